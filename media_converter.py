@@ -3,6 +3,7 @@
 
 import os
 import sys
+import threading
 
 
 __version__ = "1.0.0"
@@ -13,6 +14,25 @@ VIDEO_FORMATS = [".mov", ".mp4", ".webm", ".mkv", ".m4v", ".mxf"]
 IMAGE_FORMATS = [".jpg", ".jpeg", ".png", ".tga", ".tiff", ".tif", ".bmp", ".exr"]
 
 
+def get_user_cache_path(*args):
+    """returns a path in the user cache folder of media_converter"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "media_converter", *args)
+
+
+def get_sample_positions(duration, samples, sample_duration):
+    """returns the start times of the given number of segments spread evenly
+    over a source, a single segment from the start if the source is too short
+    or its duration is not known
+    """
+    if duration is None or duration <= samples * sample_duration:
+        return [0.0]
+    return [
+        duration * (i + 1) / (samples + 1) - sample_duration / 2
+        for i in range(samples)
+    ]
+
+
 class OutputPrinter(object):
     HEADER = "\033[95m"
     OKBLUE = "\033[94m"
@@ -21,8 +41,64 @@ class OutputPrinter(object):
     FAIL = "\033[91m"
     ENDC = "\033[0m"
 
+    # shared by all printers so blocks from concurrent jobs do not interleave
+    lock = threading.Lock()
+    # True while a status line is shown at the bottom of the terminal
+    status_line_shown = False
+
+    def __init__(self, buffered=False):
+        self.buffered = buffered
+        self.buffer = []
+
+    @classmethod
+    def clear_status(cls):
+        """clears the status line, the lock should be acquired"""
+        if cls.status_line_shown:
+            sys.stdout.flush()
+            sys.stderr.write("\r\033[K")
+            sys.stderr.flush()
+            cls.status_line_shown = False
+
+    @classmethod
+    def status(cls, text):
+        """shows the given text on the status line, which is overwritten by
+        the next status and cleared before any other output
+        """
+        with cls.lock:
+            cls.clear_status()
+            sys.stderr.write(text)
+            sys.stderr.flush()
+            cls.status_line_shown = True
+
     def print_with_color(self, color, text):
-        print("%s%s%s" % (color, text, self.ENDC))
+        line = "%s%s%s" % (color, text, self.ENDC)
+        if self.buffered:
+            self.buffer.append(line)
+        else:
+            with self.lock:
+                self.clear_status()
+                print(line)
+
+    def write(self, text):
+        """writes raw text, like the output of a process, without coloring"""
+        if not text:
+            return
+        if self.buffered:
+            self.buffer.append(text.rstrip("\n"))
+        else:
+            with self.lock:
+                self.clear_status()
+                print(text.rstrip("\n"))
+
+    def flush(self):
+        """prints the buffered lines as one uninterrupted block"""
+        if not self.buffer:
+            return
+        with self.lock:
+            self.clear_status()
+            print("\n".join(self.buffer))
+            sys.stdout.flush()
+        self.buffer = []
 
     def info(self, text):
         self.print_with_color(self.OKBLUE, text)
@@ -37,6 +113,334 @@ class OutputPrinter(object):
         self.print_with_color(self.FAIL, text)
 
 
+class QuietPrinter(OutputPrinter):
+    """A printer that keeps the lines without the colors in :attr:`lines`
+    instead of printing them, for running the jobs from another program.
+
+    It is buffered, so the output of the processes is captured too.
+    """
+
+    def __init__(self):
+        super().__init__(buffered=True)
+        self.lines = []
+
+    def print_with_color(self, color, text):
+        self.lines.append(text)
+
+    def write(self, text):
+        if text:
+            self.lines.append(text.rstrip("\n"))
+
+    def flush(self):
+        pass
+
+
+class ImageSequence(object):
+    """A compact description of an image sequence in a folder, like
+    ``name.1001.exr`` to ``name.1100.exr``, without storing every file name.
+    """
+
+    def __init__(self, **kwargs):
+        self.prefix = kwargs.get("prefix")
+        self.padding = kwargs.get("padding")
+        self.extension = kwargs.get("extension")
+        self.first = kwargs.get("first")
+        self.last = kwargs.get("last")
+        # the missing frame ranges as [start, end] pairs
+        self.gaps = kwargs.get("gaps") or []
+
+    @classmethod
+    def from_frames(cls, prefix, padding, extension, frames):
+        """creates a sequence from the given sorted list of frame numbers"""
+        gaps = []
+        for previous_frame, frame in zip(frames, frames[1:]):
+            if frame - previous_frame > 1:
+                gaps.append([previous_frame + 1, frame - 1])
+        return cls(
+            prefix=prefix,
+            padding=padding,
+            extension=extension,
+            first=frames[0],
+            last=frames[-1],
+            gaps=gaps,
+        )
+
+    @property
+    def pattern(self):
+        """the file name pattern of the sequence, like ``name.%04d.exr``"""
+        return "%s%%0%id%s" % (self.prefix, self.padding, self.extension)
+
+    @property
+    def count(self):
+        """the number of existing frames"""
+        missing = sum(end - start + 1 for start, end in self.gaps)
+        return self.last - self.first + 1 - missing
+
+    def frames(self):
+        """yields the existing frame numbers"""
+        frame = self.first
+        for start, end in self.gaps + [[self.last + 1, self.last + 1]]:
+            while frame < start:
+                yield frame
+                frame += 1
+            frame = end + 1
+
+    def file_names(self):
+        """yields the file names of the existing frames"""
+        for frame in self.frames():
+            yield "%s%0*i%s" % (self.prefix, self.padding, frame, self.extension)
+
+    def to_dict(self):
+        """returns the sequence as a JSON serializable dictionary"""
+        return {
+            "prefix": self.prefix,
+            "padding": self.padding,
+            "extension": self.extension,
+            "first": self.first,
+            "last": self.last,
+            "gaps": self.gaps,
+        }
+
+
+class SequenceIndex(object):
+    """Indexes the image sequences and the other files in a folder.
+
+    The index is built with a single ``os.scandir`` pass and kept in memory
+    and in the user cache folder. It is only rebuilt when the modification
+    time of the folder, in nanoseconds, changes, which happens when entries
+    are added or removed, so repeated runs over render folders with hundreds
+    of thousands of frames don't list them again.
+    """
+
+    # the frame number is separated with a dot or an underscore, like
+    # ``name.0001.exr`` or ``name_0001.exr``
+    frame_pattern = r"^(.*[._])([0-9]+)(\.[^.]+)$"
+
+    # indices by folder path
+    _indices = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path, mtime=None):
+        self.path = path
+        self.mtime = mtime
+        self.sequences = []
+        self.files = []
+
+    @classmethod
+    def get_cache_file_path(cls, path):
+        """returns the path of the cache file of the given folder"""
+        import hashlib
+
+        return get_user_cache_path(
+            "sequence_index",
+            "%s.json" % hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest(),
+        )
+
+    @classmethod
+    def get(cls, path):
+        """returns the up to date index of the given folder"""
+        path = os.path.abspath(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return cls(path)
+
+        with cls._lock:
+            index = cls._indices.get(path)
+        if index is not None and index.mtime == mtime:
+            return index
+
+        index = cls.load(path, mtime)
+        if index is None:
+            index = cls(path, mtime)
+            index.build()
+            index.save()
+
+        with cls._lock:
+            cls._indices[path] = index
+        return index
+
+    @classmethod
+    def load(cls, path, mtime):
+        """loads the index of the given folder from the cache, None if there
+        is no cached index or it is out of date
+        """
+        import json
+
+        try:
+            with open(cls.get_cache_file_path(path)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if data.get("path") != path or data.get("mtime") != mtime:
+            return None
+
+        index = cls(path, mtime)
+        index.sequences = [ImageSequence(**kwargs) for kwargs in data["sequences"]]
+        index.files = data["files"]
+        return index
+
+    def save(self):
+        """saves the index to the cache"""
+        import json
+        import tempfile
+
+        cache_file_path = self.get_cache_file_path(self.path)
+        try:
+            os.makedirs(os.path.dirname(cache_file_path))
+        except OSError:
+            # path already exists
+            pass
+
+        data = {
+            "path": self.path,
+            "mtime": self.mtime,
+            "sequences": [sequence.to_dict() for sequence in self.sequences],
+            "files": self.files,
+        }
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file_path))
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(temp_path, cache_file_path)
+        except OSError:
+            # the cache is only an optimization
+            pass
+
+    def build(self):
+        """lists the folder once and groups the numbered images in to
+        sequences
+        """
+        import re
+
+        frame_pattern = re.compile(self.frame_pattern)
+        frames = {}
+        files = []
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_file():
+                    # skip the hidden files like the manifest
+                    continue
+                match = frame_pattern.match(entry.name)
+                if match is None or match.group(3).lower() not in IMAGE_FORMATS:
+                    files.append(entry.name)
+                    continue
+                prefix, frame, extension = match.groups()
+                key = (prefix, len(frame), extension)
+                frames.setdefault(key, []).append(int(frame))
+
+        self.files = sorted(files)
+        self.sequences = []
+        for key in sorted(frames):
+            prefix, padding, extension = key
+            self.sequences.append(
+                ImageSequence.from_frames(
+                    prefix, padding, extension, sorted(frames[key])
+                )
+            )
+
+    def get_sequence(self, file_name):
+        """returns the sequence with the given pattern, like
+        ``name.%04d.exr``, None if there is no such sequence
+        """
+        for sequence in self.sequences:
+            if sequence.pattern == file_name:
+                return sequence
+        return None
+
+
+class NameIndex(object):
+    """Indexes the file names in a target folder to pick free output names.
+
+    The folder is listed once with ``os.scandir`` and listed again only when
+    its modification time changes. The names picked in this process are
+    reserved in the index, so the next free ``_1``, ``_2``, ... suffix is
+    found without checking the files one by one.
+    """
+
+    # indices by folder path
+    _indices = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.names = set()
+        # the names picked in this process, which may not be written yet
+        self.reserved = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, path):
+        """returns the index of the given folder"""
+        path = os.path.abspath(path)
+        with cls._lock:
+            index = cls._indices.get(path)
+            if index is None:
+                index = cls(path)
+                cls._indices[path] = index
+        return index
+
+    def refresh(self):
+        """lists the folder again if it is changed, the lock should be
+        acquired
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.mtime and mtime is not None:
+            return
+        self.mtime = mtime
+        self.names = set()
+        if mtime is not None:
+            with os.scandir(self.path) as entries:
+                self.names = set(entry.name for entry in entries)
+
+    def reserve(self, file_name):
+        """returns the given file name if it is free, the name with the
+        first free ``_1``, ``_2``, ... suffix otherwise, and reserves it
+        """
+        with self.lock:
+            self.refresh()
+            taken = self.names | self.reserved
+            name = file_name
+            root, ext = os.path.splitext(file_name)
+            i = 1
+            while name in taken:
+                name = "%s_%i%s" % (root, i, ext)
+                i += 1
+            self.reserved.add(name)
+        return name
+
+    def release(self, file_name):
+        """drops the reservation of the given file name, once the file is
+        written or it is not going to be
+        """
+        with self.lock:
+            if file_name not in self.reserved:
+                return
+            self.reserved.discard(file_name)
+            if os.path.exists(os.path.join(self.path, file_name)):
+                # the folder may be listed before the file is written in the
+                # same modification time
+                self.names.add(file_name)
+
+    @classmethod
+    def release_path(cls, path):
+        """drops the reservation of the given file path, if its folder is
+        indexed
+        """
+        if not path:
+            return
+        folder, file_name = os.path.split(os.path.abspath(path))
+        with cls._lock:
+            index = cls._indices.get(folder)
+        if index is not None:
+            index.release(file_name)
+
+
 class Manager(object):
     """Manages converters"""
 
@@ -502,311 +906,6047 @@ class Manager(object):
     ]
 
     def __init__(self):
-        self.converters = []
-        self.__initialize_converters()
+        # the converters are created when they are first asked for, so
+        # listing the templates doesn't need any of them
+        self._converters = {}
 
-    def __initialize_converters(self):
-        """Creates converters"""
-        for kwargs in self.converter_data:
-            converter = MediaConverter(**kwargs)
-
-            self.converters.append(converter)
+    @property
+    def converters(self):
+        """all the converters"""
+        return [self.get_converter(kwargs["name"]) for kwargs in self.converter_data]
 
     def get_converter(self, name):
         """returns a converter by its name"""
-        for converter in self.converters:
-            if converter.name == name:
+        converter = self._converters.get(name)
+        if converter is not None:
+            return converter
+
+        for kwargs in self.converter_data:
+            if kwargs["name"] == name:
+                converter = MediaConverter(**kwargs)
+                self._converters[name] = converter
+                return converter
+
+        if PipeChain.separator in name:
+            # a chain of templates, like denoise_normal+prores422hq
+            stages = [
+                self.get_converter(stage_name)
+                for stage_name in name.split(PipeChain.separator)
+            ]
+            if all(stages):
+                converter = MediaConverter(
+                    name=name,
+                    command=PipeChain.create_command(
+                        [stage.command for stage in stages]
+                    ),
+                    file_types=stages[0].file_types,
+                    output_file_extension=stages[-1].output_file_extension,
+                )
+                self._converters[name] = converter
                 return converter
 
         return None
 
-    def list_converter_names(self):
-        return [c.name for c in self.converters]
+    @classmethod
+    def list_converter_names(cls):
+        return [kwargs["name"] for kwargs in cls.converter_data]
 
 
-class MediaConverter(object):
-    """Converts between different media types"""
+class FFmpegCommand(object):
+    """An ffmpeg command split in to its parts::
 
-    def __init__(self, **kwargs):
+        ffmpeg [input options] -i [input] [output options] [output]
 
-        name = kwargs.get("name")
-        command = kwargs.get("command")
-        source_path = kwargs.get("source_path")
-        target_path = kwargs.get("target_path")
-        output_file_extension = kwargs.get("output_file_extension")
-        file_types = kwargs.get("file_types")
-        extra_options = kwargs.get("extra_options")
-        auto_rename = kwargs.get("auto_rename", False)
+    The options are stored as ``[flag, value]`` pairs, the value is None for
+    the options that don't take a value, like ``-an``.
+    """
 
-        self.name = name
-        self.command = command
-        self.source_path = source_path
-        self.target_path = target_path
-        self.output_file_extension = output_file_extension
-        self._extra_options = None
-        self.extra_options = extra_options
-        self.auto_rename = auto_rename
+    # the options that don't take any value
+    flags = [
+        "-an",
+        "-vn",
+        "-sn",
+        "-dn",
+        "-y",
+        "-n",
+        "-shortest",
+        "-nostdin",
+        "-nostats",
+        "-hide_banner",
+        "-re",
+        "-copyts",
+    ]
 
-        if file_types is None:
-            file_types = []
+    placeholders = ["{input_file_full_path}", "{output_file_full_path}"]
 
-        self.file_types = file_types
+    def __init__(self, **kwargs):
+        self.executable = kwargs.get("executable", "ffmpeg")
+        self.input_options = kwargs.get("input_options") or []
+        self.input_file = kwargs.get("input_file", "{input_file_full_path}")
+        self.output_options = kwargs.get("output_options") or []
+        self.output_file = kwargs.get("output_file", "{output_file_full_path}")
 
-    @property
-    def extra_options(self):
-        """Add extra options.
+    @classmethod
+    def parse_options(cls, arguments):
+        """parses the given arguments in to [flag, value] pairs"""
+        options = []
+        i = 0
+        while i < len(arguments):
+            flag = arguments[i]
+            if flag in cls.flags or i + 1 == len(arguments):
+                options.append([flag, None])
+                i += 1
+            else:
+                options.append([flag, arguments[i + 1]])
+                i += 2
+        return options
 
-        Setting any pre existing flags here will remove the original flag from
-        the original command
+    @classmethod
+    def from_string(cls, command):
+        """parses the given command string
+
+        :param str command: A command with a single input and output, like
+          the templates in :attr:`Manager.converter_data`.
         """
-        return self._extra_options
+        import shlex
 
-    @extra_options.setter
-    def extra_options(self, extra_options):
-        """setter for the extra_options attribute
+        arguments = shlex.split(command)
+        if "|" in arguments:
+            raise ValueError("not a single ffmpeg command: %s" % command)
+        input_index = arguments.index("-i")
+        return cls(
+            executable=arguments[0],
+            input_options=cls.parse_options(arguments[1:input_index]),
+            input_file=arguments[input_index + 1],
+            output_options=cls.parse_options(arguments[input_index + 2 : -1]),
+            output_file=arguments[-1],
+        )
 
-        :param str extra_options:
-        :return:
+    def get(self, *flags):
+        """returns the value of the last output option with one of the given
+        flags, None if there is no such option
         """
-        if extra_options is not None:
-            # clean the original command first
-            command = self.command
-            # ffmpeg could not be the only command we use here
-            # so assuming the command starts with this
-            # it is not good
-            input_file_template = 'ffmpeg -i "{input_file_full_path}"'
-            extra_options_template = " {extra_options}"
-            output_file_template = ' "{output_file_full_path}"'
-            command = command.replace(input_file_template, "")
-            command = command.replace(extra_options_template, "")
-            command = command.replace(output_file_template, "")
-
-            # remove any occurrence of the options from the original command
-            # part the original command to flag and value pairs
-            flags_and_values = command.split(" -")[1:]
-
-            # now we should left with only the commands and value pairs
-            # add the dash '-' sign back in to the flags_and_values
-            flags_and_values = ["-%s" % x for x in flags_and_values]
-            # now for each command try to find the extra option and replace it
-            if not extra_options.startswith(" "):
-                extra_options = " %s" % extra_options
-            extra_options_flags_and_values = extra_options.split(" -")[1:]
-            # restore extra_options
-            extra_options = extra_options.strip()
+        value = None
+        for flag, v in self.output_options:
+            if flag in flags:
+                value = v
+        return value
 
-            for extra_options_flag_and_value in extra_options_flags_and_values:
-                flag, value = extra_options_flag_and_value.split(" ")
-                if not flag:
-                    # this should be the first one skip it
-                    continue
+    def has(self, *flags):
+        """returns True if any of the given flags is in the output options"""
+        return any(flag in flags for flag, _ in self.output_options)
 
-                # add the dash sign back
-                flag = "-%s" % flag
-                # now try to find the flag in flags_and_values
+    def remove(self, *flags):
+        """removes the output options with the given flags"""
+        self.output_options = [
+            option for option in self.output_options if option[0] not in flags
+        ]
 
-                new_flags_and_values = []
-                for f in flags_and_values:
-                    if flag not in f:
-                        new_flags_and_values.append(f)
-                flags_and_values = new_flags_and_values
+    def add(self, flag, value=None):
+        """adds an output option"""
+        self.output_options.append([flag, value])
 
-            # now we should have filtered the original flags and values
-            # recompile them to a proper command
-            self.command = "%s %s%s%s" % (
-                input_file_template,
-                " ".join(flags_and_values),
-                extra_options_template,
-                output_file_template,
-            )
+    def get_input_arguments(self):
+        """returns the input options and the input as a list of arguments"""
+        arguments = []
+        for flag, value in self.input_options:
+            arguments.append(flag)
+            if value is not None:
+                arguments.append(value)
+        return arguments + ["-i", self.input_file]
 
-        self._extra_options = extra_options
+    def get_output_arguments(self):
+        """returns the output options and the output as a list of arguments"""
+        arguments = []
+        for flag, value in self.output_options:
+            arguments.append(flag)
+            if value is not None:
+                arguments.append(value)
+        return arguments + [self.output_file]
+
+    def to_arguments(self):
+        """returns the command as a list of arguments"""
+        return (
+            [self.executable]
+            + self.get_input_arguments()
+            + self.get_output_arguments()
+        )
 
     @classmethod
-    def get_start_number_from_path(cls, path):
-        """returns the start number from the given pattern. None if it is not
-        applicable.
+    def join(cls, arguments):
+        """joins the given arguments in to a shell command string"""
+        import shlex
 
-        :param path:
-        :return:
+        return " ".join(shlex.quote(argument) for argument in arguments)
+
+    def to_string(self):
+        """returns the command as a command template string, the paths are
+        left as placeholders and any other curly brackets are escaped
         """
-        import re
+        import shlex
 
-        # generate the -start_frame option as an extra option
-        glob_pattern = re.sub(r"\.%[0-9]+d", "*", path)
+        parts = []
+        for argument in self.to_arguments():
+            if argument in self.placeholders:
+                parts.append('"%s"' % argument)
+            else:
+                parts.append(
+                    shlex.quote(argument).replace("{", "{{").replace("}", "}}")
+                )
+        return " ".join(parts)
 
-        import glob
 
-        all_files = sorted(glob.glob(glob_pattern))
-        if all_files:
-            return all_files[0].split(".")[-2]
+class CommandTemplate(object):
+    """A command template compiled in to a list of arguments.
 
-    def run_per_file(self, f):
-        """converts only one file"""
-        op = OutputPrinter()
+    The template is split once, the jobs only fill the placeholders in to the
+    arguments and launch the process directly without a shell. The raw
+    tokens are kept with their quotes, so the options can be removed without
+    changing how the rest of the template is written.
 
-        source_file_full_path = f
-        op.info("source_file_full_path: %s" % source_file_full_path)
+    Templates that use shell syntax, like pipes or ``&&``, can not be run as
+    an argument list, :attr:`uses_shell` is True for them.
+    """
 
-        # get file extension
-        source_file_basename, source_file_extension = os.path.splitext(
-            os.path.basename(f)
-        )
+    # the compiled templates by the command string
+    _templates = {}
+    _lock = threading.Lock()
 
-        # if this is an image sequence try to find the start_number
+    # the characters that have a special meaning when not quoted
+    shell_characters = r"[|&;<>$`*?()]"
+
+    def __init__(self, command):
         import re
+        import shlex
 
-        is_image_sequence = re.match(r".*\.%[0-9]+d.*", source_file_basename) is not None
-        if is_image_sequence:
-            start_number = self.get_start_number_from_path(source_file_full_path)
-            # # do not add start_number option if it is already available
-            # if "start_number" not in self.extra_options:
-            #     self.extra_options = "%s -start_number %s" % (self.extra_options, start_number)
-            # add the start_number to the beginning of the command
-            # self.command =
-            self.command = self.command.replace(
-                "ffmpeg", "ffmpeg -start_number %s" % start_number
-            )
+        lexer = shlex.shlex(command, posix=False)
+        lexer.whitespace_split = True
+        lexer.commenters = ""
+        self.tokens = list(lexer)
+        self.arguments = []
+        self.uses_shell = False
+        for token in self.tokens:
+            self.arguments.append("".join(shlex.split(token)))
+            unquoted = re.sub(r"\"[^\"]*\"|'[^']*'", "", token)
+            if re.search(self.shell_characters, unquoted):
+                self.uses_shell = True
 
-        # remove any %03d or %04d from the source_file_basename
-        source_file_basename = re.sub(r"\.%[0-9]+d", "", source_file_basename)
-        source_file_extension = source_file_extension.lower()
-        op.info("source_file_basename: %s" % source_file_basename)
-        op.info("source_file_extension: %s" % source_file_extension)
+    @classmethod
+    def compile(cls, command):
+        """returns the compiled template of the given command string, each
+        command string is compiled only once
 
-        if self.output_file_extension in IMAGE_FORMATS:
-            output_file_name = "%s.%s%s" % (
-                source_file_basename,
-                "%04d",
-                self.output_file_extension,
-            )
-        else:
-            output_file_name = "%s%s" % (
-                source_file_basename,
-                self.output_file_extension,
-            )
-        op.info("output_file_name: %s" % output_file_name)
-        op.info("self.target_path: %s" % self.target_path)
+        The returned template is shared, create a new one to modify it.
+        """
+        template = cls._templates.get(command)
+        if template is None:
+            template = cls(command)
+            with cls._lock:
+                cls._templates[command] = template
+        return template
 
-        output_file_full_path = os.path.join(self.target_path, output_file_name)
+    @property
+    def command(self):
+        """the template as a command string"""
+        return " ".join(self.tokens)
 
-        op.info("output_file_full_path: %s" % output_file_full_path)
+    def remove_options(self, *flags):
+        """removes the options with the given flags and their values
 
-        # do not run the command if:
-        #    the file has no extension
-        #    the extension is not in the right format
-        #    or there is an file with the same name
-        type_is_matching = True
-        if self.file_types:
-            if (
-                source_file_extension == ""
-                or source_file_extension not in self.file_types
-            ):
-                type_is_matching = False
+        The executable, the inputs and the output are never removed. Only the
+        last command of a pipeline is changed.
+        """
+        start = 0
+        if "|" in self.arguments:
+            start = len(self.arguments) - self.arguments[::-1].index("|")
+        tokens = self.tokens[: start + 1]
+        arguments = self.arguments[: start + 1]
+        i = start + 1
+        last = len(self.arguments) - 1
+        while i < len(self.arguments):
+            argument = self.arguments[i]
+            if i == last or argument == "-i" or argument not in flags:
+                tokens.append(self.tokens[i])
+                arguments.append(argument)
+                i += 1
+            elif argument in FFmpegCommand.flags or i + 1 == last:
+                i += 1
+            else:
+                # skip the value too
+                i += 2
+        self.tokens = tokens
+        self.arguments = arguments
 
-        if type_is_matching:
-            generate_media = True
-            if os.path.exists(output_file_full_path):
-                if not self.auto_rename:
-                    generate_media = False
-                    op.warning("already exists!")
-                    op.warning("skipping: %s" % source_file_full_path)
-                else:
-                    # generate a new name for the media
-                    i = 1
-                    while os.path.exists(output_file_full_path):
-                        filename, ext = os.path.splitext(output_file_name)
-                        new_output_filename = "%s_%i%s" % (filename, i, ext)
-                        output_file_full_path = os.path.join(
-                            self.target_path, new_output_filename
-                        )
-                        i += 1
+    def add_extra_options(self):
+        """adds the ``{extra_options}`` placeholder before the output if the
+        template doesn't have it
+        """
+        if "{extra_options}" not in self.arguments:
+            self.tokens.insert(len(self.tokens) - 1, "{extra_options}")
+            self.arguments.insert(len(self.arguments) - 1, "{extra_options}")
 
-            if generate_media:
-                # create the target path
-                try:
-                    os.makedirs(self.target_path)
-                except OSError:
-                    # path already exists
-                    pass
+    def render(self, **kwargs):
+        """returns the arguments with the placeholders filled in
 
-                op.info("converting with: %s" % self.name)
-                rendered_command = self.command.format(
-                    input_file_full_path=source_file_full_path,
-                    output_file_full_path=output_file_full_path,
-                    extra_options=self.extra_options,
-                )
+        The extra options are split in to separate arguments.
+        """
+        import shlex
 
-                op.info("rendered command: %s" % rendered_command)
-                os.system(rendered_command)
+        arguments = []
+        for argument in self.arguments:
+            if argument == "{extra_options}":
+                arguments += shlex.split(kwargs.get("extra_options") or "")
+            else:
+                arguments.append(argument.format(**kwargs))
+        return arguments
 
-        else:
-            op.fail(
-                "file type is not matching: %s -> %s"
-                % (source_file_extension, self.file_types)
-            )
 
-    def run(self):
-        """runs the command"""
-        source_path = self.source_path
-        if "%" in self.source_path:
-            # this is an image sequence
-            self.run_per_file(self.source_path)
-        else:
-            if os.path.isdir(source_path):
-                # there could be image sequences in this folder.
-                # so we need to supply a compressed list of files in that situation.
-                try:
-                    # use pyseq
-                    import pyseq
-
-                    sequences = pyseq.get_sequences(self.source_path)
-                    for sequence in sequences:
-                        # only run for sequences if it is one of IMAGE_FORMATS
-                        extension = os.path.splitext(sequence.path())[-1]
-                        if extension in IMAGE_FORMATS:
-                            # This is an image sequence run for this whole sequence at once
-                            f = sequence.format("%h%p%t")
-                            self.run_per_file(os.path.join(self.source_path, f))
-                        elif extension in VIDEO_FORMATS:
-                            # Oops this is individual videos crammed together
-                            # run per item
-                            for item in sequence:
-                                f = item.path
-                                self.run_per_file(os.path.join(self.source_path, f))
-                except ImportError:
-                    # pyseq is not available
-                    # just run the normal version
-                    for f in os.listdir(self.source_path):
-                        self.run_per_file(os.path.join(self.source_path, f))
+class MediaProbe(object):
+    """Reads the stream information of media files with ffprobe"""
 
-            elif os.path.isfile(source_path):
-                self.run_per_file(self.source_path)
+    executable = "ffprobe"
+    # the ProbeCache to keep the probed info of the unchanged files in
+    cache = None
 
+    @classmethod
+    def probe(cls, path):
+        """returns the ffprobe output of the given file as a dictionary, None
+        if the file can not be probed
 
-def main():
-    """The main function"""
-    try:
-        from colorama import init
+        The info is looked up in the :attr:`cache` if there is one.
+        """
+        if cls.cache is not None:
+            return cls.cache.get(path)
+        return cls.run(path)
 
-        init()
-    except ImportError:
-        pass
+    @classmethod
+    def run(cls, path):
+        """runs ffprobe on the given file, returns its output as a
+        dictionary, None if the file can not be probed
+        """
+        import json
+        import subprocess
 
-    # create a manager
-    manager = Manager()
-    converter_names = manager.list_converter_names()
+        try:
+            output = subprocess.check_output(
+                [
+                    cls.executable,
+                    "-v",
+                    "error",
+                    "-print_format",
+                    "json",
+                    "-show_format",
+                    "-show_streams",
+                    path,
+                ],
+                stdin=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return None
 
-    import argparse
+        try:
+            return json.loads(output.decode("utf-8", "replace"))
+        except ValueError:
+            return None
 
-    parser = argparse.ArgumentParser(
-        description="Batch convert media by using templates"
-    )
-    parser.add_argument(
-        "-t",
+    @classmethod
+    def get_streams(cls, info, codec_type):
+        """returns the streams of the given type ("video" or "audio") from
+        the probed info, attached pictures like cover arts are not counted
+        """
+        return [
+            stream
+            for stream in (info or {}).get("streams", [])
+            if stream.get("codec_type") == codec_type
+            and not stream.get("disposition", {}).get("attached_pic")
+        ]
+
+
+class ProbeCache(object):
+    """Keeps the ffprobe output of the sources in a SQLite database.
+
+    The info is stored by the path, size and modification time of the file,
+    so a file is only probed again when it is changed. The files that can not
+    be probed are not stored, as ffprobe may be missing or the storage may be
+    unreachable for now, they are probed again every time. The sources can be
+    probed in parallel before the conversion starts with :meth:`prefetch`,
+    which is much faster than probing them one by one on network storage.
+    """
+
+    # the number of ffprobe processes to run in parallel
+    workers = 8
+
+    def __init__(self, path=None):
+        self.path = path or get_user_cache_path("probe.sqlite")
+        self._connection = None
+        self.lock = threading.Lock()
+        # the info of the files looked up in this process, by the file key
+        self.infos = {}
+
+    @property
+    def connection(self):
+        """the connection to the database, creates the database if needed"""
+        if self._connection is None:
+            import sqlite3
+
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError:
+                # path already exists
+                pass
+
+            self._connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS probes ("
+                "path TEXT PRIMARY KEY, "
+                "size INTEGER, "
+                "mtime INTEGER, "
+                "info TEXT)"
+            )
+            self._connection.commit()
+        return self._connection
+
+    @classmethod
+    def get_probe_path(cls, path):
+        """returns the file to probe for the given source, the first frame for
+        image sequences
+        """
+        sequence = MediaConverter.get_sequence(path)
+        if sequence is None:
+            return path
+        return os.path.join(os.path.dirname(path), next(sequence.file_names()))
+
+    def get(self, path):
+        """returns the info of the given file from the cache, probes the file
+        if it is not in the cache or changed since it is probed
+        """
+        import json
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # like image sequence patterns
+            return MediaProbe.run(path)
+
+        path = os.path.abspath(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if key in self.infos:
+                return self.infos[key]
+            row = self.connection.execute(
+                "SELECT size, mtime, info FROM probes WHERE path = ?", (path,)
+            ).fetchone()
+        if row is not None and tuple(row[:2]) == key[1:] and row[2] is not None:
+            info = json.loads(row[2])
+        else:
+            info = MediaProbe.run(path)
+            if info is None:
+                # ffprobe may be missing or the file may not be readable for
+                # now, so the failures are probed again the next time
+                return None
+            with self.lock:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?)",
+                    key + (json.dumps(info),),
+                )
+                self.connection.commit()
+
+        with self.lock:
+            self.infos[key] = info
+        return info
+
+    def prefetch(self, paths):
+        """probes the given sources in parallel
+
+        :return: A list of (source, info) pairs in the given order, the info
+          is None for the sources that can not be probed.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        probe_paths = [self.get_probe_path(path) for path in paths]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            infos = list(executor.map(self.get, probe_paths))
+        return list(zip(paths, infos))
+
+    @classmethod
+    def describe(cls, path, info):
+        """returns the duration, codecs, resolution and frame count of the
+        given source as a dictionary of strings
+        """
+        row = {
+            "duration": "-",
+            "video": "-",
+            "resolution": "-",
+            "frames": "-",
+            "audio": "-",
+        }
+        if info is None:
+            return row
+
+        try:
+            row["duration"] = ProgressTracker.format_time(
+                float(info["format"]["duration"])
+            )
+        except (KeyError, TypeError, ValueError):
+            pass
+        video_streams = MediaProbe.get_streams(info, "video")
+        if video_streams:
+            stream = video_streams[0]
+            row["video"] = stream.get("codec_name", "-")
+            if stream.get("width"):
+                row["resolution"] = "%sx%s" % (stream["width"], stream["height"])
+            row["frames"] = stream.get("nb_frames", "-")
+        audio_streams = MediaProbe.get_streams(info, "audio")
+        if audio_streams:
+            row["audio"] = audio_streams[0].get("codec_name", "-")
+
+        sequence = MediaConverter.get_sequence(path)
+        if sequence is not None:
+            row["frames"] = "%i" % sequence.count
+        return row
+
+    def print_table(self, paths):
+        """probes the given sources and prints their metadata as a table
+
+        :return: The list of the sources that can not be probed.
+        """
+        columns = ["duration", "video", "resolution", "frames", "audio"]
+        rows = []
+        failed = []
+        for path, info in self.prefetch(paths):
+            if info is None:
+                failed.append(path)
+            row = self.describe(path, info)
+            rows.append([row[column] for column in columns] + [path])
+
+        header = columns + ["path"]
+        widths = [
+            max(len(str(row[i])) for row in rows + [header])
+            for i in range(len(columns))
+        ]
+        for row in [header] + rows:
+            print(
+                "  ".join(
+                    ["%-*s" % (width, value) for width, value in zip(widths, row)]
+                    + [row[-1]]
+                )
+            )
+
+        op = OutputPrinter()
+        for path in failed:
+            op.fail("can not be probed: %s" % path)
+        return failed
+
+    def close(self):
+        """closes the connection"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class StreamCopyPlanner(object):
+    """Decides which streams of a job can be copied instead of re-encoded.
+
+    The streams of the source are compared against what the template would
+    produce. A stream is copied only if it is already in the target codec and
+    the template doesn't filter, scale or retime it.
+    """
+
+    COPY = "copy"
+    ENCODE = "encode"
+
+    # codec names of the encoders used in the templates
+    encoder_codecs = {
+        "libx264": "h264",
+        "libx265": "hevc",
+        "prores_ks": "prores",
+        "prores_aw": "prores",
+        "libvpx-vp9": "vp9",
+        "libmp3lame": "mp3",
+        "libfdk_aac": "aac",
+        "libopus": "opus",
+        "libvorbis": "vorbis",
+    }
+
+    # the codecs ffmpeg picks by default for the output file extension
+    default_codecs = {
+        ".mp4": ("h264", "aac"),
+        ".m4v": ("h264", "aac"),
+        ".mov": ("h264", "aac"),
+        ".mkv": ("h264", "vorbis"),
+        ".webm": ("vp9", "opus"),
+        ".mxf": ("mpeg2video", "pcm_s16le"),
+        ".wav": (None, "pcm_s16le"),
+        ".mp3": (None, "mp3"),
+        ".m4a": (None, "aac"),
+        ".ac3": (None, "ac3"),
+    }
+
+    # prores profile numbers and the names ffprobe reports for them
+    prores_profiles = {
+        "0": "proxy",
+        "1": "lt",
+        "2": "standard",
+        "3": "hq",
+        "4": "4444",
+        "5": "4444 xq",
+    }
+
+    stream_options = {
+        "video": {
+            "codec": ["-c:v", "-vcodec", "-codec:v"],
+            "disable": ["-vn"],
+            # options that only tune the encoder, dropped when copying
+            "encoder": [
+                "-crf",
+                "-b:v",
+                "-preset",
+                "-profile:v",
+                "-g",
+                "-bf",
+                "-flags:v",
+                "-coder",
+                "-q:v",
+                "-qscale:v",
+                "-vendor",
+                "-tune",
+                "-level",
+                "-x264opts",
+                "-x264-params",
+                "-maxrate",
+                "-bufsize",
+            ],
+            # options that change the frames, the stream can not be copied
+            "blocking": [
+                "-vf",
+                "-filter:v",
+                "-filter_complex",
+                "-lavfi",
+                "-s",
+                "-r",
+                "-pix_fmt",
+                "-aspect",
+            ],
+        },
+        "audio": {
+            "codec": ["-c:a", "-acodec", "-codec:a"],
+            "disable": ["-an"],
+            "encoder": ["-b:a", "-ab", "-profile:a", "-q:a"],
+            "blocking": [
+                "-af",
+                "-filter:a",
+                "-filter_complex",
+                "-lavfi",
+                "-ar",
+                "-ac",
+                "-r:a",
+            ],
+        },
+    }
+
+    @classmethod
+    def get_target_codec(cls, command, codec_type, output_file_extension):
+        """returns the codec name the command produces for the given stream
+        type, "copy" if the stream is already copied
+        """
+        options = cls.stream_options[codec_type]
+        encoder = command.get(*options["codec"]) or command.get("-c")
+        if encoder is not None:
+            return cls.encoder_codecs.get(encoder, encoder)
+
+        video_codec, audio_codec = cls.default_codecs.get(
+            output_file_extension.lower(), (None, None)
+        )
+        return video_codec if codec_type == "video" else audio_codec
+
+    @classmethod
+    def profile_matches(cls, command, stream):
+        """returns True if the profile requested by the command matches the
+        profile of the given stream
+        """
+        profile = command.get("-profile:v")
+        if profile is None:
+            return True
+        if stream.get("codec_name") == "prores":
+            profile = cls.prores_profiles.get(profile, profile)
+        return profile.lower() == str(stream.get("profile", "")).lower()
+
+    @classmethod
+    def decide(cls, command, info, codec_type, output_file_extension):
+        """decides if the streams of the given type should be copied or
+        encoded
+
+        :return: ``COPY``, ``ENCODE`` or None if the output will not have a
+          stream of this type.
+        """
+        streams = MediaProbe.get_streams(info, codec_type)
+        options = cls.stream_options[codec_type]
+        target_codec = cls.get_target_codec(command, codec_type, output_file_extension)
+        if not streams or target_codec is None or command.has(*options["disable"]):
+            return None
+
+        if target_codec == cls.COPY:
+            return cls.COPY
+
+        if command.has(*options["blocking"]):
+            return cls.ENCODE
+
+        for stream in streams:
+            if stream.get("codec_name") != target_codec:
+                return cls.ENCODE
+            if codec_type == "video" and not cls.profile_matches(command, stream):
+                return cls.ENCODE
+        return cls.COPY
+
+    @classmethod
+    def plan(cls, job, info=None):
+        """switches the compatible streams of the given job to stream copy
+
+        :param Job job: The job to plan, its command is updated in place.
+        :param dict info: The probed info of the source, probed if skipped.
+        :return: A dictionary with the decision for the "video" and "audio"
+          streams, None if the source can not be probed.
+        """
+        if "%" in job.source_file_full_path:
+            # image sequences are always encoded
+            return None
+
+        if info is None:
+            info = MediaProbe.probe(job.source_file_full_path)
+        if info is None:
+            return None
+
+        command = job.get_ffmpeg_command()
+        output_file_extension = os.path.splitext(job.output_file_full_path)[-1]
+        decisions = {}
+        changed = False
+        for codec_type in ["video", "audio"]:
+            decision = cls.decide(command, info, codec_type, output_file_extension)
+            decisions[codec_type] = decision
+            options = cls.stream_options[codec_type]
+            if decision == cls.COPY and command.get(*options["codec"]) != cls.COPY:
+                command.remove(*(options["codec"] + options["encoder"]))
+                command.add(options["codec"][0], cls.COPY)
+                changed = True
+
+        if changed:
+            job.set_ffmpeg_command(command)
+        job.stream_copy = decisions
+        return decisions
+
+    @classmethod
+    def describe(cls, decisions):
+        """returns a short description of the given decisions"""
+        if decisions is None:
+            return "re-encode (not probed)"
+        values = [value for value in decisions.values() if value is not None]
+        if values and all(value == cls.COPY for value in values):
+            return "remux"
+        if cls.COPY in values:
+            return "partial remux (%s)" % ", ".join(
+                "%s: %s" % (codec_type, decisions[codec_type])
+                for codec_type in ["video", "audio"]
+                if decisions[codec_type] is not None
+            )
+        return "re-encode"
+
+
+class ProcessWatchdog(object):
+    """Kills the processes of the jobs that run too long or stop making
+    progress.
+
+    The processes of the running jobs are checked by a single background
+    thread. A job is timed out when it runs longer than its ``timeout`` and
+    stalled when neither its log nor its output grows for ``stall_timeout``
+    seconds, like an ffmpeg stuck on a network read. All the processes are
+    killed when the batch is cancelled with Ctrl-C.
+    """
+
+    # seconds between the checks
+    interval = 0.5
+    # set when the batch is cancelled, no more processes are started
+    cancelled = threading.Event()
+
+    # the watched processes and their activity by job
+    _watches = {}
+    _lock = threading.Lock()
+    _thread = None
+
+    @classmethod
+    def watch(cls, job, process):
+        """starts watching the given process of the given job"""
+        import time
+
+        with cls._lock:
+            watch = cls._watches.get(job)
+            if watch is None:
+                watch = {
+                    "processes": [],
+                    "last_activity": time.time(),
+                    "output_size": None,
+                }
+                cls._watches[job] = watch
+            watch["processes"].append(process)
+            if cls._thread is None:
+                cls._thread = threading.Thread(target=cls.run, daemon=True)
+                cls._thread.start()
+        if cls.cancelled.is_set():
+            cls.kill(process)
+
+    @classmethod
+    def unwatch(cls, job, process):
+        """stops watching the given process, kills it if it is still
+        running
+        """
+        if process.poll() is None:
+            cls.kill(process)
+            process.wait()
+        with cls._lock:
+            watch = cls._watches.get(job)
+            if watch is not None:
+                watch["processes"].remove(process)
+                if not watch["processes"]:
+                    del cls._watches[job]
+
+    @classmethod
+    def touch(cls, job):
+        """marks the given job as making progress, like when it prints"""
+        import time
+
+        watch = cls._watches.get(job)
+        if watch is not None:
+            watch["last_activity"] = time.time()
+
+    @classmethod
+    def kill(cls, process):
+        """kills the given process, with its children if it is the leader of
+        its own session, like the commands run through a shell
+        """
+        import signal
+
+        try:
+            if os.getpgid(process.pid) == process.pid:
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError:
+            # already finished
+            pass
+
+    @classmethod
+    def check(cls, now):
+        """kills the processes of the timed out and stalled jobs"""
+        with cls._lock:
+            watches = list(cls._watches.items())
+
+        for job, watch in watches:
+            reason = None
+            if job.is_timed_out(now):
+                reason = "timed out after %i seconds" % job.timeout
+            elif job.stall_timeout:
+                output_size = job.get_output_size()
+                if output_size != watch["output_size"]:
+                    watch["output_size"] = output_size
+                    watch["last_activity"] = now
+                elif now - watch["last_activity"] > job.stall_timeout:
+                    reason = "stalled for %i seconds" % job.stall_timeout
+            if reason is None or job.kill_reason is not None:
+                continue
+            job.kill_reason = reason
+            job.printer.fail("%s: %s" % (reason, job.source_file_full_path))
+            for process in list(watch["processes"]):
+                cls.kill(process)
+
+    @classmethod
+    def run(cls):
+        """checks the watched jobs until there are none left"""
+        import time
+
+        while True:
+            time.sleep(cls.interval)
+            cls.check(time.time())
+            with cls._lock:
+                if not cls._watches:
+                    cls._thread = None
+                    return
+
+    @classmethod
+    def cancel(cls):
+        """kills all the watched processes and stops starting new ones"""
+        cls.cancelled.set()
+        with cls._lock:
+            processes = [
+                process
+                for watch in cls._watches.values()
+                for process in watch["processes"]
+            ]
+        for process in processes:
+            cls.kill(process)
+
+    @classmethod
+    def reset(cls):
+        """allows starting processes again after a cancel"""
+        cls.cancelled.clear()
+
+
+class Job(object):
+    """A single conversion of one source into one output.
+
+    Holds everything needed to run the conversion later, so a whole batch
+    can be collected before anything is executed.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+    # the seconds to wait before the first retry, doubled for every retry
+    retry_delay = 5.0
+
+    def __init__(self, **kwargs):
+        self.converter_name = kwargs.get("converter_name")
+        self.command = kwargs.get("command")
+        self.source_file_full_path = kwargs.get("source_file_full_path")
+        self.output_file_full_path = kwargs.get("output_file_full_path")
+        # the path the output is moved to while it is staged to a temporary
+        # file, see stage_output()
+        self.final_output_file_full_path = None
+        self.extra_options = kwargs.get("extra_options")
+        self.printer = kwargs.get("printer") or OutputPrinter()
+        # set by the CoreBudget right before the job is launched
+        self.threads = None
+        # the manifest to record the output in when the job is done
+        self.manifest = kwargs.get("manifest")
+        # remove the existing (out of date) output before running
+        self.overwrite = False
+        # pick a free name if the output appears while the job is running
+        self.auto_rename = kwargs.get("auto_rename", False)
+        # the seconds the job can run and can run without making progress
+        # before it is killed by the ProcessWatchdog
+        self.timeout = kwargs.get("timeout")
+        self.stall_timeout = kwargs.get("stall_timeout")
+        # how many times the stalled and crashed jobs are run again
+        self.retries = kwargs.get("retries", 0)
+        self.attempts = 0
+        # why the ProcessWatchdog has killed the job
+        self.kill_reason = None
+        # the job this one is a part of, like the chunks of a ChunkedEncoder,
+        # its timeout covers all of its parts
+        self.parent = kwargs.get("parent")
+        # the OutputCache to look the output up in before running
+        self.cache = kwargs.get("cache")
+        self.cache_key = None
+        self.cache_hit = False
+        # the stream copy decisions of the StreamCopyPlanner
+        self.stream_copy = None
+        # runs the job in a custom way instead of running its command, like
+        # the ChunkedEncoder
+        self.runner = None
+        # the ProgressTracker to report the -progress output of ffmpeg to
+        self.progress = kwargs.get("progress")
+        # the id of the job in the WorkQueue it is pushed to
+        self.queue_id = None
+        # set by the SchedulingPolicy right before the job is launched
+        self.cpus = None
+        self.nice = None
+        self.ionice = None
+        self.scheduling = None
+
+        self.status = self.PENDING
+        self.return_code = None
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def rendered_command(self):
+        """the command with the file paths and extra options filled in"""
+        return self.command.format(
+            input_file_full_path=self.source_file_full_path,
+            output_file_full_path=self.output_file_full_path,
+            extra_options=self.extra_options or "",
+        )
+
+    @property
+    def normalized_command(self):
+        """the command with the extra options filled in but without the file
+        paths, so it is the same for every file converted the same way
+        """
+        import re
+
+        command = self.command.format(
+            input_file_full_path="{input_file_full_path}",
+            output_file_full_path="{output_file_full_path}",
+            extra_options=self.extra_options or "",
+        )
+        return re.sub(r"\s+", " ", command).strip()
+
+    def get_ffmpeg_command(self):
+        """returns the command of this job as an :class:`FFmpegCommand`, with
+        the extra options merged in
+        """
+        return FFmpegCommand.from_string(self.normalized_command)
+
+    def set_ffmpeg_command(self, command):
+        """sets the command of this job from the given :class:`FFmpegCommand`
+
+        The extra options should already be merged in to it.
+        """
+        self.command = command.to_string()
+
+    def add_extra_options(self, options):
+        """adds the given options to the extra options, the options of the
+        template with the same flags are removed so the given ones are used
+        """
+        import shlex
+
+        flags = [argument for argument in shlex.split(options) if argument[:1] == "-"]
+        template = CommandTemplate(self.command)
+        template.remove_options(*flags)
+        template.add_extra_options()
+        self.command = template.command
+        self.extra_options = " ".join(
+            option for option in [self.extra_options, options] if option
+        )
+
+    @property
+    def arguments(self):
+        """the command as a list of arguments with the file paths and extra
+        options filled in, None if the command needs a shell
+        """
+        template = CommandTemplate.compile(self.command)
+        if template.uses_shell:
+            return None
+        return template.render(
+            input_file_full_path=self.source_file_full_path,
+            output_file_full_path=self.output_file_full_path,
+            extra_options=self.extra_options or "",
+        )
+
+    @property
+    def launch_arguments(self):
+        """the arguments with the per job thread count injected, None if the
+        command needs a shell
+        """
+        arguments = self.arguments
+        if (
+            not self.threads
+            or arguments is None
+            or os.path.basename(arguments[0]) != "ffmpeg"
+            or "-threads" in (self.extra_options or "")
+        ):
+            # not an ffmpeg command or the user has chosen the thread count
+            return arguments
+
+        threads = "%i" % self.threads
+        # drop any thread count coming from the template
+        options = []
+        i = 1
+        while i < len(arguments) - 1:
+            if arguments[i] == "-threads":
+                i += 2
+                continue
+            options.append(arguments[i])
+            i += 1
+        # decoder and filter threads go before the input, encoder threads
+        # before the output
+        global_options = ["-threads", threads, "-filter_threads", threads]
+        if "-filter_complex" in options or "-lavfi" in options:
+            global_options += ["-filter_complex_threads", threads]
+        return (
+            arguments[:1]
+            + global_options
+            + options
+            + ["-threads", threads, arguments[-1]]
+        )
+
+    @property
+    def launch_command(self):
+        """the command that is launched, for printing"""
+        arguments = self.launch_arguments
+        if arguments is None:
+            return self.rendered_command
+        return FFmpegCommand.join(arguments)
+
+    def format_command(self, arguments=None):
+        """returns the given arguments, or the launched command of this job,
+        as text for printing, with the final output paths in place of the
+        staged ones
+        """
+        jobs = [self]
+        if isinstance(self.runner, MultiOutputRunner):
+            jobs = self.runner.jobs
+        final_paths = dict(
+            (job.output_file_full_path, job.final_output_file_full_path)
+            for job in jobs
+            if job.final_output_file_full_path is not None
+        )
+        if arguments is None:
+            arguments = self.launch_arguments
+        if arguments is None:
+            return self.command.format(
+                input_file_full_path=self.source_file_full_path,
+                output_file_full_path=final_paths.get(
+                    self.output_file_full_path, self.output_file_full_path
+                ),
+                extra_options=self.extra_options or "",
+            )
+        return FFmpegCommand.join(
+            [final_paths.get(argument, argument) for argument in arguments]
+        )
+
+    def describe_scheduling(self):
+        """returns the scheduling policy of this job as text"""
+        if self.cpus:
+            return "%s, cpus %s" % (
+                self.scheduling,
+                SchedulingPolicy.format_cpu_list(self.cpus),
+            )
+        return self.scheduling
+
+    @property
+    def elapsed(self):
+        """returns the run time of the job in seconds, None if not run yet"""
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def run(self):
+        """runs the job and stores the return code
+
+        The output of the process is captured in to the printer when it is
+        buffered, so the whole job can be printed as one block.
+        """
+        import time
+
+        op = self.printer
+        if self.overwrite and "%" in self.output_file_full_path:
+            # the image sequences are not staged, the other outputs are only
+            # replaced once the job is succeeded, see commit_output()
+            for output_file in MediaConverter.get_sequence_files(
+                self.output_file_full_path
+            ):
+                op.warning("removing out of date output: %s" % output_file)
+                os.remove(output_file)
+
+        self.status = self.RUNNING
+        self.start_time = time.time()
+        if self.cache is not None and self.cache.fetch(self):
+            self.cache_hit = True
+            self.end_time = time.time()
+            self.return_code = 0
+            self.status = self.DONE
+            op.ok("cache hit: %s" % self.output_file_full_path)
+            if self.manifest is not None:
+                self.manifest.record(self)
+            op.flush()
+            return self.return_code
+
+        while True:
+            self.attempts += 1
+            self.kill_reason = None
+            if ProcessWatchdog.cancelled.is_set():
+                op.fail("cancelled: %s" % self.source_file_full_path)
+                return self.finish(130)
+            if self.is_timed_out(time.time()):
+                # the parts queued after the job is timed out are not started
+                self.kill_reason = "timed out after %i seconds" % self.timeout
+                op.fail("%s: %s" % (self.kill_reason, self.source_file_full_path))
+                return self.finish(1)
+
+            final_output_file_full_path = self.stage_output()
+            return_code = None
+            try:
+                if self.runner is not None:
+                    return_code = self.runner.execute(self)
+                else:
+                    return_code = self.execute()
+            finally:
+                if final_output_file_full_path is not None:
+                    return_code = self.commit_output(
+                        final_output_file_full_path, return_code
+                    )
+
+            if (
+                return_code == 0
+                or self.attempts > self.retries
+                or not self.is_retriable(return_code)
+            ):
+                return self.finish(return_code)
+            delay = self.retry_delay * 2 ** (self.attempts - 1)
+            op.warning(
+                "retrying in %.1f seconds (%i/%i): %s"
+                % (delay, self.attempts, self.retries, self.source_file_full_path)
+            )
+            # wakes up if the batch is cancelled
+            ProcessWatchdog.cancelled.wait(delay)
+
+    @property
+    def root(self):
+        """the job this job is a part of, itself if it is not a part"""
+        job = self
+        while job.parent is not None:
+            job = job.parent
+        return job
+
+    def is_timed_out(self, now):
+        """returns True if this job, or the job it is a part of, is running
+        longer than the timeout of this job
+        """
+        start_time = self.root.start_time
+        return bool(self.timeout and start_time and now - start_time > self.timeout)
+
+    def create_part(self, **kwargs):
+        """returns a job running a part of this job, like a chunk, with the
+        timeouts and the retries of this job
+
+        The keyword arguments are passed to the :class:`Job`.
+        """
+        kwargs.setdefault("printer", OutputPrinter(buffered=True))
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs.setdefault("stall_timeout", self.stall_timeout)
+        kwargs.setdefault("retries", self.retries)
+        return Job(parent=self, **kwargs)
+
+    def get_parts_return_code(self, parts):
+        """returns the exit code of this job from the given parts which are
+        run, None if all of them are done
+
+        The parts are retried on their own, so this job fails without being
+        retried as a whole, but it is timed out with its parts.
+        """
+        failed = [part for part in parts if part.status != self.DONE]
+        if not failed:
+            return None
+        for part in failed:
+            if part.kill_reason is not None and not part.kill_reason.startswith(
+                "stalled"
+            ):
+                self.kill_reason = part.kill_reason
+        return 1
+
+    def get_output_size(self):
+        """returns the size of the output in bytes, the total size of the
+        files of an image sequence output, None if there is no output yet
+        """
+        if "%" not in self.output_file_full_path:
+            try:
+                return os.path.getsize(self.output_file_full_path)
+            except OSError:
+                return None
+        size = None
+        for path in MediaConverter.get_sequence_files(self.output_file_full_path):
+            try:
+                size = (size or 0) + os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def is_retriable(self, return_code):
+        """returns True if the job failed in a way that another run may
+        succeed, like a stall or a crash, but not for bad inputs or timeouts
+        """
+        if ProcessWatchdog.cancelled.is_set():
+            return False
+        if self.kill_reason is not None:
+            return self.kill_reason.startswith("stalled")
+        # killed by a signal
+        return return_code is not None and return_code < 0
+
+    def stage_output(self):
+        """points the output of this job to a hidden temporary file next to
+        it, so a killed job never leaves a partial output behind
+
+        :return: The final output path, None if the output is not staged,
+          like for image sequences.
+        """
+        import uuid
+
+        if "%" in self.output_file_full_path:
+            return None
+        final_output_file_full_path = self.output_file_full_path
+        target_path, file_name = os.path.split(final_output_file_full_path)
+        root, ext = os.path.splitext(file_name)
+        # keep the extension, ffmpeg picks the muxer by it
+        self.output_file_full_path = os.path.join(
+            target_path, ".%s.%s.part%s" % (root, uuid.uuid4().hex[:12], ext)
+        )
+        self.final_output_file_full_path = final_output_file_full_path
+        return final_output_file_full_path
+
+    def commit_output(self, final_output_file_full_path, return_code):
+        """moves the staged output in to its final path if the job is
+        succeeded, removes it otherwise
+
+        The existing outputs are only replaced if the job overwrites them, if
+        the output appeared while the job was running a free name is picked
+        when auto renaming.
+
+        :return: The exit code of the job.
+        """
+        op = self.printer
+        staged_output_file_full_path = self.output_file_full_path
+        self.output_file_full_path = final_output_file_full_path
+        self.final_output_file_full_path = None
+        if return_code != 0 or not os.path.exists(staged_output_file_full_path):
+            # failed or the output is written somewhere else
+            try:
+                os.remove(staged_output_file_full_path)
+            except OSError:
+                pass
+            return return_code
+
+        try:
+            if self.overwrite:
+                os.replace(staged_output_file_full_path, final_output_file_full_path)
+                return return_code
+            while True:
+                try:
+                    self.move_output(staged_output_file_full_path)
+                except FileExistsError:
+                    if not self.auto_rename:
+                        raise
+                    target_path, file_name = os.path.split(self.output_file_full_path)
+                    index = NameIndex.get(target_path)
+                    # the name is taken, reserve the next free one instead
+                    index.release(file_name)
+                    self.output_file_full_path = os.path.join(
+                        target_path, index.reserve(file_name)
+                    )
+                    op.warning("renamed to: %s" % self.output_file_full_path)
+                    continue
+                return return_code
+        except OSError as e:
+            op.fail("can not move the output in to place: %s" % e)
+            try:
+                os.remove(staged_output_file_full_path)
+            except OSError:
+                pass
+            return 1
+
+    def move_output(self, staged_output_file_full_path):
+        """moves the given staged output to the output path of this job
+        without replacing an existing file
+
+        :raises FileExistsError: If there is a file in the output path.
+        """
+        try:
+            # linking never replaces an existing file
+            os.link(staged_output_file_full_path, self.output_file_full_path)
+        except FileExistsError:
+            raise
+        except OSError:
+            # hard links are not supported, like on some network shares, claim
+            # the name with an exclusive create and move the output over it
+            os.close(
+                os.open(
+                    self.output_file_full_path,
+                    os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                )
+            )
+            os.replace(staged_output_file_full_path, self.output_file_full_path)
+            return
+        os.remove(staged_output_file_full_path)
+
+    def finish(self, return_code):
+        """stores the result of the job, records its output when it is
+        succeeded and prints the buffered output
+        """
+        import time
+
+        op = self.printer
+        self.end_time = time.time()
+        self.return_code = return_code
+        # the output is written or it is not going to be
+        NameIndex.release_path(self.output_file_full_path)
+        if self.return_code == 0:
+            self.status = self.DONE
+            if self.manifest is not None:
+                self.manifest.record(self)
+            if self.cache is not None:
+                self.cache.store(self)
+        else:
+            self.status = self.FAILED
+            op.fail(
+                "failed with exit code %s: %s"
+                % (self.return_code, self.source_file_full_path)
+            )
+        op.flush()
+        return self.return_code
+
+    def execute(self, arguments=None):
+        """runs the command of this job in a process
+
+        The process is launched directly from its arguments, only the
+        commands using shell syntax are run through a shell.
+
+        :param list arguments: The arguments to run instead of the command of
+          this job.
+        :return: The exit code of the process.
+        """
+        import subprocess
+
+        op = self.printer
+        if arguments is None:
+            arguments = self.launch_arguments
+        shell = arguments is None
+        command = self.launch_command if shell else None
+        op.info("converting with: %s" % self.converter_name)
+        op.info("rendered command: %s" % self.format_command(arguments))
+        if self.scheduling:
+            op.info("scheduling: %s" % self.describe_scheduling())
+
+        if (
+            self.progress is not None
+            and not shell
+            and os.path.basename(arguments[0]) == "ffmpeg"
+        ):
+            return self.execute_with_progress(arguments)
+
+        kwargs = {}
+        if op.buffered:
+            kwargs = {
+                "stdin": subprocess.DEVNULL,
+                "stdout": subprocess.PIPE,
+                "stderr": subprocess.STDOUT,
+            }
+        try:
+            process = subprocess.Popen(
+                command if shell else arguments,
+                shell=shell,
+                # so the ProcessWatchdog can kill the children of the shell
+                start_new_session=shell,
+                **kwargs,
+            )
+        except OSError as e:
+            # the executable is not found, report it like the shell would do
+            op.fail("%s: %s" % (arguments[0], e.strerror))
+            return 127
+
+        SchedulingPolicy.apply(self, process.pid)
+        ProcessWatchdog.watch(self, process)
+        try:
+            if op.buffered:
+                output = []
+                while True:
+                    data = os.read(process.stdout.fileno(), 65536)
+                    if not data:
+                        break
+                    output.append(data)
+                    ProcessWatchdog.touch(self)
+                process.stdout.close()
+                op.write(
+                    b"".join(output)
+                    .decode("utf-8", "replace")
+                    .replace("\r\n", "\n")
+                    .replace("\r", "\n")
+                )
+            return process.wait()
+        finally:
+            ProcessWatchdog.unwatch(self, process)
+
+    def execute_with_progress(self, arguments):
+        """runs the given ffmpeg arguments with ``-progress pipe:1`` and
+        reports the progress to the :class:`ProgressTracker` of this job
+
+        The log of ffmpeg is captured and printed when the job is finished.
+
+        :return: The exit code of the process.
+        """
+        import subprocess
+
+        arguments = (
+            arguments[:1] + ["-progress", "pipe:1", "-nostats"] + arguments[1:]
+        )
+        try:
+            process = subprocess.Popen(
+                arguments,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                errors="replace",
+            )
+        except OSError as e:
+            self.printer.fail("%s: %s" % (arguments[0], e.strerror))
+            return 127
+        SchedulingPolicy.apply(self, process.pid)
+        ProcessWatchdog.watch(self, process)
+        # drain the log in the background, so ffmpeg never blocks on it
+        log = []
+        log_reader = threading.Thread(
+            target=lambda: log.append(process.stderr.read())
+        )
+        log_reader.start()
+
+        self.progress.start_job(self)
+        data = {}
+        try:
+            for line in process.stdout:
+                ProcessWatchdog.touch(self)
+                key, _, value = line.strip().partition("=")
+                data[key] = value
+                if key == "progress":
+                    self.progress.update(self, data)
+                    data = {}
+            return_code = process.wait()
+        finally:
+            ProcessWatchdog.unwatch(self, process)
+        log_reader.join()
+        self.progress.end_job(self, return_code)
+
+        self.printer.write("".join(log))
+        return return_code
+
+
+class Manifest(object):
+    """Records the outputs generated in a target folder.
+
+    Stores the size and modification time of the source, the template, the
+    command and the fingerprint of the output for every generated file in a
+    SQLite database in the target folder. A job is up to date only if all of
+    them are still matching, so outputs of changed sources, templates or
+    extra options and outputs of crashed jobs (which are never recorded) are
+    generated again.
+    """
+
+    file_name = ".media_converter_manifest.sqlite"
+
+    def __init__(self, target_path):
+        self.target_path = target_path
+        self.path = os.path.join(target_path, self.file_name)
+        self._connection = None
+        self.lock = threading.Lock()
+
+    @property
+    def connection(self):
+        """the connection to the database, creates the database if needed"""
+        if self._connection is None:
+            import sqlite3
+
+            try:
+                os.makedirs(self.target_path)
+            except OSError:
+                # path already exists
+                pass
+
+            # jobs are recorded from the worker threads
+            self._connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS outputs ("
+                "output_file_name TEXT PRIMARY KEY, "
+                "source_file_full_path TEXT, "
+                "source_fingerprint TEXT, "
+                "converter_name TEXT, "
+                "command TEXT, "
+                "output_fingerprint TEXT, "
+                "recorded_at REAL)"
+            )
+            self._connection.commit()
+        return self._connection
+
+    @classmethod
+    def get_fingerprint(cls, path):
+        """returns a fingerprint of the given file or image sequence, made of
+        the file count, total size and the latest modification time. None if
+        there are no files.
+        """
+        files = MediaConverter.get_sequence_files(path)
+        if not files:
+            return None
+
+        total_size = 0
+        mtime = 0
+        for f in files:
+            stat = os.stat(f)
+            total_size += stat.st_size
+            mtime = max(mtime, stat.st_mtime_ns)
+        return "%i:%i:%i" % (len(files), total_size, mtime)
+
+    def get_record(self, job):
+        """returns the recorded row of the given jobs output"""
+        if self._connection is None and not os.path.exists(self.path):
+            # do not create a database just to query it
+            return None
+
+        with self.lock:
+            return self.connection.execute(
+                "SELECT source_file_full_path, source_fingerprint, "
+                "converter_name, command, output_fingerprint "
+                "FROM outputs WHERE output_file_name = ?",
+                (os.path.basename(job.output_file_full_path),),
+            ).fetchone()
+
+    def is_up_to_date(self, job):
+        """returns True if the output of the given job is generated from the
+        same source with the same command and is not changed since then
+        """
+        record = self.get_record(job)
+        if record is None:
+            return False
+
+        output_fingerprint = self.get_fingerprint(job.output_file_full_path)
+        return output_fingerprint is not None and record == (
+            os.path.abspath(job.source_file_full_path),
+            self.get_fingerprint(job.source_file_full_path),
+            job.converter_name,
+            job.normalized_command,
+            output_fingerprint,
+        )
+
+    def record(self, job):
+        """records the output of the given (successfully finished) job"""
+        import time
+
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    os.path.basename(job.output_file_full_path),
+                    os.path.abspath(job.source_file_full_path),
+                    self.get_fingerprint(job.source_file_full_path),
+                    job.converter_name,
+                    job.normalized_command,
+                    self.get_fingerprint(job.output_file_full_path),
+                    time.time(),
+                ),
+            )
+            self.connection.commit()
+
+    def close(self):
+        """closes the connection to the database"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class OutputCache(object):
+    """A content addressed cache of the generated outputs.
+
+    The outputs are stored under a key made of a fast hash of the source
+    content and the normalized command, so the same file converted with the
+    same template and extra options in another folder or in another run is
+    hard linked (or copied) from the cache instead of being converted again.
+    The least recently used entries are evicted when the cache grows over
+    its maximum size.
+    """
+
+    index_file_name = "index.sqlite"
+
+    # the source is hashed by sampling this many chunks of this size
+    chunk_size = 1024 * 1024
+    chunk_count = 8
+
+    size_units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+    def __init__(self, path, max_size=None):
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+        self._connection = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def parse_size(cls, size):
+        """parses sizes like 500M or 50G in to bytes"""
+        size = str(size).strip().upper().rstrip("B")
+        if size and size[-1] in cls.size_units:
+            return int(float(size[:-1]) * cls.size_units[size[-1]])
+        return int(size)
+
+    @property
+    def connection(self):
+        """the connection to the index, creates the cache folder if needed"""
+        if self._connection is None:
+            import sqlite3
+
+            try:
+                os.makedirs(os.path.join(self.path, "objects"))
+            except OSError:
+                # path already exists
+                pass
+
+            self._connection = sqlite3.connect(
+                os.path.join(self.path, self.index_file_name),
+                timeout=60,
+                check_same_thread=False,
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, file_name TEXT, size INTEGER, "
+                "last_access REAL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS stats ("
+                "name TEXT PRIMARY KEY, value INTEGER)"
+            )
+            self._connection.commit()
+        return self._connection
+
+    @classmethod
+    def hash_file(cls, path):
+        """returns a fast hash of the file content.
+
+        Small files are hashed completely, larger files are hashed by
+        sampling evenly distributed chunks together with the file size.
+        """
+        import hashlib
+
+        size = os.path.getsize(path)
+        hash_ = hashlib.sha256(str(size).encode())
+        with open(path, "rb") as f:
+            if size <= cls.chunk_size * cls.chunk_count:
+                hash_.update(f.read())
+            else:
+                step = (size - cls.chunk_size) // (cls.chunk_count - 1)
+                for i in range(cls.chunk_count):
+                    f.seek(i * step)
+                    hash_.update(f.read(cls.chunk_size))
+        return hash_.hexdigest()
+
+    @classmethod
+    def is_cacheable(cls, job):
+        """returns True if the job converts one file in to one file, image
+        sequences are not cached
+        """
+        import re
+
+        return (
+            re.search(r"%[0-9]*d", job.source_file_full_path) is None
+            and re.search(r"%[0-9]*d", job.output_file_full_path) is None
+            and os.path.isfile(job.source_file_full_path)
+        )
+
+    def get_key(self, job):
+        """returns the cache key of the given job"""
+        import hashlib
+
+        output_file_extension = os.path.splitext(job.output_file_full_path)[-1]
+        return hashlib.sha256(
+            "\0".join(
+                [
+                    self.hash_file(job.source_file_full_path),
+                    job.normalized_command,
+                    output_file_extension.lower(),
+                ]
+            ).encode()
+        ).hexdigest()
+
+    @classmethod
+    def link_or_copy(cls, source, target):
+        """hard links the source to the target, copies it if linking is not
+        possible, i.e. between different file systems
+        """
+        try:
+            os.link(source, target)
+        except OSError:
+            import shutil
+
+            shutil.copy2(source, target)
+
+    def increment_stat(self, name, value=1):
+        """increments the given statistic, the lock should be acquired"""
+        self.connection.execute(
+            "INSERT OR IGNORE INTO stats VALUES (?, 0)", (name,)
+        )
+        self.connection.execute(
+            "UPDATE stats SET value = value + ? WHERE name = ?", (value, name)
+        )
+
+    def fetch(self, job):
+        """places the cached output of the given job to its output path
+
+        :return: True if it is a cache hit, False otherwise
+        """
+        import time
+
+        if not self.is_cacheable(job):
+            return False
+
+        key = self.get_key(job)
+        job.cache_key = key
+        with self.lock:
+            entry = self.connection.execute(
+                "SELECT file_name, size FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            cached_file_full_path = None
+            if entry is not None:
+                cached_file_full_path = os.path.join(self.path, "objects", entry[0])
+                if not os.path.exists(cached_file_full_path):
+                    # removed from the outside
+                    self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    entry = None
+
+            if entry is None:
+                self.increment_stat("misses")
+                self.connection.commit()
+                return False
+
+            self.link_or_copy(cached_file_full_path, job.output_file_full_path)
+            self.connection.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self.increment_stat("hits")
+            self.increment_stat("bytes_saved", entry[1])
+            self.connection.commit()
+        return True
+
+    def store(self, job):
+        """stores the output of the given (successfully finished) job"""
+        import time
+
+        if not self.is_cacheable(job) or not os.path.isfile(job.output_file_full_path):
+            return
+
+        key = job.cache_key or self.get_key(job)
+        file_name = "%s%s" % (key, os.path.splitext(job.output_file_full_path)[-1])
+        cached_file_full_path = os.path.join(self.path, "objects", file_name)
+        with self.lock:
+            # make sure the folder is created
+            connection = self.connection
+            if not os.path.exists(cached_file_full_path):
+                self.link_or_copy(job.output_file_full_path, cached_file_full_path)
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (
+                    key,
+                    file_name,
+                    os.path.getsize(cached_file_full_path),
+                    time.time(),
+                ),
+            )
+            connection.commit()
+            self.evict()
+
+    def evict(self):
+        """removes the least recently used entries until the cache fits in to
+        its maximum size, the lock should be acquired
+        """
+        if not self.max_size:
+            return
+
+        total_size = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+        entries = self.connection.execute(
+            "SELECT key, file_name, size FROM entries ORDER BY last_access"
+        ).fetchall()
+        for key, file_name, size in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, "objects", file_name))
+            except OSError:
+                pass
+            self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total_size -= size
+        self.connection.commit()
+
+    def get_stats(self):
+        """returns the statistics of the cache as a dictionary"""
+        with self.lock:
+            stats = dict(self.connection.execute("SELECT name, value FROM stats"))
+            entry_count, total_size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        hits = stats.get("hits", 0)
+        misses = stats.get("misses", 0)
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": float(hits) / (hits + misses) if hits + misses else 0.0,
+            "bytes_saved": stats.get("bytes_saved", 0),
+            "entries": entry_count,
+            "size": total_size,
+        }
+
+    def print_stats(self):
+        """prints the statistics of the cache"""
+        op = OutputPrinter()
+        stats = self.get_stats()
+        op.info("cache: %s" % self.path)
+        op.info("entries: %(entries)i (%(size)i bytes)" % stats)
+        op.info(
+            "hits: %(hits)i, misses: %(misses)i, hit rate: %(hit_rate).1f%%"
+            % dict(stats, hit_rate=stats["hit_rate"] * 100)
+        )
+        op.ok("bytes saved: %(bytes_saved)i" % stats)
+
+    def close(self):
+        """closes the connection to the index"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class CoreBudget(object):
+    """Splits a global core budget between the concurrently running jobs.
+
+    Every ffmpeg process uses all the cores by default, so running several of
+    them at once oversubscribes the CPU. The budget hands each job a thread
+    count when it is launched, depending on the codec family of the job and
+    the cores that are still free. When the queue drains, the cores freed by
+    the finished jobs go to the jobs that are launched last.
+    """
+
+    # the minimum and maximum number of threads each codec family can use
+    codec_families = {
+        "audio": (1, 1),
+        "copy": (1, 1),
+        "image": (1, 4),
+        "prores": (2, 32),
+        "x264": (2, 16),
+    }
+
+    def __init__(self, cores=None, slots=1):
+        self.cores = cores or os.cpu_count() or 1
+        self.slots = max(1, slots)
+        self.allocated = 0
+        self.running = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_codec_family(cls, job):
+        """returns the codec family of the given job"""
+        command = job.command.replace("{extra_options}", job.extra_options or "")
+        output_file_extension = os.path.splitext(job.output_file_full_path)[-1]
+        if (
+            "-vcodec copy" in command
+            or "-c:v copy" in command
+            or "-c copy" in command
+        ):
+            return "copy"
+        if "prores" in command:
+            return "prores"
+        if output_file_extension.lower() in AUDIO_FORMATS:
+            return "audio"
+        if output_file_extension.lower() in IMAGE_FORMATS + [".gif"]:
+            return "image"
+        return "x264"
+
+    def acquire(self, job, waiting):
+        """returns the thread count for the given job, which is about to be
+        launched.
+
+        :param Job job: The job to be launched.
+        :param int waiting: The number of jobs that are not launched yet,
+          including this one.
+        """
+        min_threads, max_threads = self.codec_families[self.get_codec_family(job)]
+        with self.lock:
+            free_cores = self.cores - self.allocated
+            # share the free cores with the jobs that will be launched in to
+            # the free slots
+            free_slots = max(1, min(self.slots - self.running, waiting))
+            threads = max(min_threads, min(max_threads, free_cores // free_slots))
+            self.allocated += threads
+            self.running += 1
+        return threads
+
+    def release(self, threads):
+        """gives the threads of a finished job back to the budget"""
+        with self.lock:
+            self.allocated -= threads
+            self.running -= 1
+
+
+class SchedulingPolicy(object):
+    """Pins the jobs to CPUs and sets their nice and ionice values by the
+    category of their template.
+
+    With ``affinity`` every job gets its own set of CPUs, as many as its
+    thread count from the :class:`CoreBudget`, picked from the least used
+    CPUs. With ``numa`` the set of a job is kept on a single NUMA node. With
+    ``priorities`` the jobs are run with the nice and ionice values of their
+    category, so audio jobs are not starved by the mastering encodes and the
+    interactive users of the machine stay responsive.
+
+    The values are applied to the process and its threads right after it is
+    launched, not in the child before it executes ffmpeg, as ``preexec_fn`` is
+    not safe with the worker threads of the :class:`JobPool`.
+    """
+
+    # nice, ionice class and ionice level of each category
+    priorities = {
+        "audio": (0, 2, 2),
+        "proxy": (5, 2, 4),
+        "mastering": (10, 2, 7),
+    }
+
+    ionice_classes = {1: "realtime", 2: "best-effort", 3: "idle"}
+
+    # the ioprio_set system call numbers
+    ioprio_set_calls = {
+        "x86_64": 251,
+        "i386": 289,
+        "i686": 289,
+        "aarch64": 30,
+        "armv7l": 314,
+        "ppc64le": 273,
+    }
+    _ioprio_set = None
+
+    def __init__(self, affinity=False, numa=False, priorities=False, cpus=None):
+        self.affinity = affinity or numa or cpus is not None
+        self.numa = numa
+        self.use_priorities = priorities
+        if cpus is None:
+            try:
+                cpus = os.sched_getaffinity(0)
+            except AttributeError:
+                cpus = range(os.cpu_count() or 1)
+        self.cpus = sorted(cpus)
+        self.nodes = [self.cpus]
+        if numa:
+            self.nodes = self.get_numa_nodes(self.cpus)
+        # the number of running jobs pinned to each CPU
+        self.load = dict((cpu, 0) for cpu in self.cpus)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def parse_cpu_list(cls, cpu_list):
+        """parses a CPU list like ``0-3,8,10-11`` in to a list of CPUs"""
+        cpus = []
+        for part in cpu_list.strip().split(","):
+            if not part:
+                continue
+            start, _, end = part.partition("-")
+            cpus += range(int(start), int(end or start) + 1)
+        return cpus
+
+    @classmethod
+    def format_cpu_list(cls, cpus):
+        """formats the given CPUs like ``0-3,8``"""
+        ranges = []
+        for cpu in sorted(cpus):
+            if ranges and ranges[-1][1] == cpu - 1:
+                ranges[-1][1] = cpu
+            else:
+                ranges.append([cpu, cpu])
+        return ",".join(
+            "%i" % start if start == end else "%i-%i" % (start, end)
+            for start, end in ranges
+        )
+
+    @classmethod
+    def get_numa_nodes(cls, cpus):
+        """returns the given CPUs grouped by their NUMA node"""
+        import glob
+
+        nodes = []
+        for path in sorted(glob.glob("/sys/devices/system/node/node*/cpulist")):
+            with open(path) as f:
+                node = [cpu for cpu in cls.parse_cpu_list(f.read()) if cpu in cpus]
+            if node:
+                nodes.append(node)
+        return nodes or [list(cpus)]
+
+    @classmethod
+    def get_category(cls, job):
+        """returns the scheduling category of the given job"""
+        codec_family = CoreBudget.get_codec_family(job)
+        if codec_family == "audio":
+            return "audio"
+        if codec_family == "prores" and "proxy" not in (job.converter_name or ""):
+            return "mastering"
+        return "proxy"
+
+    def pick_cpus(self, count):
+        """returns the given number of least used CPUs, the lock should be
+        acquired
+        """
+        # the node with the least used CPUs
+        node = min(
+            self.nodes,
+            key=lambda node: sum(self.load[cpu] for cpu in node) / float(len(node)),
+        )
+        return sorted(sorted(node, key=lambda cpu: self.load[cpu])[:count])
+
+    def acquire(self, job):
+        """sets the CPUs, nice and ionice values of the given job, which is
+        about to be launched
+        """
+        category = self.get_category(job)
+        description = [category]
+        if self.affinity:
+            with self.lock:
+                if job.threads:
+                    job.cpus = self.pick_cpus(job.threads)
+                else:
+                    job.cpus = self.pick_cpus(len(self.cpus))
+                for cpu in job.cpus:
+                    self.load[cpu] += 1
+        if self.use_priorities:
+            job.nice, ionice_class, ionice_level = self.priorities[category]
+            job.ionice = (ionice_class, ionice_level)
+            description.append(
+                "nice %i, ionice %s %i"
+                % (job.nice, self.ionice_classes[ionice_class], ionice_level)
+            )
+        job.scheduling = ": ".join(description)
+
+    def release(self, job):
+        """gives the CPUs of a finished job back"""
+        if job.cpus:
+            with self.lock:
+                for cpu in job.cpus:
+                    self.load[cpu] -= 1
+
+    @classmethod
+    def get_ioprio_set(cls):
+        """returns a function calling the ioprio_set system call, None if it
+        is not available
+        """
+        if cls._ioprio_set is None:
+            import ctypes
+            import ctypes.util
+            import platform
+
+            number = cls.ioprio_set_calls.get(platform.machine())
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            except OSError:
+                number = None
+            if number is None:
+                cls._ioprio_set = False
+            else:
+                # IOPRIO_WHO_PROCESS of the given process
+                cls._ioprio_set = lambda pid, priority: libc.syscall(
+                    number, 1, pid, priority
+                )
+        return cls._ioprio_set or None
+
+    @classmethod
+    def apply(cls, job, pid):
+        """applies the CPUs, nice and ionice values of the given job to the
+        launched process with the given pid, failures do not stop the job
+        """
+        if not job.cpus and job.nice is None and job.ionice is None:
+            return
+
+        nice = None
+        if job.nice:
+            # relative to this process, like the nice command
+            nice = os.getpriority(os.PRIO_PROCESS, 0) + job.nice
+        ioprio_set = None
+        priority = None
+        if job.ionice is not None:
+            ioprio_set = cls.get_ioprio_set()
+            ionice_class, ionice_level = job.ionice
+            priority = ionice_class << 13 | ionice_level
+
+        # the values are per thread, the main thread is set first so the
+        # threads it starts from now on inherit them, then the threads which
+        # are already started
+        tids = [pid]
+        try:
+            tids += sorted(
+                int(tid) for tid in os.listdir("/proc/%i/task" % pid) if int(tid) != pid
+            )
+        except OSError:
+            pass
+        for tid in tids:
+            try:
+                if job.cpus:
+                    os.sched_setaffinity(tid, job.cpus)
+                if nice is not None:
+                    os.setpriority(os.PRIO_PROCESS, tid, nice)
+            except (OSError, AttributeError):
+                pass
+            if ioprio_set is not None:
+                ioprio_set(tid, priority)
+
+
+class ProgressTracker(object):
+    """Tracks the progress of the jobs of a batch from the ``-progress``
+    output of ffmpeg.
+
+    Shows the progress, speed and ETA of the running jobs and the whole
+    batch on a status line, and writes the same numbers as JSON lines, i.e.
+    for dashboards. The ETAs are computed from the probed durations of the
+    sources.
+    """
+
+    def __init__(self, show=True, json_path=None, interval=0.5):
+        self.show = show
+        self.json_path = json_path
+        self.interval = interval
+        self.jobs = []
+        # in seconds, None if not known
+        self.durations = {}
+        # the last progress data of the running jobs
+        self.running = {}
+        self.finished = set()
+        self.start_time = None
+        self.lock = threading.Lock()
+        self._last_display_time = 0
+        self._json_file = None
+
+    @classmethod
+    def get_duration(cls, job):
+        """returns the duration of the source of the given job in seconds,
+        None if it can not be found
+        """
+        sequence = MediaConverter.get_sequence(job.source_file_full_path)
+        if sequence is not None:
+            from fractions import Fraction
+
+            # 25 is the default frame rate of the image2 demuxer
+            framerate = "25"
+            try:
+                for flag, value in job.get_ffmpeg_command().input_options:
+                    if flag in ["-framerate", "-r"]:
+                        framerate = value
+                return sequence.count / float(Fraction(framerate))
+            except (ValueError, ZeroDivisionError):
+                return None
+
+        info = MediaProbe.probe(job.source_file_full_path)
+        try:
+            return float(info["format"]["duration"])
+        except (TypeError, KeyError, ValueError):
+            return None
+
+    def prepare(self, jobs):
+        """adds the pending ones of the given jobs to the batch and probes
+        their durations in parallel, the jobs can be added in several calls,
+        like the jobs of a watched folder
+        """
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        jobs = [
+            job for job in jobs if job.status == Job.PENDING and job not in self.jobs
+        ]
+        for job in jobs:
+            job.progress = self
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            durations = list(executor.map(self.get_duration, jobs))
+        with self.lock:
+            self.jobs += jobs
+            self.durations.update(zip(jobs, durations))
+        if self.start_time is None:
+            self.start_time = time.time()
+
+        if self.json_path and self._json_file is None:
+            if self.json_path == "-":
+                self._json_file = sys.stdout
+            else:
+                self._json_file = open(self.json_path, "a")
+
+    @classmethod
+    def parse_time(cls, data):
+        """returns the out_time of the given progress data in seconds"""
+        try:
+            return int(data.get("out_time_us", "")) / 1000000.0
+        except ValueError:
+            return None
+
+    @classmethod
+    def parse_speed(cls, data):
+        """returns the speed of the given progress data as a float"""
+        try:
+            return float(data.get("speed", "").rstrip("x"))
+        except ValueError:
+            return None
+
+    @classmethod
+    def format_time(cls, seconds):
+        """formats the given seconds as HH:MM:SS"""
+        if seconds is None:
+            return "--:--:--"
+        seconds = int(seconds)
+        return "%02i:%02i:%02i" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+    def get_job_progress(self, job):
+        """returns the percent and ETA in seconds of the given running job"""
+        data = self.running.get(job) or {}
+        duration = self.durations.get(job)
+        out_time = self.parse_time(data)
+        speed = self.parse_speed(data)
+        if not duration or out_time is None:
+            return None, None
+        percent = min(100.0, 100.0 * out_time / duration)
+        eta = None
+        if speed:
+            eta = max(0.0, duration - out_time) / speed
+        return percent, eta
+
+    def get_batch_progress(self):
+        """returns the percent and ETA in seconds of the whole batch"""
+        import time
+
+        total = sum(d for d in self.durations.values() if d)
+        if not total:
+            return None, None
+
+        processed = 0.0
+        for job in self.jobs:
+            duration = self.durations.get(job) or 0
+            if job in self.finished:
+                processed += duration
+            elif job in self.running:
+                out_time = self.parse_time(self.running[job]) or 0
+                processed += min(duration, out_time)
+
+        percent = 100.0 * processed / total
+        eta = None
+        elapsed = time.time() - self.start_time
+        if processed and elapsed:
+            # media seconds converted per second
+            rate = processed / elapsed
+            eta = (total - processed) / rate
+        return percent, eta
+
+    def write_json(self, record):
+        """writes the given record as a JSON line"""
+        import json
+        import time
+
+        if self._json_file is None:
+            return
+        record = dict(record, time=time.time())
+        with OutputPrinter.lock:
+            self._json_file.write(json.dumps(record) + "\n")
+            self._json_file.flush()
+
+    def get_job_record(self, job, event):
+        """returns the JSON record of the given job"""
+        return {
+            "event": event,
+            "job": self.jobs.index(job) if job in self.jobs else None,
+            "template": job.converter_name,
+            "source": job.source_file_full_path,
+            "output": job.output_file_full_path,
+            "duration": self.durations.get(job),
+        }
+
+    def start_job(self, job):
+        """starts tracking the given job"""
+        with self.lock:
+            self.running[job] = {}
+        self.write_json(self.get_job_record(job, "start"))
+
+    def update(self, job, data):
+        """updates the progress of the given job with the parsed key=value
+        block of ffmpeg
+        """
+        import time
+
+        with self.lock:
+            self.running[job] = data
+            percent, eta = self.get_job_progress(job)
+            batch_percent, batch_eta = self.get_batch_progress()
+
+        record = self.get_job_record(job, "progress")
+        record.update(
+            {
+                "frame": data.get("frame"),
+                "fps": data.get("fps"),
+                "bitrate": data.get("bitrate"),
+                "speed": data.get("speed"),
+                "out_time": data.get("out_time"),
+                "percent": percent,
+                "eta": eta,
+                "batch_percent": batch_percent,
+                "batch_eta": batch_eta,
+            }
+        )
+        self.write_json(record)
+
+        now = time.time()
+        if now - self._last_display_time >= self.interval:
+            self._last_display_time = now
+            self.display()
+
+    def end_job(self, job, return_code):
+        """stops tracking the given job"""
+        with self.lock:
+            self.running.pop(job, None)
+            self.finished.add(job)
+        record = self.get_job_record(job, "end")
+        record["return_code"] = return_code
+        self.write_json(record)
+        self.display()
+
+    def display(self):
+        """shows the progress of the batch and the running jobs on the status
+        line
+        """
+        if not self.show:
+            return
+
+        with self.lock:
+            batch_percent, batch_eta = self.get_batch_progress()
+            parts = [
+                "[%i/%i]" % (len(self.finished), len(self.jobs)),
+                "%s ETA %s"
+                % (
+                    "--.-%" if batch_percent is None else "%.1f%%" % batch_percent,
+                    self.format_time(batch_eta),
+                ),
+            ]
+            for job, data in self.running.items():
+                percent, eta = self.get_job_progress(job)
+                parts.append(
+                    "| %s %s fps=%s %s ETA %s"
+                    % (
+                        os.path.basename(job.source_file_full_path),
+                        "--.-%" if percent is None else "%.1f%%" % percent,
+                        data.get("fps", "-"),
+                        data.get("speed", "-"),
+                        self.format_time(eta),
+                    )
+                )
+
+        import shutil
+
+        width = shutil.get_terminal_size().columns
+        OutputPrinter.status(" ".join(parts)[: width - 1])
+
+    def close(self):
+        """clears the status line and closes the JSON file"""
+        with OutputPrinter.lock:
+            OutputPrinter.clear_status()
+        if self._json_file is not None and self._json_file is not sys.stdout:
+            self._json_file.close()
+        self._json_file = None
+
+
+class BatchPlanner(object):
+    """Estimates the cost of the jobs and orders them longest first.
+
+    The sources are probed for their duration and resolution, which gives
+    the work of each job in megapixel seconds (or seconds for audio). The
+    time a template takes for a unit of work is learned from the earlier
+    runs and kept in a SQLite database in the user cache. Starting the
+    longest jobs first keeps a long file from running alone at the end of
+    the batch.
+    """
+
+    # the weight of the latest run in the learned speed of a template
+    smoothing = 0.3
+    # the seconds a unit of work takes with a template that has no history
+    default_speed = 0.05
+    # the frame rate of the image2 demuxer
+    default_framerate = 25
+
+    def __init__(self, path=None):
+        self.path = path or get_user_cache_path("history.sqlite")
+        self._connection = None
+        self.lock = threading.Lock()
+        # the estimates of the jobs, by job
+        self.estimates = {}
+
+    @property
+    def connection(self):
+        """the connection to the database, creates the database if needed"""
+        if self._connection is None:
+            import sqlite3
+
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError:
+                # path already exists
+                pass
+
+            self._connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS speeds ("
+                "converter_name TEXT PRIMARY KEY, "
+                "seconds_per_unit REAL, "
+                "runs INTEGER)"
+            )
+            self._connection.commit()
+        return self._connection
+
+    @classmethod
+    def get_work(cls, job):
+        """probes the source of the given job
+
+        :return: A dictionary with the duration, width, height and the units
+          of work of the source.
+        """
+        from fractions import Fraction
+
+        source = job.source_file_full_path
+        sequence = MediaConverter.get_sequence(source)
+        duration = None
+        if sequence is not None:
+            framerate = Fraction(cls.default_framerate)
+            try:
+                for flag, value in job.get_ffmpeg_command().input_options:
+                    if flag in ["-framerate", "-r"]:
+                        framerate = Fraction(value)
+            except ValueError:
+                pass
+            duration = float(sequence.count / framerate)
+            # the resolution of the first frame
+            source = os.path.join(
+                os.path.dirname(source), next(sequence.file_names())
+            )
+
+        info = MediaProbe.probe(source)
+        if duration is None:
+            try:
+                duration = float(info["format"]["duration"])
+            except (TypeError, KeyError, ValueError):
+                duration = None
+        width = height = None
+        video_streams = MediaProbe.get_streams(info, "video")
+        if video_streams:
+            width = video_streams[0].get("width")
+            height = video_streams[0].get("height")
+
+        if duration is None and width:
+            # a single image
+            duration = 1.0 / cls.default_framerate
+        if duration is None:
+            # can not be probed, assume a second for every megabyte
+            try:
+                duration = os.path.getsize(source) / 1e6
+            except OSError:
+                duration = 0.0
+
+        units = duration
+        if width and height:
+            units *= width * height / 1e6
+        return {
+            "duration": duration,
+            "width": width,
+            "height": height,
+            "units": units,
+        }
+
+    def get_speed(self, converter_name):
+        """returns the learned seconds per unit of work of the given
+        template, None if it has no history
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT seconds_per_unit FROM speeds WHERE converter_name = ?",
+                (converter_name,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def estimate(self, jobs):
+        """probes the pending jobs in parallel and estimates their cost in
+        seconds
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        pending = [job for job in jobs if job.status == Job.PENDING]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            works = list(executor.map(self.get_work, pending))
+
+        speeds = {}
+        for job, work in zip(pending, works):
+            if job.converter_name not in speeds:
+                speeds[job.converter_name] = self.get_speed(job.converter_name)
+            speed = speeds[job.converter_name]
+            work["learned"] = speed is not None
+            work["cost"] = work["units"] * (
+                self.default_speed if speed is None else speed
+            )
+            self.estimates[job] = work
+        return self.estimates
+
+    def order(self, jobs):
+        """returns the pending jobs ordered by their estimated cost, the most
+        costly first
+        """
+        if any(job not in self.estimates for job in jobs):
+            self.estimate(jobs)
+        pending = [job for job in jobs if job.status == Job.PENDING]
+        return sorted(
+            pending, key=lambda job: self.estimates[job]["cost"], reverse=True
+        )
+
+    @classmethod
+    def get_total_time(cls, costs, slots=1):
+        """returns the time it takes to run jobs of the given costs in the
+        given order on the given number of slots, each job starts on the slot
+        that is freed first
+        """
+        import heapq
+
+        finish_times = [0.0] * max(1, slots)
+        for cost in costs:
+            heapq.heapreplace(finish_times, finish_times[0] + cost)
+        return max(finish_times)
+
+    def print_plan(self, jobs, slots=1):
+        """prints the order of the jobs and the estimated total time"""
+        op = OutputPrinter()
+        ordered = self.order(jobs)
+        for i, job in enumerate(ordered):
+            work = self.estimates[job]
+            resolution = ""
+            if work["width"] and work["height"]:
+                resolution = " %ix%i" % (work["width"], work["height"])
+            op.info(
+                "%i. %s ~%s (%s%s, %s): %s"
+                % (
+                    i + 1,
+                    job.converter_name,
+                    ProgressTracker.format_time(work["cost"]),
+                    ProgressTracker.format_time(work["duration"]),
+                    resolution,
+                    "learned" if work["learned"] else "no history",
+                    job.source_file_full_path,
+                )
+            )
+        costs = [self.estimates[job]["cost"] for job in ordered]
+        in_order = [
+            self.estimates[job]["cost"] for job in jobs if job in self.estimates
+        ]
+        op.ok(
+            "estimated total time with %i jobs: %s (%s in the listing order)"
+            % (
+                slots,
+                ProgressTracker.format_time(self.get_total_time(costs, slots)),
+                ProgressTracker.format_time(self.get_total_time(in_order, slots)),
+            )
+        )
+
+    def record(self, jobs):
+        """learns the speed of the templates from the finished jobs"""
+        with self.lock:
+            connection = self.connection
+            for job in jobs:
+                work = self.estimates.get(job)
+                if job.status != Job.DONE or not work or not work["units"]:
+                    continue
+                if job.elapsed is None or job.cache_hit or job.runner is not None:
+                    # cache hits and chunked jobs do not tell the speed
+                    continue
+                speed = job.elapsed / work["units"]
+                row = connection.execute(
+                    "SELECT seconds_per_unit, runs FROM speeds "
+                    "WHERE converter_name = ?",
+                    (job.converter_name,),
+                ).fetchone()
+                runs = 1
+                if row is not None:
+                    speed = row[0] + self.smoothing * (speed - row[0])
+                    runs = row[1] + 1
+                connection.execute(
+                    "INSERT OR REPLACE INTO speeds VALUES (?, ?, ?)",
+                    (job.converter_name, speed, runs),
+                )
+            connection.commit()
+
+    def close(self):
+        """closes the connection"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class JobPool(object):
+    """Runs jobs on a bounded pool of worker threads.
+
+    Each job runs its own process, so threads are enough to keep the cores
+    busy. If a core budget is given, every job is launched with its own share
+    of the cores.
+    """
+
+    def __init__(self, jobs=1, cores=None, scheduling=None):
+        self.jobs = max(1, jobs or 1)
+        self.budget = None
+        # the SchedulingPolicy of the jobs
+        self.scheduling = scheduling
+        if cores is None and scheduling is not None and scheduling.affinity:
+            # only share the CPUs the jobs are pinned to
+            cores = len(scheduling.cpus)
+        if cores or self.jobs > 1:
+            self.budget = CoreBudget(cores=cores, slots=self.jobs)
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def run_job(self, job):
+        """runs one job with its share of the core budget and its scheduling
+        policy
+
+        :return: The job.
+        """
+        if self.budget is not None:
+            with self._lock:
+                waiting = self._waiting
+                self._waiting -= 1
+            job.threads = self.budget.acquire(job, waiting)
+        if self.scheduling is not None:
+            self.scheduling.acquire(job)
+        try:
+            job.run()
+            return job
+        finally:
+            if self.scheduling is not None:
+                self.scheduling.release(job)
+            if self.budget is not None:
+                self.budget.release(job.threads)
+
+    def run(self, jobs):
+        """runs the pending jobs and returns all of them"""
+        pending = [job for job in jobs if job.status == Job.PENDING]
+        self._waiting = len(pending)
+
+        executor = None
+        try:
+            if self.jobs == 1 or len(pending) < 2:
+                for job in pending:
+                    self.run_job(job)
+            else:
+                from concurrent.futures import ThreadPoolExecutor
+
+                executor = ThreadPoolExecutor(max_workers=self.jobs)
+                # consume the results, so any exception is raised here
+                list(executor.map(self.run_job, pending))
+        except KeyboardInterrupt:
+            # kill the running processes, the queued jobs are not started
+            ProcessWatchdog.cancel()
+            raise
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        return jobs
+
+    def start(self):
+        """starts the workers to run the jobs submitted one by one"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+    def submit(self, job):
+        """queues the given job to one of the workers started with
+        :meth:`start`
+
+        :return: A ``concurrent.futures.Future`` of the job.
+        """
+        with self._lock:
+            self._waiting += 1
+        return self._executor.submit(self.run_job, job)
+
+    def shutdown(self, wait=True):
+        """stops the workers started with :meth:`start`"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    @classmethod
+    def print_summary(cls, jobs):
+        """prints how many jobs are succeeded, failed or skipped"""
+        op = OutputPrinter()
+        done = [job for job in jobs if job.status == Job.DONE]
+        failed = [job for job in jobs if job.status == Job.FAILED]
+        skipped = [job for job in jobs if job.status == Job.SKIPPED]
+
+        op.info(
+            "summary: %i done, %i failed, %i skipped"
+            % (len(done), len(failed), len(skipped))
+        )
+        for job in failed:
+            op.fail(
+                "exit code %s: %s" % (job.return_code, job.source_file_full_path)
+            )
+
+        # the scheduling policies the jobs are run with
+        policies = {}
+        for job in jobs:
+            if job.scheduling:
+                policies.setdefault(job.scheduling, []).append(job)
+        for scheduling, policy_jobs in sorted(policies.items()):
+            cpu_sets = []
+            for job in policy_jobs:
+                if job.cpus:
+                    cpu_set = SchedulingPolicy.format_cpu_list(job.cpus)
+                    if cpu_set not in cpu_sets:
+                        cpu_sets.append(cpu_set)
+            op.info(
+                "scheduling: %s, %i jobs%s"
+                % (
+                    scheduling,
+                    len(policy_jobs),
+                    " on cpus %s" % " ".join(cpu_sets) if cpu_sets else "",
+                )
+            )
+
+
+class ChunkedEncoder(object):
+    """Encodes a single long video as parallel chunks.
+
+    The video stream of the source is split in to chunks at keyframes, the
+    chunks are encoded in parallel with the template of the job and then
+    losslessly joined with the concat demuxer. The audio is encoded as a
+    single stream, so there are no gaps at the seams, and muxed in at the end.
+    """
+
+    # options kept for the final mux instead of the chunks
+    container_options = ["-movflags", "-f"]
+
+    def __init__(
+        self, chunks=None, chunk_duration=None, jobs=1, cores=None, scheduling=None
+    ):
+        self.chunks = chunks
+        self.chunk_duration = chunk_duration
+        self.jobs = jobs
+        self.cores = cores
+        self.scheduling = scheduling
+
+    @classmethod
+    def is_supported(cls, job):
+        """returns True if the given job can be encoded in chunks"""
+        import re
+
+        output_file_extension = os.path.splitext(job.output_file_full_path)[-1]
+        if (
+            output_file_extension.lower() not in VIDEO_FORMATS
+            or re.search(r"%[0-9]*d", job.source_file_full_path) is not None
+        ):
+            return False
+
+        try:
+            command = job.get_ffmpeg_command()
+        except ValueError:
+            return False
+        video_options = StreamCopyPlanner.stream_options["video"]
+        if command.get(*video_options["codec"]) == "copy" or command.has("-f"):
+            # already fast or a special muxer like segment
+            return False
+
+        filter_graph = command.get("-filter_complex", "-lavfi") or ""
+        # only video filter graphs can be applied to the chunks separately
+        if ":a]" in filter_graph or "a=1" in filter_graph:
+            return False
+        # and only the ones working on one frame at a time
+        filter_graphs = [filter_graph, command.get("-vf", "-filter:v")]
+        return all(FrameRangeEncoder.has_frame_filters_only(g) for g in filter_graphs)
+
+    def get_segment_time(self, job):
+        """returns the duration of the chunks in seconds, None if the source
+        can not be chunked
+        """
+        if self.chunk_duration:
+            return self.chunk_duration
+
+        info = MediaProbe.probe(job.source_file_full_path)
+        try:
+            duration = float(info["format"]["duration"])
+        except (TypeError, KeyError, ValueError):
+            return None
+
+        chunks = self.chunks or self.jobs
+        if chunks < 2:
+            return None
+        return duration / chunks
+
+    def create_chunk_command(self, job):
+        """returns the command that encodes the video of one chunk"""
+        command = job.get_ffmpeg_command()
+        audio_options = StreamCopyPlanner.stream_options["audio"]
+        command.remove(
+            *(
+                audio_options["codec"]
+                + audio_options["encoder"]
+                + audio_options["blocking"]
+                + ["-strict"]
+                + self.container_options
+            )
+        )
+        command.add("-an")
+        return command
+
+    def create_audio_command(self, job):
+        """returns the command that encodes the whole audio of the source"""
+        command = job.get_ffmpeg_command()
+        video_options = StreamCopyPlanner.stream_options["video"]
+        command.remove(
+            *(
+                video_options["codec"]
+                + video_options["encoder"]
+                + video_options["blocking"]
+                + self.container_options
+            )
+        )
+        command.add("-vn")
+        return command
+
+    @classmethod
+    def join(cls, job, chunk_file_full_paths, **kwargs):
+        """losslessly joins the given chunks in to the output of the given job
+        with the concat demuxer, the join is run as the job so it is killed
+        with it
+
+        :param Job job: The job encoded in chunks.
+        :param list chunk_file_full_paths: The encoded chunks in order, they
+          should be in the same folder.
+        :param str audio_file_full_path: The audio to mux in, optional.
+        :param str movflags: The -movflags of the output, optional.
+        :return: The exit code of ffmpeg.
+        """
+        audio_file_full_path = kwargs.get("audio_file_full_path")
+        movflags = kwargs.get("movflags")
+
+        concat_list_full_path = os.path.join(
+            os.path.dirname(chunk_file_full_paths[0]), "chunks.txt"
+        )
+        with open(concat_list_full_path, "w") as f:
+            for chunk_file_full_path in chunk_file_full_paths:
+                f.write("file '%s'\n" % os.path.basename(chunk_file_full_path))
+
+        arguments = [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            concat_list_full_path,
+        ]
+        if audio_file_full_path is not None:
+            arguments += ["-i", audio_file_full_path]
+        arguments += ["-map", "0:v"]
+        if audio_file_full_path is not None:
+            arguments += ["-map", "1:a"]
+        arguments += ["-c", "copy"]
+        if movflags:
+            arguments += ["-movflags", movflags]
+        arguments.append(job.output_file_full_path)
+        return job.execute(arguments)
+
+    def execute(self, job):
+        """encodes the given job in chunks
+
+        :return: The exit code, 0 if every step is succeeded.
+        """
+        import shutil
+        import tempfile
+
+        op = job.printer
+        segment_time = self.get_segment_time(job)
+        if segment_time is None:
+            op.warning("can not be chunked, encoding in one piece")
+            return job.execute()
+
+        target_path = os.path.dirname(job.output_file_full_path) or "."
+        temp_path = tempfile.mkdtemp(
+            prefix=".%s.chunks." % os.path.basename(job.output_file_full_path),
+            dir=target_path,
+        )
+        try:
+            # split the video at the keyframes, as a part of the job so it is
+            # killed with it
+            op.info("splitting in to %.2f second chunks" % segment_time)
+            split_job = job.create_part(
+                converter_name="%s (split)" % job.converter_name,
+                source_file_full_path=job.source_file_full_path,
+                output_file_full_path=os.path.join(temp_path, "chunk.%05d.mkv"),
+                printer=op,
+            )
+            return_code = split_job.execute(
+                [
+                    "ffmpeg",
+                    "-v",
+                    "error",
+                    "-i",
+                    job.source_file_full_path,
+                    "-map",
+                    "0:v:0",
+                    "-c",
+                    "copy",
+                    "-f",
+                    "segment",
+                    "-segment_time",
+                    "%f" % segment_time,
+                    "-reset_timestamps",
+                    "1",
+                    split_job.output_file_full_path,
+                ]
+            )
+            if return_code != 0:
+                job.kill_reason = split_job.kill_reason
+                return return_code
+
+            chunk_command = self.create_chunk_command(job).to_string()
+            jobs = []
+            for chunk_file_name in sorted(os.listdir(temp_path)):
+                jobs.append(
+                    job.create_part(
+                        converter_name="%s (chunk)" % job.converter_name,
+                        command=chunk_command,
+                        source_file_full_path=os.path.join(temp_path, chunk_file_name),
+                        output_file_full_path=os.path.join(
+                            temp_path, "encoded_%s" % chunk_file_name
+                        ),
+                    )
+                )
+            video_jobs = list(jobs)
+            op.info("encoding %i chunks" % len(video_jobs))
+
+            info = MediaProbe.probe(job.source_file_full_path)
+            has_audio = MediaProbe.get_streams(info, "audio")
+            audio_job = None
+            if has_audio and not job.get_ffmpeg_command().has("-an"):
+                audio_job = job.create_part(
+                    converter_name="%s (audio)" % job.converter_name,
+                    command=self.create_audio_command(job).to_string(),
+                    source_file_full_path=job.source_file_full_path,
+                    # keep the container, so the encoder delay is kept too
+                    output_file_full_path=os.path.join(
+                        temp_path,
+                        "audio%s" % os.path.splitext(job.output_file_full_path)[-1],
+                    ),
+                )
+                # the audio is the longest job, start it first
+                jobs.insert(0, audio_job)
+
+            JobPool(jobs=self.jobs, cores=self.cores, scheduling=self.scheduling).run(
+                jobs
+            )
+            return_code = job.get_parts_return_code(jobs)
+            if return_code is not None:
+                return return_code
+
+            op.info("joining %i chunks" % len(video_jobs))
+            return self.join(
+                job,
+                [video_job.output_file_full_path for video_job in video_jobs],
+                audio_file_full_path=(
+                    audio_job.output_file_full_path if audio_job else None
+                ),
+                movflags=job.get_ffmpeg_command().get("-movflags"),
+            )
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+
+class FrameRangeEncoder(object):
+    """Encodes an image sequence as parallel frame ranges.
+
+    With an intra-only codec every frame is encoded on its own, so the
+    sequence can be split in to ranges with ``-start_number`` and
+    ``-frames:v``, the ranges encoded in parallel and losslessly joined with
+    the concat demuxer. Decoding the frames, which is single threaded for
+    formats like EXR, is spread over the pool too. The joined output has the
+    same frames with the same timing as a single process would give.
+    """
+
+    # the codecs that only encode intra frames
+    intra_codecs = [
+        "prores",
+        "prores_ks",
+        "prores_aw",
+        "dnxhd",
+        "mjpeg",
+        "png",
+        "qtrle",
+        "rawvideo",
+    ]
+    # the filters that work on one frame at a time
+    frame_filters = [
+        "format",
+        "scale",
+        "crop",
+        "pad",
+        "colorspace",
+        "zscale",
+        "lut",
+        "lut3d",
+        "lutrgb",
+        "lutyuv",
+        "eq",
+        "hflip",
+        "vflip",
+        "transpose",
+        "setsar",
+        "setdar",
+        "unsharp",
+        "premultiply",
+        "unpremultiply",
+    ]
+    # options that change the number or the timing of the frames
+    timing_options = ["-r", "-vsync", "-fps_mode", "-frames:v", "-vframes", "-t"]
+    # the fewest frames worth a range of their own
+    min_frames = 50
+
+    def __init__(
+        self, ranges=None, range_duration=None, jobs=1, cores=None, scheduling=None
+    ):
+        self.ranges = ranges
+        self.range_duration = range_duration
+        self.jobs = jobs
+        self.cores = cores
+        self.scheduling = scheduling
+
+    @classmethod
+    def is_intra_only(cls, command):
+        """returns True if the given FFmpegCommand only encodes intra
+        frames
+        """
+        video_options = StreamCopyPlanner.stream_options["video"]
+        codec = command.get(*video_options["codec"])
+        return codec in cls.intra_codecs or (
+            codec is not None and command.get("-g") == "1"
+        )
+
+    @classmethod
+    def is_supported(cls, job):
+        """returns True if the given job can be encoded in frame ranges"""
+        output_file_extension = os.path.splitext(job.output_file_full_path)[-1]
+        if output_file_extension.lower() not in VIDEO_FORMATS:
+            return False
+
+        sequence = MediaConverter.get_sequence(job.source_file_full_path)
+        if sequence is None or sequence.gaps:
+            # ffmpeg stops at the first missing frame
+            return False
+
+        try:
+            command = job.get_ffmpeg_command()
+        except ValueError:
+            return False
+        if (
+            not cls.is_intra_only(command)
+            or command.has("-f", "-filter_complex", "-lavfi", *cls.timing_options)
+        ):
+            return False
+
+        return cls.has_frame_filters_only(command.get("-vf", "-filter:v"))
+
+    @classmethod
+    def has_frame_filters_only(cls, filter_graph):
+        """returns True if every filter of the given filter graph works on one
+        frame at a time, the filters keeping state between the frames, like
+        select or hqdn3d, would see the seams of the ranges
+        """
+        import re
+
+        for f in re.split(r"[,;]", filter_graph or ""):
+            # drop the link labels, like [in] and [out]
+            f = re.sub(r"\[[^\]]*\]", "", f).strip()
+            if f and f.split("=")[0].strip() not in cls.frame_filters:
+                return False
+        return True
+
+    @classmethod
+    def get_framerate(cls, command):
+        """returns the input frame rate of the given FFmpegCommand"""
+        from fractions import Fraction
+
+        framerate = Fraction(BatchPlanner.default_framerate)
+        for flag, value in command.input_options:
+            if flag in ["-framerate", "-r"]:
+                framerate = Fraction(value)
+        return framerate
+
+    def get_ranges(self, job):
+        """returns the [start_number, frames] pairs of the ranges of the
+        given job, a single range if it is not worth splitting
+        """
+        sequence = MediaConverter.get_sequence(job.source_file_full_path)
+        if self.range_duration:
+            framerate = self.get_framerate(job.get_ffmpeg_command())
+            frames = int(round(self.range_duration * framerate))
+        else:
+            frames = -(-sequence.count // max(1, self.ranges or self.jobs))
+        frames = max(frames, self.min_frames)
+        return [
+            [start, min(frames, sequence.last - start + 1)]
+            for start in range(sequence.first, sequence.last + 1, frames)
+        ]
+
+    def create_range_command(self, job, start_number, frames):
+        """returns the command that encodes the given range of frames"""
+        command = job.get_ffmpeg_command()
+        command.input_options = [
+            option for option in command.input_options if option[0] != "-start_number"
+        ]
+        command.input_options.insert(0, ["-start_number", str(start_number)])
+        command.remove(*ChunkedEncoder.container_options)
+        command.add("-frames:v", str(frames))
+        return command
+
+    def execute(self, job):
+        """encodes the given job in frame ranges
+
+        :return: The exit code, 0 if every step is succeeded.
+        """
+        import shutil
+        import tempfile
+
+        op = job.printer
+        ranges = self.get_ranges(job)
+        if len(ranges) < 2:
+            return job.execute()
+
+        target_path = os.path.dirname(job.output_file_full_path) or "."
+        temp_path = tempfile.mkdtemp(
+            prefix=".%s.ranges." % os.path.basename(job.output_file_full_path),
+            dir=target_path,
+        )
+        try:
+            output_file_extension = os.path.splitext(job.output_file_full_path)[-1]
+            jobs = []
+            for i, (start_number, frames) in enumerate(ranges):
+                jobs.append(
+                    job.create_part(
+                        converter_name="%s (frames %i-%i)"
+                        % (job.converter_name, start_number, start_number + frames - 1),
+                        command=self.create_range_command(
+                            job, start_number, frames
+                        ).to_string(),
+                        source_file_full_path=job.source_file_full_path,
+                        output_file_full_path=os.path.join(
+                            temp_path, "range_%05d%s" % (i, output_file_extension)
+                        ),
+                    )
+                )
+            op.info("encoding %i frame ranges" % len(jobs))
+            JobPool(jobs=self.jobs, cores=self.cores, scheduling=self.scheduling).run(
+                jobs
+            )
+            return_code = job.get_parts_return_code(jobs)
+            if return_code is not None:
+                return return_code
+
+            op.info("joining %i frame ranges" % len(jobs))
+            return ChunkedEncoder.join(
+                job,
+                [range_job.output_file_full_path for range_job in jobs],
+                movflags=job.get_ffmpeg_command().get("-movflags"),
+            )
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+
+class QualitySearch(object):
+    """Picks the highest CRF of a template which still meets a quality
+    target for a source.
+
+    A few short segments are sampled from the source and passed through the
+    filters of the template in to lossless references. The references are
+    encoded with the template at candidate CRF values, scored against the
+    references with the ssim or psnr filter of ffmpeg and the CRF is binary
+    searched. The chosen CRF overrides the one of the template as an extra
+    option of the job. The results are cached in a SQLite database by the
+    source, its size and modification time, the template and the target.
+    """
+
+    # the number and the duration in seconds of the sampled segments
+    samples = 3
+    sample_duration = 2.0
+    # the CRF values to search in
+    crf_range = (10, 40)
+    # the patterns of the scores in the logs of the filters
+    score_patterns = {
+        "ssim": r"SSIM .*All:([0-9.]+)",
+        "psnr": r"PSNR .*average:([0-9.]+|inf)",
+    }
+
+    def __init__(self, metric="ssim", target=0.98, path=None):
+        self.metric = metric
+        self.target = target
+        self.path = path or get_user_cache_path("quality.sqlite")
+        self._connection = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def parse_target(cls, value):
+        """parses a target like ``ssim:0.98`` or ``psnr:42``, a bare value
+        is an SSIM below 1 and a PSNR otherwise
+
+        :return: The metric and the target value.
+        """
+        metric, _, target = value.rpartition(":")
+        target = float(target)
+        if not metric:
+            metric = "ssim" if target <= 1 else "psnr"
+        if metric not in cls.score_patterns:
+            raise ValueError("unknown quality metric: %s" % metric)
+        return metric, target
+
+    @property
+    def connection(self):
+        """the connection to the database, creates the database if needed"""
+        if self._connection is None:
+            import sqlite3
+
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError:
+                # path already exists
+                pass
+
+            self._connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS searches ("
+                "key TEXT PRIMARY KEY, "
+                "crf INTEGER, "
+                "score REAL)"
+            )
+            self._connection.commit()
+        return self._connection
+
+    @classmethod
+    def is_supported(cls, job):
+        """returns True if the given job encodes a video file with a CRF"""
+        if job.runner is not None or "%" in job.source_file_full_path:
+            return False
+        try:
+            command = job.get_ffmpeg_command()
+        except ValueError:
+            return False
+        return (
+            command.has("-crf")
+            and not command.has("-filter_complex", "-lavfi")
+            and MultiOutputRunner.has_video(command)
+        )
+
+    def get_key(self, job):
+        """returns the key of the search of the given job, None if the source
+        does not exist
+        """
+        import hashlib
+        import json
+
+        try:
+            stat = os.stat(job.source_file_full_path)
+        except OSError:
+            return None
+        command = job.get_ffmpeg_command()
+        command.remove("-crf")
+        data = [
+            os.path.abspath(job.source_file_full_path),
+            stat.st_size,
+            stat.st_mtime_ns,
+            command.to_string(),
+            self.metric,
+            self.target,
+        ]
+        return hashlib.sha1(json.dumps(data).encode("utf-8")).hexdigest()
+
+    def get_positions(self, duration):
+        """returns the start times of the sampled segments"""
+        return get_sample_positions(duration, self.samples, self.sample_duration)
+
+    def create_reference_arguments(self, job, position, path):
+        """returns the arguments that pass a segment of the source through
+        the filters of the template in to a lossless reference
+        """
+        video_options = StreamCopyPlanner.stream_options["video"]
+        command = job.get_ffmpeg_command()
+        options = [
+            option
+            for option in command.output_options
+            if option[0] in video_options["blocking"]
+        ]
+        return (
+            [command.executable, "-v", "error"]
+            + ["-ss", "%f" % position, "-t", "%f" % self.sample_duration]
+            + command.get_input_arguments()[:-1]
+            + [job.source_file_full_path]
+            + [argument for option in options for argument in option if argument]
+            + ["-an", "-sn", "-dn", "-c:v", "ffv1", "-y", path]
+        )
+
+    def create_encode_arguments(self, job, reference_path, crf, path):
+        """returns the arguments that encode a reference with the template at
+        the given CRF
+        """
+        video_options = StreamCopyPlanner.stream_options["video"]
+        audio_options = StreamCopyPlanner.stream_options["audio"]
+        command = job.get_ffmpeg_command()
+        command.remove(
+            *(
+                ["-crf"]
+                + video_options["blocking"]
+                + audio_options["codec"]
+                + audio_options["encoder"]
+                + audio_options["blocking"]
+                + ChunkedEncoder.container_options
+                + ["-map", "-strict"]
+            )
+        )
+        return (
+            [command.executable, "-v", "error", "-i", reference_path]
+            + command.get_output_arguments()[:-1]
+            + ["-crf", "%i" % crf, "-an", "-y", path]
+        )
+
+    def score(self, encoded_path, reference_path):
+        """returns the score of the encoded segment against its reference,
+        None if it can not be scored
+        """
+        import re
+        import subprocess
+
+        process = subprocess.run(
+            [
+                "ffmpeg",
+                "-hide_banner",
+                "-i",
+                encoded_path,
+                "-i",
+                reference_path,
+                "-lavfi",
+                "[0:v][1:v]%s" % self.metric,
+                "-f",
+                "null",
+                "-",
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            errors="replace",
+        )
+        match = re.search(self.score_patterns[self.metric], process.stderr)
+        if process.returncode != 0 or match is None:
+            return None
+        return float(match.group(1))
+
+    def search(self, job):
+        """samples the source of the given job and searches the highest CRF
+        meeting the target
+
+        :return: The CRF and its score, the score is None if the source can
+          not be sampled or encoded.
+        """
+        import shutil
+        import subprocess
+        import tempfile
+
+        info = MediaProbe.probe(job.source_file_full_path)
+        try:
+            duration = float(info["format"]["duration"])
+        except (TypeError, KeyError, ValueError):
+            duration = None
+
+        output_file_extension = os.path.splitext(job.output_file_full_path)[-1]
+        temp_path = tempfile.mkdtemp(prefix="media_converter_quality_")
+        try:
+            references = []
+            for i, position in enumerate(self.get_positions(duration)):
+                reference_path = os.path.join(temp_path, "reference_%i.mkv" % i)
+                return_code = subprocess.call(
+                    self.create_reference_arguments(job, position, reference_path),
+                    stdin=subprocess.DEVNULL,
+                )
+                if return_code != 0:
+                    return self.crf_range[0], None
+                references.append(reference_path)
+
+            def get_score(crf):
+                """returns the worst score of the samples at the given CRF"""
+                scores = []
+                for i, reference_path in enumerate(references):
+                    encoded_path = os.path.join(
+                        temp_path, "sample_%i_crf%i%s" % (i, crf, output_file_extension)
+                    )
+                    return_code = subprocess.call(
+                        self.create_encode_arguments(
+                            job, reference_path, crf, encoded_path
+                        ),
+                        stdin=subprocess.DEVNULL,
+                    )
+                    score = None
+                    if return_code == 0:
+                        score = self.score(encoded_path, reference_path)
+                    if score is None:
+                        return None
+                    scores.append(score)
+                return min(scores)
+
+            # the quality only goes down with a higher CRF
+            low, high = self.crf_range
+            best = best_score = None
+            scores = {}
+            while low <= high:
+                crf = (low + high) // 2
+                score = scores[crf] = get_score(crf)
+                if score is None:
+                    return self.crf_range[0], None
+                job.printer.info("crf %i: %s %.4f" % (crf, self.metric, score))
+                if score >= self.target:
+                    best, best_score = crf, score
+                    low = crf + 1
+                else:
+                    high = crf - 1
+            if best is None:
+                # the best quality there is, it is searched down to it
+                best = self.crf_range[0]
+                best_score = scores.get(best)
+                if best_score is None:
+                    best_score = get_score(best)
+                    if best_score is None:
+                        return best, None
+                job.printer.warning(
+                    "%s %s is not reached, using crf %i with %s %.4f"
+                    % (self.metric, self.target, best, self.metric, best_score)
+                )
+            return best, best_score
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    def apply(self, job):
+        """overrides the CRF of the given job with the searched or the cached
+        one
+
+        :return: The CRF, None if the search failed.
+        """
+        key = self.get_key(job)
+        row = None
+        if key is not None:
+            with self.lock:
+                row = self.connection.execute(
+                    "SELECT crf, score FROM searches WHERE key = ?", (key,)
+                ).fetchone()
+
+        op = job.printer
+        if row is not None:
+            crf, score = row
+            op.info("cached quality search: crf %i" % crf)
+        else:
+            crf, score = self.search(job)
+            if score is None:
+                op.warning(
+                    "quality search failed, keeping the template CRF: %s"
+                    % job.source_file_full_path
+                )
+                return None
+            if key is not None:
+                with self.lock:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO searches VALUES (?, ?, ?)",
+                        (key, crf, score),
+                    )
+                    self.connection.commit()
+
+        op.ok(
+            "crf %i for %s %s: %s"
+            % (crf, self.metric, self.target, job.source_file_full_path)
+        )
+        job.add_extra_options("-crf %i" % crf)
+        return crf
+
+    def close(self):
+        """closes the connection"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class PreviewRenderer(object):
+    """Renders a few short windows sampled from the sources of the jobs, so a
+    batch can be signed off before it is converted.
+
+    The windows are cut with input seeking, ``-ss`` and ``-t`` before the
+    input, or ``-start_number`` and ``-frames:v`` for the image sequences,
+    so only the sampled parts are decoded. Everything else is the command of
+    the job as it is, the full batch runs the same command later. The
+    previews are written to a side folder next to the target folder.
+
+    The jobs run through a :class:`PipeChain` are previewed through a chain
+    too. The other runners, like the :class:`ChunkedEncoder`, the
+    :class:`FrameRangeEncoder` and the :class:`PaletteEncoder`, work on the
+    whole source, so their jobs are not previewed rather than previewed
+    with another command.
+    """
+
+    # the suffix of the folder of the previews next to the target folder
+    folder_suffix = "_preview"
+
+    def __init__(self, samples=3, sample_duration=5.0, **kwargs):
+        self.samples = samples
+        self.sample_duration = sample_duration
+        self.jobs = kwargs.get("jobs", 1)
+        self.cores = kwargs.get("cores")
+        self.scheduling = kwargs.get("scheduling")
+
+    @classmethod
+    def get_preview_path(cls, target_path):
+        """returns the folder of the previews of the given target folder"""
+        target_path = os.path.normpath(os.path.abspath(target_path))
+        return target_path + cls.folder_suffix
+
+    def create_window_command(self, job, position):
+        """returns the command of the job that only renders the window
+        starting at the given position in seconds
+        """
+        if isinstance(job.runner, PipeChain):
+            # only the first stage reads the source
+            stages = job.normalized_command.split(" | ")
+        else:
+            stages = [job.normalized_command]
+        command = FFmpegCommand.from_string(stages[0])
+
+        sequence = MediaConverter.get_sequence(job.source_file_full_path)
+        if sequence is not None:
+            framerate = FrameRangeEncoder.get_framerate(command)
+            start_number = sequence.first + int(position * framerate)
+            command.input_options = [
+                option
+                for option in command.input_options
+                if option[0] != "-start_number"
+            ]
+            command.input_options.insert(0, ["-start_number", str(start_number)])
+            command.add(
+                "-frames:v",
+                str(max(1, int(round(self.sample_duration * framerate)))),
+            )
+        else:
+            command.input_options = [
+                option
+                for option in command.input_options
+                if option[0] not in ["-ss", "-t"]
+            ]
+            command.input_options += [
+                ["-ss", "%.3f" % position],
+                ["-t", "%.3f" % self.sample_duration],
+            ]
+        stages[0] = command.to_string()
+        return " | ".join(stages)
+
+    def create_jobs(self, job):
+        """returns the jobs rendering the windows of the given job
+
+        :raises ValueError: If the job can not be previewed.
+        """
+        if job.runner is not None and not isinstance(job.runner, PipeChain):
+            raise ValueError(
+                "%s works on the whole source" % job.runner.__class__.__name__
+            )
+        duration = ProgressTracker.get_duration(job)
+        target_path = self.get_preview_path(
+            os.path.dirname(job.output_file_full_path) or "."
+        )
+        root, output_file_extension = os.path.splitext(
+            os.path.basename(job.output_file_full_path)
+        )
+        preview_jobs = []
+        positions = get_sample_positions(
+            duration, self.samples, self.sample_duration
+        )
+        for i, position in enumerate(positions):
+            preview_job = Job(
+                converter_name=job.converter_name,
+                command=self.create_window_command(job, position),
+                source_file_full_path=job.source_file_full_path,
+                output_file_full_path=os.path.join(
+                    target_path,
+                    "%s.preview%i%s" % (root, i + 1, output_file_extension),
+                ),
+                printer=job.printer,
+                timeout=job.timeout,
+                stall_timeout=job.stall_timeout,
+            )
+            preview_job.overwrite = True
+            if isinstance(job.runner, PipeChain):
+                preview_job.runner = PipeChain()
+            preview_jobs.append(preview_job)
+        return preview_jobs
+
+    def run(self, jobs):
+        """renders the previews of the pending jobs and prints the commands
+        the full batch will run
+
+        :return: The list of the preview :class:`Job` instances.
+        """
+        op = OutputPrinter()
+        previews = []
+        for job in jobs:
+            if job.status != Job.PENDING:
+                continue
+            try:
+                previews.append((job, self.create_jobs(job)))
+            except ValueError as e:
+                op.warning(
+                    "can not be previewed, %s: %s" % (e, job.source_file_full_path)
+                )
+
+        preview_jobs = [
+            preview_job for _, job_previews in previews for preview_job in job_previews
+        ]
+        for path in set(
+            os.path.dirname(preview_job.output_file_full_path)
+            for preview_job in preview_jobs
+        ):
+            if not os.path.exists(path):
+                os.makedirs(path)
+        JobPool(jobs=self.jobs, cores=self.cores, scheduling=self.scheduling).run(
+            preview_jobs
+        )
+
+        for job, job_previews in previews:
+            op.ok("preview: %s" % job.source_file_full_path)
+            for preview_job in job_previews:
+                if preview_job.status == Job.DONE:
+                    op.info("  %s" % preview_job.output_file_full_path)
+                else:
+                    op.fail("  %s" % preview_job.output_file_full_path)
+            op.info("rendered command: %s" % job.rendered_command)
+        return preview_jobs
+
+
+class PaletteEncoder(object):
+    """Encodes GIFs with a palette computed in a separate pass.
+
+    The GIF templates build the palette inline with
+    ``split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse``, which buffers
+    every frame at the source resolution until the palette is ready. Here the
+    palette is generated from a downscaled and frame sampled copy of the
+    source first and cached per source, so re-running with other fps or scale
+    options reuses it. The bounce templates are built from a forward and
+    backward list of the frames of the image sequence instead of the
+    ``reverse`` filter, so no frames are held in memory.
+    """
+
+    # the frames per second and the width the palette is computed from
+    sample_rate = 2
+    sample_width = 320
+
+    filter_options = ["-vf", "-filter_complex", "-lavfi"]
+
+    @classmethod
+    def get_filter_graph(cls, command):
+        """returns the filter graph with the palettegen filter, None if
+        there is none
+        """
+        for flag, value in command.output_options:
+            if flag in cls.filter_options and "palettegen" in (value or ""):
+                return value
+        return None
+
+    @classmethod
+    def is_supported(cls, job):
+        """returns True if the given job creates its palette in its filter
+        graph or creates a GIF
+        """
+        try:
+            command = job.get_ffmpeg_command()
+        except ValueError:
+            return False
+        output_file_extension = os.path.splitext(job.output_file_full_path)[-1]
+        return (
+            output_file_extension.lower() == ".gif"
+            or cls.get_filter_graph(command) is not None
+        )
+
+    @classmethod
+    def parse_filter_graph(cls, graph):
+        """parses the palette filter graph of a template
+
+        :return: A tuple of the filters before the palette, the options of
+          palettegen and paletteuse and if the graph plays the frames forward
+          and backward.
+        """
+        import re
+
+        if not graph:
+            return "", "", "", False
+
+        before_split = graph[: graph.find("split")].rstrip(",")
+        bounce = "reverse" in before_split
+        filters = "" if bounce else before_split
+        gen_options = re.search(r"palettegen(=[^\[;,]*)?", graph).group(1) or ""
+        use_options = re.search(r"paletteuse(=[^\[;,]*)?", graph).group(1) or ""
+        return filters, gen_options, use_options, bounce
+
+    def get_palette(self, job, command, gen_options):
+        """returns the path of the cached palette of the source of the given
+        job, generates it if it is not cached
+
+        :return: The path of the palette, None if it can not be generated.
+        """
+        import hashlib
+        import subprocess
+        import tempfile
+
+        source = job.source_file_full_path
+        prepass_filter = "fps=%s,scale=%i:-2,palettegen%s" % (
+            self.sample_rate,
+            self.sample_width,
+            gen_options,
+        )
+        key = hashlib.sha1(
+            "\0".join(
+                [
+                    os.path.abspath(source),
+                    Manifest.get_fingerprint(source) or "",
+                    prepass_filter,
+                ]
+            ).encode("utf-8")
+        ).hexdigest()
+        palette_path = get_user_cache_path("palettes", "%s.png" % key)
+        if os.path.exists(palette_path):
+            job.printer.info("cached palette: %s" % palette_path)
+            return palette_path
+
+        os.makedirs(os.path.dirname(palette_path), exist_ok=True)
+        # generate in to a temporary file, so a half written palette is never
+        # used by a parallel job, the jobs of the same process need their own
+        # file too
+        handle, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(palette_path), suffix=".png"
+        )
+        os.close(handle)
+        command = FFmpegCommand(
+            executable=command.executable,
+            input_options=command.input_options,
+            input_file=source,
+            output_options=[
+                ["-v", "error"],
+                ["-vf", prepass_filter],
+                ["-frames:v", "1"],
+                ["-update", "1"],
+                ["-y", None],
+            ],
+            output_file=temp_path,
+        )
+        job.printer.info("generating palette: %s" % palette_path)
+        process = subprocess.run(
+            command.to_arguments(),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            errors="replace",
+        )
+        if process.returncode != 0 or not os.path.getsize(temp_path):
+            job.printer.write(process.stdout)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return None
+        os.replace(temp_path, palette_path)
+        return palette_path
+
+    @classmethod
+    def write_bounce_list(cls, sequence, source, path, framerate):
+        """writes a concat demuxer list that plays the frames of the given
+        sequence forward and then backward
+        """
+        folder = os.path.dirname(source)
+        file_names = list(sequence.file_names())
+        duration = 1.0 / framerate
+        with open(path, "w") as f:
+            f.write("ffconcat version 1.0\n")
+            for file_name in file_names + file_names[::-1]:
+                file_path = os.path.abspath(os.path.join(folder, file_name))
+                f.write("file '%s'\n" % file_path.replace("'", "'\\''"))
+                f.write("duration %f\n" % duration)
+
+    def execute(self, job):
+        """generates or reuses the palette and encodes the GIF with it, the
+        :class:`Job` runner interface
+
+        :return: The exit code of the process.
+        """
+        import tempfile
+        from fractions import Fraction
+
+        command = job.get_ffmpeg_command()
+        graph = self.get_filter_graph(command)
+        filters, gen_options, use_options, bounce = self.parse_filter_graph(graph)
+        # the filters given with the extra options replace the ones of the
+        # template
+        user_filters = [
+            value
+            for flag, value in command.output_options
+            if flag in self.filter_options and value != graph
+        ]
+        if user_filters:
+            filters = ",".join(user_filters)
+
+        palette_path = self.get_palette(job, command, gen_options)
+        if palette_path is None:
+            job.printer.warning("can not generate the palette, using the template")
+            return job.execute()
+
+        framerate = "25"
+        for flag, value in command.input_options:
+            if flag in ["-framerate", "-r"]:
+                framerate = value
+        sequence = MediaConverter.get_sequence(job.source_file_full_path)
+
+        list_path = None
+        if bounce and sequence is None:
+            job.printer.warning("only image sequences can bounce, using the template")
+            return job.execute()
+        if bounce:
+            handle, list_path = tempfile.mkstemp(prefix="bounce_", suffix=".txt")
+            os.close(handle)
+            self.write_bounce_list(
+                sequence, job.source_file_full_path, list_path, Fraction(framerate)
+            )
+            input_arguments = ["-f", "concat", "-safe", "0", "-i", list_path]
+            # the concat demuxer doesn't keep the frame rate of the images
+            filters = ",".join(
+                filter(None, ["setpts=N/(%s*TB)" % framerate, filters])
+            )
+        else:
+            input_arguments = command.get_input_arguments()
+            input_arguments[-1] = job.source_file_full_path
+
+        command.remove(*self.filter_options)
+        output_arguments = command.get_output_arguments()
+        output_arguments[-1] = job.output_file_full_path
+        arguments = (
+            [command.executable]
+            + input_arguments
+            + ["-i", palette_path]
+            + [
+                "-filter_complex",
+                "[0:v]%s[x];[x][1:v]paletteuse%s" % (filters or "null", use_options),
+            ]
+            + output_arguments
+        )
+        try:
+            return job.execute(arguments)
+        finally:
+            if list_path is not None:
+                os.remove(list_path)
+
+
+class MultiOutputRunner(object):
+    """Runs the jobs of several templates for the same source as a single
+    ffmpeg process.
+
+    The source is decoded once and the video is split with a filter graph in
+    to one branch per template, each branch gets the video filters of its
+    template and is encoded with the options of its template in to its own
+    output.
+    """
+
+    def __init__(self, jobs):
+        # the first job runs the process for all the others
+        self.jobs = jobs
+
+    @classmethod
+    def is_mergeable(cls, job):
+        """returns True if the job can be merged with the jobs of the other
+        templates
+        """
+        if job.runner is not None:
+            return False
+        if job.cache is not None:
+            # the cache is looked up per job, a hit of the first job would
+            # leave the others of the merged command unfinished
+            return False
+        try:
+            command = job.get_ffmpeg_command()
+        except ValueError:
+            return False
+        # the templates with their own filter graphs run separately
+        return not command.has("-filter_complex", "-lavfi")
+
+    @classmethod
+    def copies_video(cls, command):
+        """returns True if the given command copies the video stream, which
+        can not be taken from the filter graph
+        """
+        codec_options = StreamCopyPlanner.stream_options["video"]["codec"]
+        return (command.get(*codec_options) or command.get("-c")) == "copy"
+
+    @classmethod
+    def has_video(cls, command):
+        """returns True if the output of the given command has a video"""
+        output_file_extension = os.path.splitext(command.output_file)[-1]
+        return (
+            not command.has("-vn")
+            and output_file_extension.lower() not in AUDIO_FORMATS
+        )
+
+    @classmethod
+    def get_video_filter(cls, command):
+        """returns the video filter of the given command without the default
+        [in] and [out] labels
+        """
+        import re
+
+        video_filter = command.get("-vf", "-filter:v")
+        if video_filter is None:
+            return None
+        video_filter = re.sub(r"^\s*\[in\]\s*", "", video_filter)
+        return re.sub(r"\s*\[out\]\s*$", "", video_filter)
+
+    def create_arguments(self):
+        """returns the arguments of the merged ffmpeg command"""
+        commands = []
+        for job in self.jobs:
+            command = job.get_ffmpeg_command()
+            command.input_file = job.source_file_full_path
+            command.output_file = job.output_file_full_path
+            commands.append(command)
+
+        # decode once
+        arguments = [commands[0].executable] + commands[0].get_input_arguments()
+
+        video_commands = [
+            command
+            for command in commands
+            if self.has_video(command) and not self.copies_video(command)
+        ]
+        filter_graph = []
+        if len(video_commands) > 1:
+            filter_graph.append(
+                "[0:v]split=%i%s"
+                % (
+                    len(video_commands),
+                    "".join("[v%i]" % i for i in range(len(video_commands))),
+                )
+            )
+
+        output_arguments = []
+        video_index = 0
+        for command in commands:
+            if self.has_video(command) and self.copies_video(command):
+                # the copied stream is taken from the input as it is
+                output_arguments += ["-map", "0:v:0?"]
+            elif self.has_video(command):
+                if not filter_graph:
+                    # only one video output, it can keep its own filters
+                    output_arguments += ["-map", "0:v:0?"]
+                else:
+                    label = "[v%i]" % video_index
+                    video_filter = self.get_video_filter(command)
+                    if video_filter:
+                        filter_graph.append(
+                            "%s%s[o%i]" % (label, video_filter, video_index)
+                        )
+                        label = "[o%i]" % video_index
+                    command.remove("-vf", "-filter:v")
+                    output_arguments += ["-map", label]
+                video_index += 1
+            if not command.has("-an"):
+                output_arguments += ["-map", "0:a:0?"]
+            output_arguments += command.get_output_arguments()
+
+        if filter_graph:
+            arguments += ["-filter_complex", ";".join(filter_graph)]
+        return arguments + output_arguments
+
+    def execute(self, job):
+        """runs the merged command and finishes the other jobs with its
+        result
+
+        :return: The exit code of the process.
+        """
+        import time
+
+        others = self.jobs[1:]
+        final_output_file_full_paths = []
+        for other in others:
+            other.status = Job.RUNNING
+            other.start_time = time.time()
+            final_output_file_full_paths.append(other.stage_output())
+
+        job.printer.info(
+            "decoding once for: %s" % ", ".join(j.converter_name for j in self.jobs)
+        )
+        return_code = job.execute(self.create_arguments())
+        for other, final_output_file_full_path in zip(
+            others, final_output_file_full_paths
+        ):
+            other_return_code = return_code
+            if final_output_file_full_path is not None:
+                other_return_code = other.commit_output(
+                    final_output_file_full_path, return_code
+                )
+            other.finish(other_return_code)
+        return return_code
+
+
+class PipeChain(object):
+    """Runs a chain of templates, like ``denoise_normal+prores422hq``, as
+    processes connected with pipes.
+
+    Every stage but the last one writes a lossless NUT stream, with raw video
+    and PCM audio, to its standard output and the next stage reads it from
+    its standard input. So the stages run at the same time and the
+    intermediate files never touch the disk. The chain is a single command
+    with ``|`` between the stages, which a shell could run too.
+    """
+
+    # separates the template names of a chain
+    separator = "+"
+    # the codecs of the stream between the stages
+    video_codec = "rawvideo"
+    audio_codec = "pcm_f32le"
+    # the options that only apply to the encoder or the container of a
+    # template, dropped from the stages writing to a pipe
+    container_options = ["-movflags", "-f", "-strict", "-loop"]
+
+    @classmethod
+    def create_command(cls, commands):
+        """returns the chained command of the given template commands
+
+        The extra options are added to the last stage.
+        """
+        import re
+
+        video_options = StreamCopyPlanner.stream_options["video"]
+        audio_options = StreamCopyPlanner.stream_options["audio"]
+        stages = []
+        for i, command in enumerate(commands):
+            command = FFmpegCommand.from_string(
+                re.sub(r"\s*\{extra_options\}", "", command)
+            )
+            if i > 0:
+                # the demuxer options of the source do not apply to the pipe
+                command.input_options = []
+                command.input_file = "pipe:0"
+            if i < len(commands) - 1:
+                output_file_extension = os.path.splitext(command.output_file)[-1]
+                command.remove(
+                    *(
+                        video_options["codec"]
+                        + video_options["encoder"]
+                        + audio_options["codec"]
+                        + audio_options["encoder"]
+                        + cls.container_options
+                    )
+                )
+                if output_file_extension.lower() in AUDIO_FORMATS:
+                    command.add("-vn")
+                if not command.has("-vn"):
+                    command.add("-c:v", cls.video_codec)
+                if not command.has("-an"):
+                    command.add("-c:a", cls.audio_codec)
+                command.add("-sn")
+                command.add("-dn")
+                command.add("-f", "nut")
+                command.output_file = "pipe:1"
+            stages.append(command.to_string())
+
+        template = CommandTemplate(" | ".join(stages))
+        template.add_extra_options()
+        return template.command
+
+    @classmethod
+    def is_chain(cls, command):
+        """returns True if the given command is a chain of ffmpeg commands"""
+        template = CommandTemplate.compile(command)
+        stages = cls.split(template.arguments)
+        return len(stages) > 1 and all(
+            stage and os.path.basename(stage[0]) == "ffmpeg" for stage in stages
+        )
+
+    @classmethod
+    def split(cls, arguments):
+        """splits the given arguments in to the arguments of the stages"""
+        stages = [[]]
+        for argument in arguments:
+            if argument == "|":
+                stages.append([])
+            else:
+                stages[-1].append(argument)
+        return stages
+
+    @classmethod
+    def parse_stats(cls, log):
+        """returns the number of frames and the speed of the last ``-stats``
+        line in the given ffmpeg log, None for the ones that are not found
+        """
+        import re
+
+        frames = speed = None
+        for match in re.finditer(r"frame=\s*([0-9]+)", log):
+            frames = int(match.group(1))
+        for match in re.finditer(r"speed=\s*([0-9.]+)x", log):
+            speed = float(match.group(1))
+        return frames, speed
+
+    def execute(self, job):
+        """runs the stages of the given job connected with pipes and reports
+        the throughput of each stage
+
+        :return: The exit code of the last failed stage, 0 if every stage is
+          succeeded.
+        """
+        import subprocess
+        import time
+
+        op = job.printer
+        template = CommandTemplate.compile(job.command)
+        stages = self.split(
+            template.render(
+                input_file_full_path=job.source_file_full_path,
+                output_file_full_path=job.output_file_full_path,
+                extra_options=job.extra_options or "",
+            )
+        )
+        names = job.converter_name.split(self.separator)
+        if len(names) != len(stages):
+            names = ["stage %i" % (i + 1) for i in range(len(stages))]
+
+        op.info("converting with: %s" % job.converter_name)
+        op.info("rendered command: %s" % job.format_command())
+        if job.scheduling:
+            op.info("scheduling: %s" % job.describe_scheduling())
+
+        processes = []
+        logs = []
+        log_readers = []
+        stdin = subprocess.DEVNULL
+        start_time = time.time()
+        try:
+            for i, arguments in enumerate(stages):
+                last = i == len(stages) - 1
+                process = subprocess.Popen(
+                    arguments,
+                    stdin=stdin,
+                    stdout=subprocess.DEVNULL if last else subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
+                SchedulingPolicy.apply(job, process.pid)
+                if stdin is not subprocess.DEVNULL:
+                    # only the next stage reads the pipe, so the earlier
+                    # stage gets SIGPIPE if the next one dies
+                    stdin.close()
+                stdin = process.stdout
+                processes.append(process)
+                ProcessWatchdog.watch(job, process)
+                log = []
+                logs.append(log)
+                # drain the logs in the background, so no stage blocks on it
+                log_reader = threading.Thread(
+                    target=lambda process=process, log=log: log.append(
+                        process.stderr.read().decode("utf-8", "replace")
+                    )
+                )
+                log_reader.start()
+                log_readers.append(log_reader)
+        except OSError as e:
+            op.fail("%s: %s" % (arguments[0], e.strerror))
+            for process in processes:
+                ProcessWatchdog.unwatch(job, process)
+            return 127
+
+        end_times = []
+        try:
+            for process in processes:
+                process.wait()
+                end_times.append(time.time())
+        finally:
+            for process in processes:
+                ProcessWatchdog.unwatch(job, process)
+        for log_reader in log_readers:
+            log_reader.join()
+
+        for name, log in zip(names, logs):
+            op.info("%s:" % name)
+            op.write("".join(log))
+
+        for i, (name, log, end_time) in enumerate(zip(names, logs, end_times)):
+            frames, speed = self.parse_stats("".join(log))
+            elapsed = max(end_time - start_time, 1e-6)
+            text = "stage %i/%i %s: %.2f s" % (i + 1, len(stages), name, elapsed)
+            if frames is not None:
+                text += ", %i frames, %.1f fps" % (frames, frames / elapsed)
+            if speed is not None:
+                text += ", %.2fx" % speed
+            op.info(text)
+
+        return_codes = [process.returncode for process in processes]
+        if return_codes[-1] != 0:
+            return return_codes[-1]
+        failed = [return_code for return_code in return_codes if return_code != 0]
+        return failed[-1] if failed else 0
+
+
+class MultiTemplateConverter(object):
+    """Converts the same sources with several templates at once.
+
+    The sources are decoded only once and every template writes its own
+    output, see :class:`MultiOutputRunner`.
+    """
+
+    def __init__(self, converters, jobs=1, cores=None, dry_run=False):
+        self.converters = converters
+        self.jobs = jobs
+        self.cores = cores
+        self.dry_run = dry_run
+
+        # the outputs of the templates with the same file extension would
+        # overwrite each other, suffix the later ones with the template name
+        output_file_extensions = []
+        for converter in self.converters:
+            if converter.output_file_extension in output_file_extensions:
+                converter.output_file_suffix = "_%s" % converter.name
+            output_file_extensions.append(converter.output_file_extension)
+
+    def prepare_jobs(self):
+        """prepares the jobs of all the converters and merges the ones with
+        the same source
+
+        :return: The list of all the jobs and the list of jobs to run.
+        """
+        all_jobs = []
+        groups = {}
+        jobs_to_run = []
+        for converter in self.converters:
+            converter_jobs = converter.prepare_jobs()
+            if converter.quality is not None and not self.dry_run:
+                # the merged jobs are run with the searched CRF
+                converter.search_quality(converter_jobs)
+            for job in converter_jobs:
+                all_jobs.append(job)
+                if job.status != Job.PENDING:
+                    continue
+                if not MultiOutputRunner.is_mergeable(job):
+                    jobs_to_run.append(job)
+                    continue
+                if job.source_file_full_path not in groups:
+                    groups[job.source_file_full_path] = []
+                    jobs_to_run.append(job)
+                groups[job.source_file_full_path].append(job)
+
+        for group in groups.values():
+            if len(group) > 1:
+                group[0].runner = MultiOutputRunner(group)
+        return all_jobs, jobs_to_run
+
+    def run(self):
+        """runs the converters
+
+        :return: The list of :class:`Job` instances.
+        """
+        ProcessWatchdog.reset()
+        all_jobs, jobs_to_run = self.prepare_jobs()
+        if self.dry_run:
+            op = OutputPrinter()
+            for job in jobs_to_run:
+                if isinstance(job.runner, MultiOutputRunner):
+                    arguments = job.runner.create_arguments()
+                    op.info("rendered command: %s" % FFmpegCommand.join(arguments))
+                else:
+                    op.info("rendered command: %s" % job.rendered_command)
+            return all_jobs
+
+        for converter in self.converters:
+            if any(
+                job.status == Job.PENDING and job.converter_name == converter.name
+                for job in all_jobs
+            ):
+                converter.create_target_path()
+
+        # the converters of the command line share the tracker
+        progress = self.converters[0].progress
+        if progress is not None:
+            # the merged jobs report the progress of their first job
+            progress.prepare(jobs_to_run)
+        try:
+            JobPool(
+                jobs=self.jobs,
+                cores=self.cores,
+                scheduling=self.converters[0].scheduling,
+            ).run(jobs_to_run)
+        finally:
+            if progress is not None:
+                progress.close()
+
+        if len(all_jobs) > 1:
+            JobPool.print_summary(all_jobs)
+        return all_jobs
+
+
+class Inotify(object):
+    """A minimal inotify watch on a folder, through ctypes so there are no
+    extra dependencies. Only available on Linux.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+
+    def __init__(self, path):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        # not waking up for every write, files are checked to settle anyway
+        mask = (
+            self.IN_CLOSE_WRITE
+            | self.IN_MOVED_FROM
+            | self.IN_MOVED_TO
+            | self.IN_CREATE
+            | self.IN_DELETE
+        )
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def wait(self, timeout):
+        """waits for any change in the folder
+
+        :return: True if there are changes, False on timeout.
+        """
+        import select
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        # drain the events, the folder is scanned anyway
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        """stops watching"""
+        os.close(self.fd)
+
+
+class FolderWatcher(object):
+    """Watches the source folder of a converter and streams jobs in to its
+    worker pool as new files and image sequences appear.
+
+    A file is submitted once its size and modification time stay the same
+    for ``settle_time`` seconds, so half written files are not converted. An
+    image sequence is submitted once its frame range stops growing. Changes
+    are noticed with inotify on Linux, other systems fall back to polling.
+    """
+
+    def __init__(self, converter, settle_time=5, poll_interval=2):
+        self.converter = converter
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.jobs = []
+
+        # the source paths, their last signatures and since when they are
+        # seen with that signature
+        self._candidates = {}
+        # the signatures of the submitted sources
+        self._submitted = {}
+
+    @classmethod
+    def get_signature(cls, folder, name, sequence=None):
+        """returns a value that changes while a file or sequence is written"""
+        if sequence is not None:
+            last_file_name = "%0*i" % (sequence.padding, sequence.last)
+            path = os.path.join(
+                folder, "%s%s%s" % (sequence.prefix, last_file_name, sequence.extension)
+            )
+            extra = (sequence.first, sequence.last, sequence.count)
+        else:
+            path = os.path.join(folder, name)
+            extra = ()
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return extra + (stat.st_size, stat.st_mtime_ns)
+
+    def scan(self, now):
+        """checks the source folder once
+
+        :return: The list of source paths that are settled and should be
+          submitted.
+        """
+        folder = self.converter.source_path
+        index = SequenceIndex.get(folder)
+        sources = [(s.pattern, s) for s in index.sequences]
+        sources += [(f, None) for f in index.files]
+
+        settled = []
+        seen = set()
+        for name, sequence in sources:
+            path = os.path.join(folder, name)
+            seen.add(path)
+            if path in self.converter._reserved_output_paths:
+                # our own output
+                continue
+            signature = self.get_signature(folder, name, sequence)
+            if signature is None or self._submitted.get(path) == signature:
+                continue
+
+            previous = self._candidates.get(path)
+            if previous is None or previous[0] != signature:
+                # new or still changing
+                self._candidates[path] = (signature, now)
+            elif now - previous[1] >= self.settle_time:
+                del self._candidates[path]
+                self._submitted[path] = signature
+                settled.append(path)
+
+        # forget the removed ones
+        for path in list(self._candidates):
+            if path not in seen:
+                del self._candidates[path]
+        return settled
+
+    def run(self):
+        """watches the folder until :meth:`stop` is called or the process is
+        interrupted
+
+        :return: The list of the submitted :class:`Job` instances.
+        """
+        import time
+
+        op = OutputPrinter()
+        converter = self.converter
+        pool = JobPool(
+            jobs=converter.jobs, cores=converter.cores, scheduling=converter.scheduling
+        )
+        pool.start()
+
+        try:
+            inotify = Inotify(converter.source_path)
+            op.info("watching with inotify: %s" % converter.source_path)
+        except (OSError, AttributeError):
+            inotify = None
+            op.info("watching by polling: %s" % converter.source_path)
+
+        try:
+            while not self.stop_event.is_set():
+                for path in self.scan(time.time()):
+                    job = converter.prepare_job(
+                        path, printer=OutputPrinter(buffered=converter.jobs > 1)
+                    )
+                    self.jobs.append(job)
+                    if job.status == Job.PENDING:
+                        converter.create_target_path()
+                        if converter.progress is not None:
+                            converter.progress.prepare([job])
+                        pool.submit(job)
+
+                # wake up for the changes, but also to see the candidates
+                # settle
+                timeout = self.poll_interval
+                if self._candidates:
+                    timeout = min(timeout, self.settle_time)
+                if inotify is not None:
+                    inotify.wait(timeout)
+                else:
+                    self.stop_event.wait(timeout)
+        except KeyboardInterrupt:
+            op.warning("stopping, waiting for the running jobs")
+        finally:
+            if inotify is not None:
+                inotify.close()
+            pool.shutdown()
+            if converter.progress is not None:
+                converter.progress.close()
+
+        JobPool.print_summary(self.jobs)
+        return self.jobs
+
+    def stop(self):
+        """stops watching after the current scan"""
+        self.stop_event.set()
+
+
+class WorkQueue(object):
+    """A queue of jobs shared by the coordinator and the workers of a render
+    farm.
+
+    The queue is a SQLite database, which can be on a file system shared by
+    the hosts. The coordinator pushes the prepared jobs in to it and waits
+    for their results, the workers lease the jobs one by one, extend their
+    leases while running them and store the results. The jobs of a worker
+    that stops heartbeating are leased again when their lease expires, up to
+    ``max_attempts`` times.
+
+    The jobs are pushed in batches, a batch is open while its coordinator is
+    waiting for it. The workers keep polling while there are open batches,
+    and the coordinator gives up when no worker is alive for
+    ``worker_timeout`` seconds.
+
+    The file paths are stored as they are, so the source and target folders
+    should be at the same paths on every host. The lease times are compared
+    with the clock of each host, so the clocks should be in sync.
+    """
+
+    PENDING = "pending"
+    LEASED = "leased"
+
+    def __init__(self, path, lease_time=60, max_attempts=3, worker_timeout=600):
+        self.path = path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.worker_timeout = worker_timeout
+        self._connection = None
+        self.lock = threading.Lock()
+
+    @property
+    def connection(self):
+        """the connection to the database, creates the database if needed"""
+        if self._connection is None:
+            import sqlite3
+
+            # the transactions are started explicitly, so a lease is a single
+            # atomic read and update for all the hosts
+            self._connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False, isolation_level=None
+            )
+            self._connection.row_factory = sqlite3.Row
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "batch TEXT, "
+                "converter_name TEXT, "
+                "command TEXT, "
+                "source_file_full_path TEXT, "
+                "output_file_full_path TEXT, "
+                "extra_options TEXT, "
+                "overwrite INTEGER, "
+                "manifest_path TEXT, "
+                "status TEXT, "
+                "worker TEXT, "
+                "lease_expires REAL, "
+                "attempts INTEGER DEFAULT 0, "
+                "return_code INTEGER, "
+                "start_time REAL, "
+                "end_time REAL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS batches ("
+                "id TEXT PRIMARY KEY, "
+                "closed INTEGER DEFAULT 0, "
+                "heartbeat REAL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS workers ("
+                "worker TEXT PRIMARY KEY, "
+                "heartbeat REAL)"
+            )
+        return self._connection
+
+    def push(self, jobs):
+        """adds the pending jobs to the queue
+
+        :return: The id of the batch of the jobs.
+        """
+        import time
+        import uuid
+
+        batch = uuid.uuid4().hex
+        with self.lock:
+            connection = self.connection
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "INSERT INTO batches (id, heartbeat) VALUES (?, ?)",
+                (batch, time.time()),
+            )
+            for job in jobs:
+                if job.status != Job.PENDING:
+                    continue
+                cursor = connection.execute(
+                    "INSERT INTO jobs (batch, converter_name, command, "
+                    "source_file_full_path, output_file_full_path, "
+                    "extra_options, overwrite, manifest_path, status) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        batch,
+                        job.converter_name,
+                        job.command,
+                        os.path.abspath(job.source_file_full_path),
+                        os.path.abspath(job.output_file_full_path),
+                        job.extra_options,
+                        job.overwrite,
+                        job.manifest.target_path if job.manifest else None,
+                        self.PENDING,
+                    ),
+                )
+                job.queue_id = cursor.lastrowid
+            connection.execute("COMMIT")
+        return batch
+
+    def lease(self, worker):
+        """leases the next pending job, or a job whose lease is expired, to
+        the given worker
+
+        :return: A :class:`Job`, None if there is no job to lease.
+        """
+        import time
+
+        now = time.time()
+        with self.lock:
+            connection = self.connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                # give up on the jobs that kill their workers
+                connection.execute(
+                    "UPDATE jobs SET status = ?, return_code = -1 "
+                    "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                    (Job.FAILED, self.LEASED, now, self.max_attempts),
+                )
+                row = connection.execute(
+                    "SELECT * FROM jobs WHERE status = ? "
+                    "OR (status = ? AND lease_expires < ?) ORDER BY id LIMIT 1",
+                    (self.PENDING, self.LEASED, now),
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE jobs SET status = ?, worker = ?, "
+                        "lease_expires = ?, attempts = attempts + 1, "
+                        "start_time = ? WHERE id = ?",
+                        (self.LEASED, worker, now + self.lease_time, now, row["id"]),
+                    )
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+        if row is None:
+            return None
+        job = Job(
+            converter_name=row["converter_name"],
+            command=row["command"],
+            source_file_full_path=row["source_file_full_path"],
+            output_file_full_path=row["output_file_full_path"],
+            extra_options=row["extra_options"],
+            printer=OutputPrinter(buffered=True),
+        )
+        if row["manifest_path"]:
+            job.manifest = Manifest(row["manifest_path"])
+        # the output of a previous attempt is not complete
+        job.overwrite = bool(row["overwrite"]) or row["attempts"] > 0
+        job.queue_id = row["id"]
+        if PipeChain.is_chain(job.command):
+            job.runner = PipeChain()
+        return job
+
+    def heartbeat(self, worker):
+        """marks the given worker alive and extends the leases of its jobs"""
+        import time
+
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO workers VALUES (?, ?)", (worker, now)
+            )
+            self.connection.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE worker = ? AND status = ?",
+                (now + self.lease_time, worker, self.LEASED),
+            )
+
+    def close_batch(self, batch):
+        """marks the given batch closed, its coordinator stopped waiting"""
+        with self.lock:
+            self.connection.execute(
+                "UPDATE batches SET closed = 1 WHERE id = ?", (batch,)
+            )
+
+    def has_open_batches(self):
+        """returns True if a coordinator is still waiting for a batch, the
+        batches of the coordinators which stopped heartbeating are closed
+        """
+        import time
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT COUNT(*) FROM batches WHERE closed = 0 AND heartbeat > ?",
+                (time.time() - self.lease_time,),
+            ).fetchone()
+        return row[0] > 0
+
+    def get_last_worker_heartbeat(self):
+        """returns the time of the last heartbeat of any worker, None if no
+        worker is seen yet
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT MAX(heartbeat) FROM workers"
+            ).fetchone()
+        return row[0]
+
+    def complete(self, job, worker):
+        """stores the result of the given job, if it is still leased to the
+        given worker
+        """
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, return_code = ?, end_time = ? "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (
+                    job.status,
+                    job.return_code,
+                    job.end_time,
+                    job.queue_id,
+                    worker,
+                    self.LEASED,
+                ),
+            )
+
+    def has_unfinished_jobs(self):
+        """returns True if there are pending or leased jobs in the queue"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)",
+                (self.PENDING, self.LEASED),
+            ).fetchone()
+        return row[0] > 0
+
+    def wait(self, jobs, poll_interval=1):
+        """waits until the given pushed jobs are finished by the workers and
+        updates them with their results
+
+        The batches of the jobs are kept open while waiting. The jobs which
+        are not finished are failed if no worker is alive for
+        ``worker_timeout`` seconds.
+        """
+        import time
+
+        waiting = dict(
+            (job.queue_id, job)
+            for job in jobs
+            if job.status == Job.PENDING and job.queue_id is not None
+        )
+        start_time = time.time()
+        while waiting:
+            now = time.time()
+            with self.lock:
+                self.connection.execute(
+                    "UPDATE batches SET heartbeat = ? WHERE id IN "
+                    "(SELECT batch FROM jobs WHERE id IN (%s))"
+                    % ",".join("?" * len(waiting)),
+                    [now] + list(waiting),
+                )
+                rows = self.connection.execute(
+                    "SELECT * FROM jobs WHERE id IN (%s) AND status IN (?, ?)"
+                    % ",".join("?" * len(waiting)),
+                    list(waiting) + [Job.DONE, Job.FAILED],
+                ).fetchall()
+            for row in rows:
+                job = waiting.pop(row["id"])
+                job.status = row["status"]
+                job.return_code = row["return_code"]
+                job.start_time = row["start_time"]
+                job.end_time = row["end_time"]
+                op = OutputPrinter()
+                if job.status == Job.DONE:
+                    op.ok("done by %s: %s" % (row["worker"], job.output_file_full_path))
+                else:
+                    op.fail(
+                        "failed on %s with exit code %s: %s"
+                        % (row["worker"], job.return_code, job.source_file_full_path)
+                    )
+            if not waiting:
+                break
+
+            last_heartbeat = self.get_last_worker_heartbeat() or 0
+            if now - max(start_time, last_heartbeat) > self.worker_timeout:
+                op = OutputPrinter()
+                op.fail(
+                    "no worker is alive for %i seconds, giving up on %i jobs"
+                    % (self.worker_timeout, len(waiting))
+                )
+                for job in waiting.values():
+                    job.status = Job.FAILED
+                    op.fail("not run: %s" % job.source_file_full_path)
+                break
+            time.sleep(poll_interval)
+        return jobs
+
+    def close(self):
+        """closes the connection"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class QueueWorker(object):
+    """Leases the jobs of a :class:`WorkQueue` and runs them until the queue
+    is drained.
+
+    ``jobs`` jobs are run at the same time, each on its own lease. The
+    leases are extended by a heartbeat thread while the jobs are running.
+
+    The worker keeps polling while a coordinator is waiting for an open
+    batch. A worker started before any batch is pushed waits
+    ``idle_timeout`` seconds for one.
+    """
+
+    def __init__(
+        self,
+        queue,
+        jobs=1,
+        cores=None,
+        scheduling=None,
+        poll_interval=2,
+        idle_timeout=60,
+    ):
+        import socket
+
+        self.queue = queue
+        self.jobs = max(1, jobs or 1)
+        self.cores = cores
+        self.scheduling = scheduling
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.worker = "%s:%i" % (socket.gethostname(), os.getpid())
+        self.stop_event = threading.Event()
+        self.finished_jobs = []
+
+    def heartbeat(self):
+        """extends the leases of this worker until it is stopped"""
+        while not self.stop_event.wait(self.queue.lease_time / 3.0):
+            self.queue.heartbeat(self.worker)
+
+    def work(self, pool):
+        """leases and runs jobs until the queue is drained and there are no
+        open batches
+        """
+        import time
+
+        start_time = time.time()
+        has_work = False
+        while not self.stop_event.is_set():
+            job = self.queue.lease(self.worker)
+            if job is None:
+                if self.queue.has_open_batches():
+                    # the coordinator may still be pushing its jobs
+                    has_work = True
+                elif not self.queue.has_unfinished_jobs() and (
+                    has_work or time.time() - start_time > self.idle_timeout
+                ):
+                    return
+                # other workers are running the rest, their jobs are leased
+                # again if they die
+                self.stop_event.wait(self.poll_interval)
+                continue
+            has_work = True
+            pool.submit(job).result()
+            self.queue.complete(job, self.worker)
+            self.finished_jobs.append(job)
+
+    def run(self):
+        """runs the jobs of the queue
+
+        :return: The list of the :class:`Job` instances run by this worker.
+        """
+        OutputPrinter().info("worker %s: %s" % (self.worker, self.queue.path))
+        self.queue.heartbeat(self.worker)
+        pool = JobPool(jobs=self.jobs, cores=self.cores, scheduling=self.scheduling)
+        pool.start()
+        heartbeat = threading.Thread(target=self.heartbeat)
+        heartbeat.daemon = True
+        heartbeat.start()
+        threads = [
+            threading.Thread(target=self.work, args=(pool,)) for i in range(self.jobs)
+        ]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.stop_event.set()
+            pool.shutdown()
+            heartbeat.join()
+        return self.finished_jobs
+
+    def stop(self):
+        """stops leasing new jobs"""
+        self.stop_event.set()
+
+
+class Benchmark(object):
+    """Measures how fast the templates encode.
+
+    Deterministic test media is generated once in the work folder with the
+    ``testsrc2`` and ``sine`` sources of ffmpeg: a video with audio and an
+    image sequence for every size and an audio file. Every template is run
+    against the sources it accepts, and the encode fps, realtime factor, CPU
+    time, peak RSS and output size are recorded. The results are saved as
+    JSON, so two runs can be compared with :meth:`compare`.
+    """
+
+    resolutions = {
+        "720p": "1280x720",
+        "1080p": "1920x1080",
+        "4k": "3840x2160",
+    }
+    frame_rate = 25
+
+    # the metrics compared between two runs and if larger values are better
+    metrics = {
+        "fps": True,
+        "realtime_factor": True,
+        "cpu_time": False,
+        "peak_rss": False,
+        "output_bytes": False,
+    }
+
+    def __init__(self, converters, work_path, sizes=None, duration=5):
+        self.converters = converters
+        self.work_path = work_path
+        self.sizes = sizes or ["720p"]
+        self.duration = duration
+        # the measurements of the jobs run by this benchmark
+        self.measurements = {}
+
+    @classmethod
+    def get_size(cls, size):
+        """returns the WxH resolution of the given size, like 720p or
+        640x360
+        """
+        return cls.resolutions.get(size.lower(), size)
+
+    def get_source_path(self, *args):
+        """returns a path in the sources folder of the work path"""
+        return os.path.join(self.work_path, "sources", *args)
+
+    def generate(self, command, path):
+        """generates a test source with the given ffmpeg arguments, unless it
+        is already generated
+        """
+        import shlex
+        import subprocess
+
+        if MediaConverter.get_sequence_files(path):
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        OutputPrinter().info("generating: %s" % path)
+        subprocess.run(
+            ["ffmpeg", "-y", "-v", "error"] + shlex.split(command) + [path],
+            stdin=subprocess.DEVNULL,
+            check=True,
+        )
+        return path
+
+    def generate_sources(self):
+        """generates the test sources
+
+        :return: A list of (name, size, path, frame count) tuples.
+        """
+        duration = self.duration
+        sources = []
+        for size in self.sizes:
+            resolution = self.get_size(size)
+            video = "-f lavfi -i testsrc2=size=%s:rate=%s:duration=%s" % (
+                resolution,
+                self.frame_rate,
+                duration,
+            )
+            audio = "-f lavfi -i sine=frequency=1000:sample_rate=48000:duration=%s" % (
+                duration,
+            )
+            frames = int(duration * self.frame_rate)
+
+            name = "testsrc2_%s" % size
+            path = self.generate(
+                "%s %s -c:v ffv1 -pix_fmt yuv420p -c:a aac" % (video, audio),
+                self.get_source_path("%s.mkv" % name),
+            )
+            sources.append(("video", size, path, frames))
+
+            path = self.generate(
+                "%s -start_number 1001" % video,
+                self.get_source_path(name, "%s.%%04d.png" % name),
+            )
+            sources.append(("image_sequence", size, path, frames))
+
+        path = self.generate(
+            "-f lavfi -i sine=frequency=1000:sample_rate=48000:duration=%s" % duration,
+            self.get_source_path("sine.wav"),
+        )
+        sources.append(("audio", None, path, None))
+        return sources
+
+    def execute(self, job):
+        """runs the command of the given job and measures it, the
+        :class:`Job` runner interface
+        """
+        import subprocess
+        import time
+
+        arguments = job.launch_arguments
+        job.printer.info("rendered command: %s" % job.format_command())
+        start_time = time.time()
+        process = subprocess.Popen(
+            job.launch_command if arguments is None else arguments,
+            shell=arguments is None,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            errors="replace",
+        )
+        log = process.stderr.read()
+        process.stderr.close()
+        # wait4 returns the resource usage of the process and its children
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        self.measurements[job] = {
+            "wall_time": time.time() - start_time,
+            "cpu_time": usage.ru_utime + usage.ru_stime,
+            # in kilobytes on Linux
+            "peak_rss": usage.ru_maxrss * 1024,
+        }
+        if process.returncode == 0:
+            # only the log of the failed jobs is printed
+            job.printer.buffer = []
+        else:
+            job.printer.write(log)
+        return process.returncode
+
+    def measure(self, converter, source, size, path, frames):
+        """runs the given converter on the given source
+
+        :return: The result as a dictionary.
+        """
+        import copy
+        import shutil
+        import tempfile
+
+        converter = copy.copy(converter)
+        converter.source_path = path
+        converter.target_path = tempfile.mkdtemp(
+            prefix="output_", dir=self.work_path
+        )
+        converter.auto_rename = False
+        converter.incremental = False
+        converter.cache = None
+        converter.stream_copy = False
+        converter.progress = None
+        try:
+            job = converter.prepare_job(path, printer=OutputPrinter(buffered=True))
+            job.runner = self
+            job.run()
+
+            result = {
+                "template": converter.name,
+                "source": source,
+                "size": size,
+                "return_code": job.return_code,
+            }
+            if job.status != Job.DONE:
+                return result
+
+            measurements = self.measurements.pop(job)
+            wall_time = measurements["wall_time"]
+            result.update(measurements)
+            result["fps"] = frames / wall_time if frames else None
+            result["realtime_factor"] = self.duration / wall_time
+            result["output_bytes"] = sum(
+                os.path.getsize(f)
+                for f in MediaConverter.get_sequence_files(job.output_file_full_path)
+            )
+            return result
+        finally:
+            shutil.rmtree(converter.target_path, ignore_errors=True)
+
+    @classmethod
+    def get_ffmpeg_version(cls):
+        """returns the first line of ffmpeg -version"""
+        import subprocess
+
+        try:
+            output = subprocess.run(
+                ["ffmpeg", "-version"],
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+            ).stdout
+        except OSError:
+            return None
+        return output.split("\n")[0]
+
+    def run(self):
+        """runs the benchmark
+
+        :return: The results as a dictionary.
+        """
+        import platform
+        import time
+
+        op = OutputPrinter()
+        sources = self.generate_sources()
+        results = []
+        for converter in self.converters:
+            for source, size, path, frames in sources:
+                extension = os.path.splitext(path)[1].lower()
+                if extension not in converter.file_types:
+                    continue
+                result = self.measure(converter, source, size, path, frames)
+                results.append(result)
+                name = " ".join(filter(None, [converter.name, source, size]))
+                if result["return_code"] != 0:
+                    op.fail("%s: failed" % name)
+                    continue
+                op.ok(
+                    "%s: %s fps, %.2fx realtime, %.2fs cpu, %i MB rss, %i bytes"
+                    % (
+                        name,
+                        "-" if result["fps"] is None else "%.1f" % result["fps"],
+                        result["realtime_factor"],
+                        result["cpu_time"],
+                        result["peak_rss"] // 1048576,
+                        result["output_bytes"],
+                    )
+                )
+
+        return {
+            "media_converter": __version__,
+            "ffmpeg": self.get_ffmpeg_version(),
+            "machine": platform.node(),
+            "cpu_count": os.cpu_count(),
+            "time": time.time(),
+            "duration": self.duration,
+            "results": results,
+        }
+
+    @classmethod
+    def save(cls, results, path):
+        """saves the given results as JSON"""
+        import json
+
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """loads the results from the given JSON file"""
+        import json
+
+        with open(path) as f:
+            return json.load(f)
+
+    @classmethod
+    def compare(cls, old, new, threshold=10):
+        """compares two benchmark results
+
+        :param dict old: The baseline results.
+        :param dict new: The new results.
+        :param float threshold: The change in percent that is a regression.
+        :return: A list of (template, source, size, metric, old value, new
+          value, change in percent) tuples for the metrics that got worse by
+          more than the threshold.
+        """
+        baseline = {
+            (r["template"], r["source"], r["size"]): r for r in old["results"]
+        }
+        regressions = []
+        for result in new["results"]:
+            key = (result["template"], result["source"], result["size"])
+            old_result = baseline.get(key)
+            if old_result is None:
+                continue
+            if old_result["return_code"] == 0 and result["return_code"] != 0:
+                regressions.append(
+                    key + ("return_code", 0, result["return_code"], None)
+                )
+                continue
+            for metric, higher_is_better in cls.metrics.items():
+                old_value = old_result.get(metric)
+                new_value = result.get(metric)
+                if not old_value or new_value is None:
+                    continue
+                change = 100.0 * (new_value - old_value) / old_value
+                if (higher_is_better and change < -threshold) or (
+                    not higher_is_better and change > threshold
+                ):
+                    regressions.append(key + (metric, old_value, new_value, change))
+        return regressions
+
+    @classmethod
+    def print_comparison(cls, regressions, threshold):
+        """prints the regressions found by :meth:`compare`"""
+        op = OutputPrinter()
+        if not regressions:
+            op.ok("no regressions past %s%%" % threshold)
+            return
+        for regression in regressions:
+            name = " ".join(filter(None, regression[:3]))
+            metric, old_value, new_value, change = regression[3:]
+            if change is None:
+                op.fail("%s: started failing" % name)
+                continue
+            op.fail(
+                "%s: %s %.6g -> %.6g (%+.1f%%)"
+                % (name, metric, old_value, new_value, change)
+            )
+        op.warning("%i regressions past %s%%" % (len(regressions), threshold))
+
+
+class MediaConverter(object):
+    """Converts between different media types"""
+
+    def __init__(self, **kwargs):
+
+        name = kwargs.get("name")
+        command = kwargs.get("command")
+        source_path = kwargs.get("source_path")
+        target_path = kwargs.get("target_path")
+        output_file_extension = kwargs.get("output_file_extension")
+        file_types = kwargs.get("file_types")
+        extra_options = kwargs.get("extra_options")
+        auto_rename = kwargs.get("auto_rename", False)
+        jobs = kwargs.get("jobs", 1)
+        cores = kwargs.get("cores")
+        incremental = kwargs.get("incremental", False)
+        cache = kwargs.get("cache")
+        stream_copy = kwargs.get("stream_copy", False)
+        dry_run = kwargs.get("dry_run", False)
+        chunks = kwargs.get("chunks")
+        chunk_duration = kwargs.get("chunk_duration")
+        frame_ranges = kwargs.get("frame_ranges", False)
+        output_file_suffix = kwargs.get("output_file_suffix", "")
+        progress = kwargs.get("progress")
+        gif_prepass = kwargs.get("gif_prepass", False)
+        scheduling = kwargs.get("scheduling")
+        queue = kwargs.get("queue")
+        planner = kwargs.get("planner")
+        plan = kwargs.get("plan", False)
+        timeout = kwargs.get("timeout")
+        stall_timeout = kwargs.get("stall_timeout")
+        retries = kwargs.get("retries", 0)
+        quality = kwargs.get("quality")
+        preview = kwargs.get("preview")
+
+        self.name = name
+        self.command = command
+        if command is not None:
+            # compile the template once, the jobs share it
+            CommandTemplate.compile(command)
+        self.source_path = source_path
+        self.target_path = target_path
+        self.output_file_extension = output_file_extension
+        self._extra_options = None
+        self.extra_options = extra_options
+        self.auto_rename = auto_rename
+        self.jobs = jobs
+        self.cores = cores
+        self.incremental = incremental
+        self._manifest = None
+        self.cache = cache
+        self.stream_copy = stream_copy
+        self.dry_run = dry_run
+        self.chunks = chunks
+        self.chunk_duration = chunk_duration
+        # encode the intra-only image sequences in parallel frame ranges, only
+        # when asked for as the outputs are joined from several encodes
+        self.frame_ranges = frame_ranges
+        # added to the output file names, i.e. to tell apart the outputs of
+        # several templates with the same file extension
+        self.output_file_suffix = output_file_suffix
+        # a ProgressTracker to show the progress of the jobs
+        self.progress = progress
+        # generate the GIF palettes in a cached prepass
+        self.gif_prepass = gif_prepass
+        # the SchedulingPolicy of the jobs
+        self.scheduling = scheduling
+        # the WorkQueue to push the jobs to instead of running them
+        self.queue = queue
+        # the BatchPlanner to run the longest jobs first with
+        self.planner = planner
+        # only print the plan of the planner
+        self.plan = plan
+        # the seconds a job of this template can run, and can run without
+        # making progress, before it is killed
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        # how many times the stalled and crashed jobs are run again
+        self.retries = retries
+        # the QualitySearch to pick the CRF of the jobs with
+        self.quality = quality
+        # the PreviewRenderer to only render the sampled previews with
+        self.preview = preview
+        # output paths of the prepared jobs which are not written yet
+        self._reserved_output_paths = set()
+
+        if file_types is None:
+            file_types = []
+
+        self.file_types = file_types
+
+    def copy(self, **kwargs):
+        """returns a copy of this converter with the given attributes set, the
+        extra options are applied to the command of the copy only, so the
+        converters of the :class:`Manager` can be shared
+        """
+        import copy
+
+        converter = copy.copy(self)
+        converter._manifest = None
+        converter._reserved_output_paths = set()
+        converter.file_types = list(self.file_types)
+        for key, value in kwargs.items():
+            if not hasattr(converter, key):
+                raise TypeError("unknown converter option: %s" % key)
+            setattr(converter, key, value)
+        return converter
+
+    @property
+    def extra_options(self):
+        """Add extra options.
+
+        Setting any pre existing flags here will remove the original flag from
+        the original command
+        """
+        return self._extra_options
+
+    @extra_options.setter
+    def extra_options(self, extra_options):
+        """setter for the extra_options attribute
+
+        :param str extra_options:
+        :return:
+        """
+        if extra_options is not None:
+            import shlex
+
+            # remove any occurrence of the extra options from the original
+            # command, the compiled template is shared so work on a copy
+            template = CommandTemplate(self.command)
+            flags = [
+                flag
+                for flag, _ in FFmpegCommand.parse_options(shlex.split(extra_options))
+                if flag.startswith("-")
+            ]
+            template.remove_options(*flags)
+            template.add_extra_options()
+            self.command = template.command
+            extra_options = extra_options.strip()
+
+        self._extra_options = extra_options
+
+    @classmethod
+    def get_start_number_from_path(cls, path):
+        """returns the start number from the given pattern. None if it is not
+        applicable.
+
+        :param path:
+        :return:
+        """
+        sequence = cls.get_sequence(path)
+        if sequence is not None:
+            return "%0*i" % (sequence.padding, sequence.first)
+
+    @classmethod
+    def get_sequence(cls, path):
+        """returns the :class:`ImageSequence` of the given pattern, None if it
+        is not an image sequence or there are no frames
+        """
+        import re
+
+        if re.search(r"[._]%[0-9]+d", path) is None:
+            return None
+
+        # normalize %4d to %04d
+        file_name = re.sub(
+            r"([._])%0?([0-9]+)d", r"\1%0\2d", os.path.basename(path)
+        )
+        index = SequenceIndex.get(os.path.dirname(path) or ".")
+        return index.get_sequence(file_name)
+
+    @classmethod
+    def get_sequence_files(cls, path):
+        """returns the sorted list of existing files of the given path, which
+        can be an image sequence pattern like ``name.%04d.exr`` or a file.
+
+        :param str path:
+        :return:
+        """
+        import re
+
+        if re.search(r"[._]%[0-9]+d", path) is None:
+            return [path] if os.path.exists(path) else []
+
+        sequence = cls.get_sequence(path)
+        if sequence is None:
+            return []
+        folder = os.path.dirname(path)
+        return [os.path.join(folder, f) for f in sequence.file_names()]
+
+    def prepare_job(self, f, printer=None):
+        """prepares the conversion of only one file without running it
+
+        :param str f: The source file or image sequence pattern.
+        :param OutputPrinter printer: The printer to report to, a new one is
+          created if skipped.
+        :return: A :class:`Job`, its status is ``Job.SKIPPED`` if there is
+          nothing to do for this file.
+        """
+        op = printer or OutputPrinter()
+
+        source_file_full_path = f
+        op.info("source_file_full_path: %s" % source_file_full_path)
+
+        # get file extension
+        source_file_basename, source_file_extension = os.path.splitext(
+            os.path.basename(f)
+        )
+
+        # if this is an image sequence try to find the start_number
+        import re
+
+        # do not alter self.command, every job gets its own copy
+        command = self.command
+        is_image_sequence = (
+            re.match(r".*[._]%[0-9]+d.*", source_file_basename) is not None
+        )
+        if is_image_sequence:
+            sequence = self.get_sequence(source_file_full_path)
+            if sequence is not None:
+                op.info(
+                    "frame range: %i-%i (%i frames, %i gaps)"
+                    % (
+                        sequence.first,
+                        sequence.last,
+                        sequence.count,
+                        len(sequence.gaps),
+                    )
+                )
+                if sequence.gaps:
+                    op.warning(
+                        "the sequence has missing frames, ffmpeg stops at the "
+                        "first one: %s" % source_file_full_path
+                    )
+            start_number = self.get_start_number_from_path(source_file_full_path)
+            # add the start_number to the beginning of the command
+            command = command.replace(
+                "ffmpeg", "ffmpeg -start_number %s" % start_number, 1
+            )
+
+        # remove any %03d or %04d from the source_file_basename
+        source_file_basename = re.sub(r"[._]%[0-9]+d", "", source_file_basename)
+        source_file_extension = source_file_extension.lower()
+        op.info("source_file_basename: %s" % source_file_basename)
+        op.info("source_file_extension: %s" % source_file_extension)
+
+        if self.output_file_suffix:
+            source_file_basename = "%s%s" % (
+                source_file_basename,
+                self.output_file_suffix,
+            )
+
+        if self.output_file_extension in IMAGE_FORMATS:
+            output_file_name = "%s.%s%s" % (
+                source_file_basename,
+                "%04d",
+                self.output_file_extension,
+            )
+        else:
+            output_file_name = "%s%s" % (
+                source_file_basename,
+                self.output_file_extension,
+            )
+        op.info("output_file_name: %s" % output_file_name)
+        op.info("self.target_path: %s" % self.target_path)
+
+        output_file_full_path = os.path.join(self.target_path, output_file_name)
+
+        op.info("output_file_full_path: %s" % output_file_full_path)
+
+        job = Job(
+            converter_name=self.name,
+            command=command,
+            source_file_full_path=source_file_full_path,
+            output_file_full_path=output_file_full_path,
+            extra_options=self.extra_options,
+            printer=op,
+            cache=self.cache,
+            timeout=self.timeout,
+            stall_timeout=self.stall_timeout,
+            retries=self.retries,
+        )
+        if PipeChain.is_chain(command):
+            job.runner = PipeChain()
+
+        # do not run the command if:
+        #    the file has no extension
+        #    the extension is not in the right format
+        #    or there is an file with the same name
+        type_is_matching = True
+        if self.file_types:
+            if (
+                source_file_extension == ""
+                or source_file_extension not in self.file_types
+            ):
+                type_is_matching = False
+
+        if type_is_matching:
+            if self.stream_copy and job.runner is None:
+                decisions = StreamCopyPlanner.plan(job)
+                op.info("stream copy: %s" % StreamCopyPlanner.describe(decisions))
+
+            manifest = self.get_manifest()
+            job.manifest = manifest
+            if (
+                manifest is not None
+                and output_file_full_path not in self._reserved_output_paths
+            ):
+                # the manifest decides if the existing output is usable
+                if manifest.is_up_to_date(job):
+                    job.status = Job.SKIPPED
+                    op.ok("up to date, skipping: %s" % source_file_full_path)
+                elif self.get_sequence_files(output_file_full_path):
+                    job.overwrite = True
+                    op.warning(
+                        "out of date, regenerating: %s" % output_file_full_path
+                    )
+            elif self.auto_rename:
+                # pick the first free name from the index of the target
+                # folder, it is shared by all the converters of this process
+                output_file_name = NameIndex.get(self.target_path).reserve(
+                    output_file_name
+                )
+                job.output_file_full_path = os.path.join(
+                    self.target_path, output_file_name
+                )
+                job.auto_rename = True
+            elif self.output_exists(output_file_full_path):
+                job.status = Job.SKIPPED
+                op.warning("already exists!")
+                op.warning("skipping: %s" % source_file_full_path)
+        else:
+            job.status = Job.SKIPPED
+            op.fail(
+                "file type is not matching: %s -> %s"
+                % (source_file_extension, self.file_types)
+            )
+
+        if job.status == Job.SKIPPED:
+            op.flush()
+        else:
+            self._reserved_output_paths.add(job.output_file_full_path)
+        return job
+
+    def get_manifest(self):
+        """returns the manifest of the target path if the incremental mode is
+        enabled, None otherwise
+        """
+        if not self.incremental:
+            return None
+        if (
+            self._manifest is None
+            or self._manifest.target_path != self.target_path
+        ):
+            self._manifest = Manifest(self.target_path)
+        return self._manifest
+
+    def output_exists(self, path):
+        """returns True if the path exists or it is the output of an already
+        prepared job
+        """
+        return path in self._reserved_output_paths or os.path.exists(path)
+
+    def run_per_file(self, f):
+        """converts only one file"""
+        job = self.prepare_job(f)
+        if job.status == Job.PENDING:
+            self.create_target_path()
+            JobPool(jobs=1, cores=self.cores, scheduling=self.scheduling).run([job])
+        return job
+
+    def create_target_path(self):
+        """creates the target path if it doesn't exist"""
+        try:
+            os.makedirs(self.target_path)
+        except OSError:
+            # path already exists
+            pass
+
+    def collect_source_files(self):
+        """returns the files and image sequence patterns to be converted"""
+        source_path = self.source_path
+        source_files = []
+        if "%" in self.source_path:
+            # this is an image sequence
+            source_files.append(self.source_path)
+        else:
+            if os.path.isdir(source_path):
+                # there could be image sequences in this folder.
+                # so we need to supply a compressed list of files in that situation.
+                index = SequenceIndex.get(source_path)
+                for sequence in index.sequences:
+                    # This is an image sequence run for this whole sequence at once
+                    source_files.append(os.path.join(source_path, sequence.pattern))
+                for f in index.files:
+                    source_files.append(os.path.join(source_path, f))
+
+            elif os.path.isfile(source_path):
+                source_files.append(self.source_path)
+
+        return source_files
+
+    def prepare_jobs(self):
+        """prepares a job for every source file without running any of them"""
+        # buffer the output of each job when running them in parallel
+        buffered = self.jobs > 1
+        self._reserved_output_paths = set()
+        source_files = self.collect_source_files()
+        if MediaProbe.cache is not None and self.uses_probes:
+            self.prefetch(source_files)
+        return [
+            self.prepare_job(f, printer=OutputPrinter(buffered=buffered))
+            for f in source_files
+        ]
+
+    def filter_source_files(self, source_files):
+        """returns the given source files which are of the file types of this
+        converter
+        """
+        if not self.file_types:
+            return source_files
+        return [
+            f
+            for f in source_files
+            if os.path.splitext(f)[-1].lower() in self.file_types
+        ]
+
+    @property
+    def uses_probes(self):
+        """True if a feature reading the info of the sources is enabled, so
+        they are worth probing up front, a plain conversion doesn't need them
+        """
+        return bool(
+            self.stream_copy
+            or self.chunks
+            or self.chunk_duration
+            or self.frame_ranges
+            or self.progress is not None
+            or self.planner is not None
+            or self.quality is not None
+            or self.preview is not None
+        )
+
+    def prefetch(self, source_files):
+        """probes the sources of the matching file types in parallel in to
+        the probe cache and reports the ones that can not be probed up front
+        """
+        op = OutputPrinter()
+        source_files = self.filter_source_files(source_files)
+        for path, info in MediaProbe.cache.prefetch(source_files):
+            if info is None:
+                op.warning("can not be probed: %s" % path)
+
+    def create_runner(self, job):
+        """returns the runner the given job is run with, like a
+        :class:`ChunkedEncoder`, None if it is run with its command
+        """
+        if (
+            self.frame_ranges
+            and self.jobs > 1
+            and FrameRangeEncoder.is_supported(job)
+        ):
+            return FrameRangeEncoder(
+                ranges=self.chunks,
+                range_duration=self.chunk_duration,
+                jobs=self.jobs,
+                cores=self.cores,
+                scheduling=self.scheduling,
+            )
+        if (self.chunks or self.chunk_duration) and ChunkedEncoder.is_supported(job):
+            return ChunkedEncoder(
+                chunks=self.chunks,
+                chunk_duration=self.chunk_duration,
+                jobs=self.jobs,
+                cores=self.cores,
+                scheduling=self.scheduling,
+            )
+        if self.gif_prepass and PaletteEncoder.is_supported(job):
+            return PaletteEncoder()
+        return None
+
+    def print_dry_run_report(self, jobs):
+        """prints what would be done for the given jobs without running them"""
+        op = OutputPrinter()
+        for job in jobs:
+            if job.status != Job.PENDING:
+                continue
+            if self.stream_copy:
+                op.ok(
+                    "%s: %s"
+                    % (
+                        StreamCopyPlanner.describe(job.stream_copy),
+                        job.source_file_full_path,
+                    )
+                )
+            op.info("rendered command: %s" % job.rendered_command)
+
+        if self.stream_copy:
+            pending = [job for job in jobs if job.status == Job.PENDING]
+            remuxed = [
+                job
+                for job in pending
+                if StreamCopyPlanner.describe(job.stream_copy) == "remux"
+            ]
+            op.info(
+                "%i to remux, %i to re-encode"
+                % (len(remuxed), len(pending) - len(remuxed))
+            )
+
+    def search_quality(self, jobs):
+        """picks the CRF of the pending jobs with the quality search, the
+        sources are searched in parallel on ``self.jobs`` workers
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        searched_jobs = [
+            job
+            for job in jobs
+            if job.status == Job.PENDING and QualitySearch.is_supported(job)
+        ]
+        if not searched_jobs:
+            return
+        with ThreadPoolExecutor(max_workers=max(1, self.jobs)) as executor:
+            list(executor.map(self.quality.apply, searched_jobs))
+
+    def run(self):
+        """runs the command
+
+        All the jobs are collected first and then run on a pool of
+        ``self.jobs`` workers.
+
+        :return: The list of :class:`Job` instances.
+        """
+        ProcessWatchdog.reset()
+        jobs = self.prepare_jobs()
+        if self.dry_run:
+            self.print_dry_run_report(jobs)
+            return jobs
+
+        if self.planner is not None and self.plan:
+            self.planner.print_plan(jobs, slots=self.jobs)
+            return jobs
+
+        if self.quality is not None:
+            self.search_quality(jobs)
+
+        if self.preview is not None:
+            # the previews see the runners the full batch would run with
+            for job in jobs:
+                if job.status == Job.PENDING and job.runner is None:
+                    job.runner = self.create_runner(job)
+            return self.preview.run(jobs)
+
+        if any(job.status == Job.PENDING for job in jobs):
+            self.create_target_path()
+
+        if self.queue is not None:
+            # leave the conversion to the workers of the render farm
+            batch = self.queue.push(jobs)
+            OutputPrinter().info(
+                "pushed %i jobs to: %s"
+                % (len([job for job in jobs if job.queue_id]), self.queue.path)
+            )
+            try:
+                self.queue.wait(jobs)
+            finally:
+                # the workers stop polling for this batch
+                self.queue.close_batch(batch)
+            if len(jobs) > 1:
+                JobPool.print_summary(jobs)
+            return jobs
+
+        if self.progress is not None:
+            self.progress.prepare(jobs)
+
+        for job in jobs:
+            if job.status != Job.PENDING or job.runner is not None:
+                continue
+            job.runner = self.create_runner(job)
+            if isinstance(job.runner, (FrameRangeEncoder, ChunkedEncoder)):
+                # encode the long videos and the intra-only image sequences
+                # one by one, each using the whole pool
+                job.run()
+
+        # the pool runs the jobs in the given order
+        ordered_jobs = jobs
+        if self.planner is not None:
+            ordered_jobs = self.planner.order(jobs)
+
+        try:
+            JobPool(jobs=self.jobs, cores=self.cores, scheduling=self.scheduling).run(
+                ordered_jobs
+            )
+        finally:
+            if self.progress is not None:
+                self.progress.close()
+            if self.planner is not None:
+                self.planner.record(jobs)
+
+        if len(jobs) > 1:
+            JobPool.print_summary(jobs)
+        return jobs
+
+
+class Batch(object):
+    """Runs conversions from another program in the same process.
+
+    The jobs of all the submitted conversions share a single pool of
+    workers, the templates of the :class:`Manager` are copied before the
+    options are applied, and nothing is printed, the log of each job is in
+    the ``lines`` of its :class:`QuietPrinter`::
+
+        with Batch(jobs=4) as batch:
+            futures = batch.submit(
+                "youtube", ["a.mov", "b.mov"], target_path="out",
+                extra_options="-crf 20",
+            )
+            for future in futures:
+                job = future.result()
+                print(job.status, job.output_file_full_path, job.elapsed)
+
+    The options handled by :meth:`MediaConverter.run` instead of
+    :meth:`MediaConverter.prepare_job`, like ``dry_run`` or ``preview``, are
+    not supported, the pool settings are given to the batch itself.
+    """
+
+    # the MediaConverter options that only MediaConverter.run handles
+    unsupported_options = [
+        "chunk_duration",
+        "chunks",
+        "cores",
+        "dry_run",
+        "frame_ranges",
+        "gif_prepass",
+        "jobs",
+        "plan",
+        "planner",
+        "preview",
+        "progress",
+        "quality",
+        "queue",
+        "scheduling",
+    ]
+
+    def __init__(self, jobs=1, cores=None, scheduling=None, manager=None):
+        self.manager = manager or Manager()
+        self.pool = JobPool(jobs=jobs, cores=cores, scheduling=scheduling)
+        self.pool.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(wait=exc_type is None)
+
+    def get_converter(self, template, **options):
+        """returns a copy of the converter of the given template with the
+        given options set
+
+        :raises ValueError: If there is no such template.
+        :raises TypeError: If an option is not supported in a batch.
+        """
+        unsupported_options = sorted(set(options) & set(self.unsupported_options))
+        if unsupported_options:
+            raise TypeError(
+                "not supported in a batch: %s" % ", ".join(unsupported_options)
+            )
+        converter = self.manager.get_converter(template)
+        if converter is None:
+            raise ValueError("no converter found: %s" % template)
+        return converter.copy(**options)
+
+    def prepare(self, template, sources, target_path=None, **options):
+        """prepares the jobs of the given sources without running them
+
+        :param str template: The name of the template.
+        :param list sources: The files, image sequence patterns and folders
+          to convert.
+        :param str target_path: The folder of the outputs, the folder of each
+          source if not given.
+        :param options: The attributes of the :class:`MediaConverter`, like
+          ``extra_options`` or ``auto_rename``.
+        :return: The list of :class:`Job` instances, the ones that have
+          nothing to do are ``Job.SKIPPED``.
+        """
+        converter = self.get_converter(template, **options)
+        if isinstance(sources, str):
+            sources = [sources]
+
+        jobs = []
+        for source in sources:
+            converter.source_path = source
+            converter.target_path = target_path
+            if target_path is None:
+                if "%" in source or os.path.isfile(source):
+                    converter.target_path = os.path.dirname(source)
+                else:
+                    converter.target_path = source
+            for f in converter.collect_source_files():
+                job = converter.prepare_job(f, printer=QuietPrinter())
+                if job.status == Job.PENDING:
+                    converter.create_target_path()
+                jobs.append(job)
+        return jobs
+
+    def submit(self, template, sources, target_path=None, **options):
+        """prepares the jobs of the given sources and queues them to the
+        workers, see :meth:`prepare` for the arguments
+
+        :return: A ``concurrent.futures.Future`` for every job, the result of
+          the future is the finished :class:`Job`.
+        """
+        from concurrent.futures import Future
+
+        futures = []
+        for job in self.prepare(template, sources, target_path, **options):
+            if job.status == Job.PENDING:
+                futures.append(self.pool.submit(job))
+            else:
+                future = Future()
+                future.set_result(job)
+                futures.append(future)
+        return futures
+
+    def run(self, template, sources, target_path=None, **options):
+        """runs the conversion of the given sources and waits for it, see
+        :meth:`prepare` for the arguments
+
+        :return: The list of the finished :class:`Job` instances.
+        """
+        return [
+            future.result()
+            for future in self.submit(template, sources, target_path, **options)
+        ]
+
+    def shutdown(self, wait=True):
+        """stops the workers, the queued jobs are still run if ``wait`` is
+        True
+        """
+        self.pool.shutdown(wait=wait)
+
+
+def create_parser():
+    """creates the command line parser"""
+    import argparse
+
+    converter_names = Manager.list_converter_names()
+
+    parser = argparse.ArgumentParser(
+        description="Batch convert media by using templates"
+    )
+    parser.add_argument(
+        "-t",
         "--template",
         required=False,
-        help="The template to use. One of: " "%s" % ", ".join(converter_names),
+        help="The template to use, several templates can be separated with "
+        "commas to decode the sources once for all of them, or chained with "
+        "plus signs, like denoise_normal+prores422hq, to pipe the output of "
+        "each template in to the next one without intermediate files. One of: "
+        "%s" % ", ".join(converter_names),
     )
     parser.add_argument(
         "-i", "--input", required=False, help="The input folder or file"
@@ -824,6 +6964,310 @@ def main():
         action="store_true",
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of files to convert in parallel, 0 uses all the cores.",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--cores",
+        help="The number of cores shared by the parallel jobs. Each job is "
+        "launched with its share of it as -threads. Defaults to all the cores "
+        "when running more than one job.",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--incremental",
+        help="Keep a manifest of the generated files in the output folder and "
+        "only convert the files whose output is missing or out of date. Out of "
+        "date outputs are replaced instead of being renamed.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        help="Look the outputs up in this cache folder before converting and "
+        "store the new outputs in it. Shared between folders and runs.",
+    )
+
+    parser.add_argument(
+        "--cache-max-size",
+        help="The maximum size of the cache, i.e. 500M or 50G. The least "
+        "recently used outputs are removed when it is exceeded.",
+        default="50G",
+    )
+
+    parser.add_argument(
+        "--cache-stats",
+        help="Print the hit rate and bytes saved by the cache and exit.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--stream-copy",
+        help="Probe the sources and copy the streams that are already in the "
+        "target codec instead of re-encoding them.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        help="Print what would be converted, and with --stream-copy which "
+        "files would be remuxed or re-encoded, without converting anything.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--chunks",
+        help="Split each video in to this many chunks at the keyframes, encode "
+        "the chunks in parallel with -j jobs and join them losslessly.",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--chunk-duration",
+        help="Like --chunks but splits the videos in to chunks of this many "
+        "seconds.",
+        type=float,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--timeout",
+        help="Kill the jobs running longer than this many seconds. Several "
+        "templates can have their own timeouts, like youtube=600,vr=1200.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--stall-timeout",
+        help="Kill the jobs which neither print nor grow their output for this "
+        "many seconds, like an ffmpeg stuck reading from network storage.",
+        type=float,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--retries",
+        help="Run the stalled and crashed jobs again this many times, waiting "
+        "longer before every retry.",
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        "--preview",
+        help="Only render this many short windows sampled from every source "
+        "in to a side folder next to the output folder and print the command "
+        "the full conversion will run.",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--preview-duration",
+        help="The duration of the preview windows in seconds.",
+        type=float,
+        default=5.0,
+    )
+
+    parser.add_argument(
+        "--target-quality",
+        help="Pick the highest CRF of the template which still meets this "
+        "quality, like ssim:0.98 or psnr:42, by encoding a few short samples "
+        "of every source. The picked CRF is cached in the user cache folder "
+        "by the source and the template.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--probe-only",
+        help="Only probe the sources of the template in parallel and print "
+        "their duration, codecs, resolution and frame count. The probed info "
+        "is cached in the user cache folder by the path, size and "
+        "modification time of the files. Exits with 1 if any source can not "
+        "be probed.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--frame-ranges",
+        help="Split the image sequences of intra-only templates, like "
+        "image_seq_to_mp4 and prores422*, in to frame ranges encoded in "
+        "parallel with -j jobs. The ranges follow --chunks and "
+        "--chunk-duration.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--gif-prepass",
+        help="Generate the palette of the GIF templates from a downscaled and "
+        "frame sampled copy of the source in a separate pass and cache it per "
+        "source, instead of buffering every frame. Bounce GIFs are built "
+        "without the reverse filter.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--affinity",
+        help="Pin every job to its own set of CPUs, as many as its share of "
+        "the cores.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--numa",
+        help="Like --affinity but keeps the CPUs of each job on a single NUMA "
+        "node.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--cpus",
+        help="The CPUs the jobs are pinned to, like 0-7,16-23. Implies "
+        "--affinity.",
+    )
+
+    parser.add_argument(
+        "--priorities",
+        help="Run the jobs with the nice and ionice values of their template "
+        "category, audio, proxy or mastering, so the long encodes don't starve "
+        "the short ones or the interactive users.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--queue",
+        help="Push the jobs to this shared SQLite queue instead of running "
+        "them, and wait until the workers run them.",
+    )
+
+    parser.add_argument(
+        "--worker",
+        metavar="QUEUE",
+        help="Run the jobs of this shared SQLite queue with -j jobs until it "
+        "is drained. Several workers can run on several hosts.",
+    )
+
+    parser.add_argument(
+        "--lease-time",
+        help="The seconds a worker can go without a heartbeat before its jobs "
+        "are given to other workers.",
+        type=float,
+        default=60,
+    )
+
+    parser.add_argument(
+        "--idle-timeout",
+        help="The seconds a worker started before any jobs are pushed waits "
+        "for them.",
+        type=float,
+        default=60,
+    )
+
+    parser.add_argument(
+        "--worker-timeout",
+        help="The seconds the --queue coordinator waits without any live "
+        "worker before it gives up on the jobs that are not run.",
+        type=float,
+        default=600,
+    )
+
+    parser.add_argument(
+        "--longest-first",
+        help="Probe the sources, estimate the cost of the jobs from the speed "
+        "of the templates in the earlier runs and start the most costly ones "
+        "first.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--plan",
+        help="Print the estimated cost and order of the jobs and the total "
+        "time of the batch without converting anything.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--watch",
+        help="Keep watching the input folder and convert the new files and "
+        "image sequences as they appear.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--settle",
+        help="In watch mode, the seconds a file or image sequence should stay "
+        "unchanged before it is converted.",
+        type=float,
+        default=5,
+    )
+
+    parser.add_argument(
+        "-p",
+        "--progress",
+        help="Show the progress, speed and ETA of the jobs and the whole batch.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--progress-json",
+        help="Write the progress of the jobs as JSON lines to this file, - for "
+        "the standard output.",
+    )
+
+    parser.add_argument(
+        "--benchmark",
+        metavar="RESULTS",
+        help="Run the templates given with -t, or all of them, on generated "
+        "test media and save the encode fps, realtime factor, CPU time, peak "
+        "RSS and output size to this JSON file. The test media is kept in the "
+        "-o folder, or in the user cache.",
+    )
+
+    parser.add_argument(
+        "--benchmark-sizes",
+        help="The comma separated sizes of the benchmark test media, 720p, "
+        "1080p, 4k or WxH.",
+        default="720p",
+    )
+
+    parser.add_argument(
+        "--benchmark-duration",
+        help="The duration of the benchmark test media in seconds.",
+        type=float,
+        default=5,
+    )
+
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="Compare two benchmark results and exit with 1 if any template "
+        "got slower or bigger by more than the --threshold.",
+    )
+
+    parser.add_argument(
+        "--threshold",
+        help="The change in percent that --compare reports as a regression.",
+        type=float,
+        default=10,
+    )
+
+    parser.add_argument(
+        "--completion",
+        help="Print the version, templates and options for the shell "
+        "completion script and exit.",
+        action="store_true",
+    )
+
     parser.add_argument(
         "-c", "--command-info", help="Print command info.", action="store_true"
     )
@@ -836,12 +7280,83 @@ def main():
         required=False,
     )
 
+    return parser
+
+
+def parse_timeout(value, converter_name):
+    """returns the timeout of the given template from the --timeout value,
+    which is either the seconds for all the templates or a comma separated
+    list of template=seconds pairs
+    """
+    if not value:
+        return None
+    if "=" not in value:
+        return float(value)
+    for pair in value.split(","):
+        name, _, seconds = pair.partition("=")
+        if name.strip() == converter_name:
+            return float(seconds)
+    return None
+
+
+def print_completion():
+    """prints what the shell completion script needs, without creating any
+    converter
+
+    The first line is the version and the path and modification time of this
+    module, the completion script caches the rest until they change. The
+    second line is the template names and the third line the options.
+    """
+    module_path = os.path.abspath(__file__)
+    print(
+        "%s %s %i"
+        % (__version__, module_path, int(os.path.getmtime(module_path)))
+    )
+    print(" ".join(Manager.list_converter_names()))
+    parser = create_parser()
+    print(
+        " ".join(
+            option
+            for action in parser._actions
+            for option in action.option_strings
+            if option.startswith("--")
+        )
+    )
+
+
+def main():
+    """The main function"""
+    # answer the shell completion before importing or creating anything else,
+    # it runs on every Tab press
+    arguments = sys.argv[1:]
+    if arguments in [["-t", "get_converters"], ["--template", "get_converters"]]:
+        print(" ".join(Manager.list_converter_names()))
+        return
+    if arguments == ["--completion"]:
+        print_completion()
+        return
+
+    try:
+        from colorama import init
+
+        init()
+    except ImportError:
+        pass
+
+    # create a manager, the converters are created when they are used
+    manager = Manager()
+    converter_names = manager.list_converter_names()
+
+    parser = create_parser()
     args = parser.parse_args()
 
     converter_name = args.template
     source_path = args.input
     target_path = args.output
     auto_rename = args.auto_rename
+    jobs = args.jobs
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
     command_info = args.command_info
     version_info_query = args.version
 
@@ -849,10 +7364,87 @@ def main():
         print(" ".join(converter_names))
         sys.exit(0)
 
+    if args.completion:
+        print_completion()
+        sys.exit(0)
+
     if version_info_query:
         print("media_converter %s" % __version__)
         sys.exit(0)
 
+    cache = None
+    if args.cache_dir:
+        cache = OutputCache(
+            args.cache_dir, max_size=OutputCache.parse_size(args.cache_max_size)
+        )
+
+    if args.cache_stats:
+        if cache is None:
+            print("media_converter: error: --cache-stats needs --cache-dir")
+            sys.exit(-1)
+        cache.print_stats()
+        sys.exit(0)
+
+    scheduling = None
+    if args.affinity or args.numa or args.cpus or args.priorities:
+        scheduling = SchedulingPolicy(
+            affinity=args.affinity,
+            numa=args.numa,
+            priorities=args.priorities,
+            cpus=SchedulingPolicy.parse_cpu_list(args.cpus) if args.cpus else None,
+        )
+
+    # keep the probed info of the sources between the runs
+    MediaProbe.cache = ProbeCache()
+
+    if args.worker:
+        worker = QueueWorker(
+            WorkQueue(args.worker, lease_time=args.lease_time),
+            jobs=jobs,
+            cores=args.cores,
+            scheduling=scheduling,
+            idle_timeout=args.idle_timeout,
+        )
+        finished_jobs = worker.run()
+        if any(job.status == Job.FAILED for job in finished_jobs):
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.compare:
+        threshold = args.threshold
+        regressions = Benchmark.compare(
+            Benchmark.load(args.compare[0]),
+            Benchmark.load(args.compare[1]),
+            threshold=threshold,
+        )
+        Benchmark.print_comparison(regressions, threshold)
+        sys.exit(1 if regressions else 0)
+
+    if args.benchmark:
+        if converter_name:
+            converters = [
+                manager.get_converter(name.strip())
+                for name in converter_name.split(",")
+            ]
+            if not all(converters):
+                print("no converter found")
+                sys.exit(-1)
+        else:
+            converters = manager.converters
+        for converter in converters:
+            converter.extra_options = args.extra_options.replace("\\-", "-")
+        benchmark = Benchmark(
+            converters,
+            target_path or get_user_cache_path("benchmark"),
+            sizes=args.benchmark_sizes.split(","),
+            duration=args.benchmark_duration,
+        )
+        results = benchmark.run()
+        Benchmark.save(results, args.benchmark)
+        if any(result["return_code"] != 0 for result in results["results"]):
+            sys.exit(1)
+        sys.exit(0)
+
     if not converter_name:
         parser.print_usage()
         print(
@@ -867,21 +7459,126 @@ def main():
             else:
                 target_path = source_path
 
-    # find the converter
-    converter = manager.get_converter(converter_name)
-    assert isinstance(converter, MediaConverter)
+    # find the converters, several templates can be given separated with commas
+    converters = [
+        manager.get_converter(name.strip()) for name in converter_name.split(",")
+    ]
 
-    if converter:
+    if converters and all(converters):
         if command_info:
-            print(converter.name)
-            print(converter.command)
+            for converter in converters:
+                print(converter.name)
+                print(converter.command)
             return
         # do conversion
-        converter.source_path = source_path
-        converter.target_path = target_path
-        converter.extra_options = args.extra_options.replace("\\-", "-")
-        converter.auto_rename = auto_rename
-        converter.run()
+        progress = None
+        if args.progress or args.progress_json:
+            progress = ProgressTracker(
+                show=args.progress, json_path=args.progress_json
+            )
+
+        planner = None
+        if args.longest_first or args.plan:
+            planner = BatchPlanner()
+
+        quality = None
+        if args.target_quality:
+            try:
+                metric, target = QualitySearch.parse_target(args.target_quality)
+            except ValueError as e:
+                print("media_converter: error: --target-quality: %s" % e)
+                sys.exit(-1)
+            quality = QualitySearch(metric=metric, target=target)
+
+        preview = None
+        if args.preview is not None:
+            if args.preview < 1 or args.preview_duration <= 0:
+                print(
+                    "media_converter: error: --preview: needs at least 1 window "
+                    "of a positive duration"
+                )
+                sys.exit(-1)
+            preview = PreviewRenderer(
+                samples=args.preview,
+                sample_duration=args.preview_duration,
+                jobs=jobs,
+                cores=args.cores,
+                scheduling=scheduling,
+            )
+
+        for converter in converters:
+            converter.source_path = source_path
+            converter.target_path = target_path
+            converter.extra_options = args.extra_options.replace("\\-", "-")
+            converter.auto_rename = auto_rename
+            converter.jobs = jobs
+            converter.cores = args.cores
+            converter.incremental = args.incremental
+            converter.cache = cache
+            converter.stream_copy = args.stream_copy
+            converter.dry_run = args.dry_run
+            converter.chunks = args.chunks
+            converter.chunk_duration = args.chunk_duration
+            converter.frame_ranges = args.frame_ranges
+            converter.progress = progress
+            converter.gif_prepass = args.gif_prepass
+            converter.scheduling = scheduling
+            converter.timeout = (
+                parse_timeout(args.timeout, converter.name) or converter.timeout
+            )
+            converter.stall_timeout = args.stall_timeout
+            converter.retries = args.retries
+            converter.quality = quality
+            converter.preview = preview
+            if args.longest_first or args.plan:
+                converter.planner = planner
+                converter.plan = args.plan
+            if args.queue:
+                converter.queue = WorkQueue(
+                    args.queue,
+                    lease_time=args.lease_time,
+                    worker_timeout=args.worker_timeout,
+                )
+
+        if args.probe_only:
+            source_files = []
+            for converter in converters:
+                for f in converter.filter_source_files(
+                    converter.collect_source_files()
+                ):
+                    if f not in source_files:
+                        source_files.append(f)
+            failed = MediaProbe.cache.print_table(source_files)
+            sys.exit(1 if failed else 0)
+
+        if args.watch:
+            if len(converters) > 1 or not os.path.isdir(source_path or ""):
+                print(
+                    "media_converter: error: --watch needs a single template "
+                    "and an input folder"
+                )
+                sys.exit(-1)
+            jobs = FolderWatcher(converters[0], settle_time=args.settle).run()
+            if any(job.status == Job.FAILED for job in jobs):
+                sys.exit(1)
+            return
+
+        if len(converters) > 1 and preview is None:
+            # decode the sources once for all the templates
+            converters = [
+                MultiTemplateConverter(
+                    converters, jobs=jobs, cores=args.cores, dry_run=args.dry_run
+                )
+            ]
+        try:
+            jobs = []
+            for converter in converters:
+                jobs += converter.run()
+        except KeyboardInterrupt:
+            OutputPrinter().fail("cancelled, the running jobs are killed")
+            sys.exit(130)
+        if any(job.status == Job.FAILED for job in jobs):
+            sys.exit(1)
     else:
         print("no converter found")
         sys.exit(-1)
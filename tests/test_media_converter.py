@@ -92,3 +92,1745 @@ def test_start_number_is_generated_correctly():
         '-vcodec libx264 -vf format=yuv420p -g 1 -b:v 20480k ' \
         '-an {extra_options} ' \
         '"{output_file_full_path}"'
+
+
+def test_run_with_multiple_jobs_collects_exit_status(tmp_path, monkeypatch):
+    """testing if running with multiple jobs converts every file and collects
+    the exit status of each job
+    """
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import Job, MediaConverter
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    for i in range(4):
+        (source_path / ('file%i.txt' % i)).write_text('data %i' % i)
+    (source_path / 'broken.bad').write_text('')
+
+    converter = MediaConverter(
+        name='copy',
+        # fails for the empty file
+        command='grep -q data "{input_file_full_path}" && '
+                'cp "{input_file_full_path}" "{output_file_full_path}"',
+        output_file_extension='.out',
+        source_path=str(source_path),
+        target_path=str(tmp_path / 'target'),
+        jobs=3,
+    )
+    jobs = converter.run()
+
+    assert len(jobs) == 5
+    assert sorted(job.status for job in jobs) == \
+        [Job.DONE] * 4 + [Job.FAILED]
+    for job in jobs:
+        if job.status == Job.DONE:
+            assert job.return_code == 0
+            assert open(job.output_file_full_path).read() == \
+                open(job.source_file_full_path).read()
+        else:
+            assert job.return_code != 0
+            assert job.source_file_full_path.endswith('broken.bad')
+
+
+def test_core_budget_splits_cores_between_jobs():
+    """testing if the core budget splits the cores between the running jobs
+    and gives the freed cores to the last jobs
+    """
+    from media_converter import CoreBudget, Job, Manager
+    manager = Manager()
+
+    def create_job(converter_name):
+        converter = manager.get_converter(converter_name)
+        return Job(
+            converter_name=converter.name,
+            command=converter.command,
+            source_file_full_path='input.mov',
+            output_file_full_path='output%s' % converter.output_file_extension,
+            extra_options='',
+        )
+
+    prores_job = create_job('prores422hq')
+    audio_job = create_job('audio_to_wav')
+    assert CoreBudget.get_codec_family(prores_job) == 'prores'
+    assert CoreBudget.get_codec_family(audio_job) == 'audio'
+
+    budget = CoreBudget(cores=16, slots=4)
+    # 10 jobs are waiting, every slot gets a quarter of the cores
+    assert budget.acquire(prores_job, 10) == 4
+    assert budget.acquire(prores_job, 9) == 4
+    # audio jobs are single threaded
+    assert budget.acquire(audio_job, 8) == 1
+    # the queue is drained, the last job gets all the free cores
+    assert budget.acquire(prores_job, 1) == 7
+
+    # the thread count is injected in to the rendered command
+    prores_job.threads = 4
+    arguments = prores_job.launch_arguments
+    assert arguments[:7] == [
+        'ffmpeg', '-threads', '4', '-filter_threads', '4', '-i', 'input.mov'
+    ]
+    assert arguments[-3:] == ['-threads', '4', 'output.mov']
+    assert arguments.count('-threads') == 2
+
+
+def test_incremental_run_only_converts_changed_files(tmp_path, monkeypatch):
+    """testing if the incremental mode skips the up to date outputs and
+    converts only the changed sources again
+    """
+    import os
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import Job, MediaConverter
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    for i in range(3):
+        (source_path / ('file%i.txt' % i)).write_text('data %i' % i)
+
+    def run(extra_options=''):
+        converter = MediaConverter(
+            name='copy',
+            command='cp {extra_options} "{input_file_full_path}" '
+                    '"{output_file_full_path}"',
+            output_file_extension='.out',
+            source_path=str(source_path),
+            target_path=str(tmp_path / 'target'),
+            incremental=True,
+        )
+        # do not parse the command as an ffmpeg command
+        converter._extra_options = extra_options
+        jobs = converter.run()
+        return sorted(
+            os.path.basename(job.source_file_full_path)
+            for job in jobs if job.status == Job.DONE
+        )
+
+    assert run() == ['file0.txt', 'file1.txt', 'file2.txt']
+    assert run() == []
+
+    # changing the source
+    (source_path / 'file1.txt').write_text('new data')
+    assert run() == ['file1.txt']
+    assert (tmp_path / 'target' / 'file1.out').read_text() == 'new data'
+
+    # an output that is changed after it is recorded
+    (tmp_path / 'target' / 'file2.out').write_text('partial')
+    assert run() == ['file2.txt']
+
+    # changing the extra options
+    assert run(extra_options='-p') == ['file0.txt', 'file1.txt', 'file2.txt']
+    assert run(extra_options='-p') == []
+
+    # a failed rebuild keeps the previous outputs
+    assert run(extra_options='--no-such-option') == []
+    assert (tmp_path / 'target' / 'file0.out').read_text() == 'data 0'
+    assert (tmp_path / 'target' / 'file1.out').read_text() == 'new data'
+
+
+def test_output_cache_is_shared_between_folders(tmp_path, monkeypatch):
+    """testing if the output cache reuses the outputs of the same content
+    converted with the same command and evicts the least recently used ones
+    """
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'user_cache'))
+    from media_converter import Job, MediaConverter, OutputCache
+    cache = OutputCache(str(tmp_path / 'cache'), max_size=20)
+
+    def run(source_path, target_path):
+        converter = MediaConverter(
+            name='copy',
+            command='cp "{input_file_full_path}" "{output_file_full_path}"',
+            output_file_extension='.out',
+            source_path=str(source_path),
+            target_path=str(target_path),
+            cache=cache,
+        )
+        return converter.run()
+
+    for folder in ['a', 'b', 'c']:
+        source_path = tmp_path / folder
+        source_path.mkdir()
+        (source_path / 'file1.txt').write_text('same content')
+    (tmp_path / 'c' / 'file1.txt').write_text('other content')
+
+    run(tmp_path / 'a', tmp_path / 'a_out')
+    jobs = run(tmp_path / 'b', tmp_path / 'b_out')
+    assert jobs[0].status == Job.DONE
+    assert (tmp_path / 'b_out' / 'file1.out').read_text() == 'same content'
+
+    stats = cache.get_stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['bytes_saved'] == len('same content')
+
+    # the two outputs do not fit in to 20 bytes, the least recently used one
+    # is evicted
+    run(tmp_path / 'c', tmp_path / 'c_out')
+    stats = cache.get_stats()
+    assert stats['entries'] == 1
+    assert stats['size'] == len('other content')
+
+
+def test_stream_copy_planner_copies_compatible_streams():
+    """testing if the stream copy planner switches only the streams that are
+    already in the target codec to stream copy
+    """
+    from media_converter import Job, Manager, StreamCopyPlanner
+    manager = Manager()
+
+    def plan(converter_name, video_codec, audio_codec):
+        converter = manager.get_converter(converter_name)
+        job = Job(
+            converter_name=converter.name,
+            command=converter.command,
+            source_file_full_path='input.mp4',
+            output_file_full_path='output%s' % converter.output_file_extension,
+            extra_options='',
+        )
+        info = {'streams': [
+            {'codec_type': 'video', 'codec_name': video_codec},
+            {'codec_type': 'audio', 'codec_name': audio_codec},
+        ]}
+        return StreamCopyPlanner.plan(job, info), job
+
+    # h264 phone footage through to_mp4 is only remuxed
+    decisions, job = plan('to_mp4', 'h264', 'aac')
+    assert decisions == {'video': 'copy', 'audio': 'copy'}
+    assert job.rendered_command == \
+        'ffmpeg -i "input.mp4" -acodec copy -c:v copy "output.mp4"'
+
+    # hevc is re-encoded
+    decisions, job = plan('to_mp4', 'hevc', 'aac')
+    assert decisions == {'video': 'encode', 'audio': 'copy'}
+    assert '-crf 15' in job.rendered_command
+
+    # filtered streams are always re-encoded
+    decisions, job = plan('youtube', 'h264', 'aac')
+    assert decisions == {'video': 'encode', 'audio': 'encode'}
+
+    # only the audio goes in to a wav file
+    decisions, job = plan('extract_audio', 'h264', 'pcm_s16le')
+    assert decisions == {'video': None, 'audio': 'copy'}
+    assert StreamCopyPlanner.describe(decisions) == 'remux'
+
+
+def test_chunked_encoding_matches_single_process_output(tmp_path, monkeypatch):
+    """testing if encoding a video in parallel chunks generates the same
+    number of frames and the same duration with the single process output,
+    and the filters keeping state between the frames are not chunked
+    """
+    import shutil
+    import subprocess
+    import pytest
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import ChunkedEncoder, Job, Manager
+
+    def create_job(command):
+        return Job(
+            command=command,
+            source_file_full_path=str(tmp_path / 'source.mov'),
+            output_file_full_path=str(tmp_path / 'output.mp4'),
+        )
+
+    manager = Manager()
+    for name in ['30_to_24_motion_detection', 'denoise_normal']:
+        job = create_job(manager.get_converter(name).command)
+        assert not ChunkedEncoder.is_supported(job)
+    for vf in ['"select=gt(scene\\,0.4),setpts=N/FRAME_RATE/TB"',
+               'minterpolate=fps=60', 'tblend=all_mode=average']:
+        job = create_job(
+            'ffmpeg -i "{input_file_full_path}" -c:v libx264 -vf %s '
+            '"{output_file_full_path}"' % vf
+        )
+        assert not ChunkedEncoder.is_supported(job)
+    job = create_job(
+        'ffmpeg -i "{input_file_full_path}" -c:v libx264 '
+        '-vf "[in] scale=1280:-2, format=yuv420p[out]" '
+        '"{output_file_full_path}"'
+    )
+    assert ChunkedEncoder.is_supported(job)
+
+    if not shutil.which('ffmpeg') or not shutil.which('ffprobe'):
+        pytest.skip('ffmpeg is not available')
+
+    source = str(tmp_path / 'source.mp4')
+    subprocess.check_call([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi',
+        '-i', 'testsrc2=duration=6:size=160x120:rate=25',
+        '-f', 'lavfi', '-i', 'sine=duration=6',
+        '-c:v', 'libx264', '-g', '25', '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+        '-shortest', source
+    ])
+
+    def convert(target_path, **kwargs):
+        converter = Manager().get_converter('youtube')
+        converter.source_path = source
+        converter.target_path = str(tmp_path / target_path)
+        converter.extra_options = ''
+        for key, value in kwargs.items():
+            setattr(converter, key, value)
+        jobs = converter.run()
+        assert jobs[0].status == Job.DONE
+        output = subprocess.check_output([
+            'ffprobe', '-v', 'error', '-count_frames',
+            '-show_entries', 'stream=codec_type,nb_read_frames',
+            '-show_entries', 'format=duration', '-of', 'compact',
+            jobs[0].output_file_full_path
+        ])
+        return output.decode()
+
+    assert convert('chunked', chunks=3, jobs=3) == convert('single')
+
+
+def test_multiple_templates_are_merged_in_to_one_command(
+        tmp_path, monkeypatch):
+    """testing if several templates for the same source are merged in to a
+    single ffmpeg command with a split filter graph
+    """
+    import os
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import (
+        Manager, MultiOutputRunner, MultiTemplateConverter
+    )
+    source = tmp_path / 'master.mov'
+    source.write_text('')
+    manager = Manager()
+    converters = []
+    for name in ['youtube', 'whatsapp_720p', 'extract_audio']:
+        converter = manager.get_converter(name)
+        converter.source_path = str(source)
+        converter.target_path = str(tmp_path)
+        converters.append(converter)
+
+    multi_converter = MultiTemplateConverter(converters)
+    all_jobs, jobs_to_run = multi_converter.prepare_jobs()
+    assert len(all_jobs) == 3
+    assert len(jobs_to_run) == 1
+    assert isinstance(jobs_to_run[0].runner, MultiOutputRunner)
+    # the outputs with the same extension are not overwriting each other
+    assert sorted(
+        os.path.basename(job.output_file_full_path) for job in all_jobs
+    ) == ['master.mp4', 'master.wav', 'master_whatsapp_720p.mp4']
+
+    arguments = jobs_to_run[0].runner.create_arguments()
+    # decoded once
+    assert arguments.count('-i') == 1
+    filter_graph = arguments[arguments.index('-filter_complex') + 1]
+    assert filter_graph == \
+        '[0:v]split=2[v0][v1];' \
+        '[v0]format=yuv420p[o0];' \
+        '[v1]scale=1280:-2, format=yuv420p[o1]'
+    assert '-vf' not in arguments
+    assert arguments[-3:] == [
+        '-map', '0:a:0?', str(tmp_path / 'master.wav')
+    ]
+
+
+def test_merged_templates_with_stream_copy_and_a_warm_cache(
+        tmp_path, monkeypatch):
+    """testing if the stream copied outputs are mapped from the input when
+    the templates are merged, and the jobs with an output cache are run on
+    their own so a warm cache finishes every one of them
+    """
+    import os
+    import shutil
+    import subprocess
+    import pytest
+    if not shutil.which('ffmpeg') or not shutil.which('ffprobe'):
+        pytest.skip('ffmpeg is not available')
+
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'user_cache'))
+    from media_converter import (
+        Job, Manager, MultiOutputRunner, MultiTemplateConverter, OutputCache
+    )
+    source = str(tmp_path / 'master.mp4')
+    subprocess.check_call([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi',
+        '-i', 'testsrc2=duration=1:size=160x120:rate=25',
+        '-f', 'lavfi', '-i', 'sine=duration=1',
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-c:a', 'aac', source
+    ])
+
+    def convert(target_path, **kwargs):
+        manager = Manager()
+        converters = []
+        for name in ['to_mp4', 'whatsapp_720p']:
+            converter = manager.get_converter(name)
+            converter.source_path = source
+            converter.target_path = str(tmp_path / target_path)
+            converter.extra_options = ''
+            for key, value in kwargs.items():
+                setattr(converter, key, value)
+            converters.append(converter)
+        return MultiTemplateConverter(converters).run()
+
+    jobs = convert('copied', stream_copy=True)
+    assert [job.status for job in jobs] == [Job.DONE, Job.DONE]
+    assert isinstance(jobs[0].runner, MultiOutputRunner)
+    arguments = jobs[0].runner.create_arguments()
+    copied = arguments[:arguments.index(jobs[0].output_file_full_path)]
+    assert copied[copied.index('-c:v') + 1] == 'copy'
+    assert '0:v:0?' in copied
+
+    cache = OutputCache(str(tmp_path / 'cache'))
+    convert('cold', cache=cache)
+    jobs = convert('warm', cache=cache)
+    assert [(job.status, job.cache_hit) for job in jobs] == \
+        [(Job.DONE, True), (Job.DONE, True)]
+    assert sorted(os.listdir(str(tmp_path / 'warm'))) == \
+        ['master.mp4', 'master_whatsapp_720p.mp4']
+    cache.close()
+
+
+def test_sequence_index_is_built_once_per_folder_modification(
+        tmp_path, monkeypatch):
+    """testing if the sequence index groups the frames in to sequences with
+    their frame ranges and gaps, and is only rebuilt when the folder changes
+    """
+    import os
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import MediaConverter, SequenceIndex
+    folder = tmp_path / 'renders'
+    folder.mkdir()
+    for frame in list(range(1001, 1011)) + list(range(1015, 1021)):
+        (folder / ('shot.%04i.exr' % frame)).write_text('')
+    for frame in range(1, 4):
+        (folder / ('plate_%04i.exr' % frame)).write_text('')
+    (folder / 'clip.0001.mov').write_text('')
+
+    index = SequenceIndex.get(str(folder))
+    assert index.files == ['clip.0001.mov']
+    assert len(index.sequences) == 2
+    assert index.sequences[0].pattern == 'plate_%04d.exr'
+    assert (index.sequences[0].first, index.sequences[0].last) == (1, 3)
+    assert MediaConverter.get_sequence_files(
+        str(folder / 'plate_%04d.exr')
+    ) == [str(folder / ('plate_%04i.exr' % frame)) for frame in range(1, 4)]
+    sequence = index.sequences[1]
+    assert sequence.pattern == 'shot.%04d.exr'
+    assert (sequence.first, sequence.last) == (1001, 1020)
+    assert sequence.gaps == [[1011, 1014]]
+    assert sequence.count == 16
+    assert MediaConverter.get_start_number_from_path(
+        str(folder / 'shot.%04d.exr')
+    ) == '1001'
+
+    # the folder is not listed again, neither in this process nor from the
+    # cache file in another one, however often the sequences are looked up
+    def scandir(path):
+        raise AssertionError('listed again')
+    monkeypatch.setattr(os, 'scandir', scandir)
+    SequenceIndex._indices.clear()
+    assert SequenceIndex.get(str(folder)).sequences[1].to_dict() == \
+        sequence.to_dict()
+    for _ in range(3):
+        assert MediaConverter.get_start_number_from_path(
+            str(folder / 'plate_%04d.exr')
+        ) == '0001'
+
+    # adding a frame changes the folder
+    monkeypatch.undo()
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    (folder / 'shot.0999.exr').write_text('')
+    os.utime(str(folder), ns=(0, os.stat(str(folder)).st_mtime_ns + 1000))
+    assert SequenceIndex.get(str(folder)).sequences[1].first == 999
+
+
+def test_watcher_submits_files_after_they_settle(tmp_path, monkeypatch):
+    """testing if the folder watcher submits the new files only after their
+    size stops changing and each of them only once
+    """
+    import time
+    import threading
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import FolderWatcher, Job, MediaConverter
+    source_path = tmp_path / 'ingest'
+    source_path.mkdir()
+    converter = MediaConverter(
+        name='copy',
+        command='cp "{input_file_full_path}" "{output_file_full_path}"',
+        output_file_extension='.out',
+        file_types=['.txt'],
+        source_path=str(source_path),
+        target_path=str(tmp_path / 'target'),
+        jobs=2,
+    )
+    watcher = FolderWatcher(converter, settle_time=0.3, poll_interval=0.05)
+
+    # the scan alone decides when a file is settled
+    (source_path / 'growing.txt').write_text('a')
+    assert watcher.scan(100.0) == []
+    (source_path / 'growing.txt').write_text('abc')
+    assert watcher.scan(100.2) == []
+    assert watcher.scan(100.4) == []
+    assert watcher.scan(100.6) == [str(source_path / 'growing.txt')]
+    assert watcher.scan(101.0) == []
+
+    # the whole loop
+    watcher = FolderWatcher(converter, settle_time=0.3, poll_interval=0.05)
+    thread = threading.Thread(target=watcher.run)
+    thread.start()
+    try:
+        (source_path / 'dropped.txt').write_text('new file')
+        deadline = time.time() + 10
+        while time.time() < deadline and not all(
+            (tmp_path / 'target' / name).exists()
+            for name in ['growing.out', 'dropped.out']
+        ):
+            time.sleep(0.05)
+    finally:
+        watcher.stop()
+        thread.join()
+
+    assert sorted(job.status for job in watcher.jobs) == [Job.DONE] * 2
+    assert (tmp_path / 'target' / 'dropped.out').read_text() == 'new file'
+
+
+def test_progress_is_parsed_from_ffmpeg_progress_output(tmp_path, monkeypatch):
+    """testing if the -progress output of ffmpeg is turned in to job and
+    batch progress records
+    """
+    import json
+    import os
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import (
+        Job, MediaConverter, MultiTemplateConverter, ProgressTracker
+    )
+
+    # a fake ffmpeg, printing two progress blocks for a 10 second source
+    bin_path = tmp_path / 'bin'
+    bin_path.mkdir()
+    ffmpeg = bin_path / 'ffmpeg'
+    ffmpeg.write_text(
+        '#!/bin/sh\n'
+        'echo "frame=120\nfps=60.0\nspeed=2.5x\nout_time_us=5000000\n'
+        'progress=continue"\n'
+        'echo "frame=240\nfps=60.0\nspeed=2.5x\nout_time_us=10000000\n'
+        'progress=end"\n'
+        'echo "log line" >&2\n'
+        'for last; do :; done\n'
+        'touch "$last"\n'
+    )
+    ffmpeg.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (bin_path, os.environ['PATH']))
+    monkeypatch.setattr(
+        ProgressTracker, 'get_duration', classmethod(lambda cls, job: 10.0)
+    )
+
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    (source_path / 'clip.mov').write_text('not really a movie')
+    json_path = tmp_path / 'progress.jsonl'
+    converter = MediaConverter(
+        name='fake',
+        command='ffmpeg -i "{input_file_full_path}" "{output_file_full_path}"',
+        output_file_extension='.mp4',
+        file_types=['.mov'],
+        source_path=str(source_path),
+        target_path=str(tmp_path / 'target'),
+        progress=ProgressTracker(show=False, json_path=str(json_path)),
+    )
+    jobs = converter.run()
+
+    assert [job.status for job in jobs] == [Job.DONE]
+    records = [json.loads(line) for line in json_path.read_text().splitlines()]
+    assert [r['event'] for r in records] == [
+        'start', 'progress', 'progress', 'end'
+    ]
+    assert records[1]['percent'] == 50.0
+    assert records[1]['eta'] == 2.0
+    assert records[1]['batch_percent'] == 50.0
+    assert records[2]['percent'] == 100.0
+    assert records[2]['eta'] == 0.0
+    assert records[3]['return_code'] == 0
+
+    # the templates run together are reporting to the same tracker
+    json_path.unlink()
+    progress = ProgressTracker(show=False, json_path=str(json_path))
+    converters = []
+    for extension in ['.mp4', '.mkv']:
+        converters.append(MediaConverter(
+            name='fake%s' % extension,
+            command='ffmpeg -i "{input_file_full_path}" '
+                    '"{output_file_full_path}"',
+            output_file_extension=extension,
+            file_types=['.mov'],
+            source_path=str(source_path),
+            target_path=str(tmp_path / 'multi'),
+            progress=progress,
+        ))
+    jobs = MultiTemplateConverter(converters).run()
+
+    assert [job.status for job in jobs] == [Job.DONE, Job.DONE]
+    records = [json.loads(line) for line in json_path.read_text().splitlines()]
+    # decoded once, the merged job reports for both
+    assert [r['event'] for r in records] == [
+        'start', 'progress', 'progress', 'end'
+    ]
+    assert records[2]['batch_percent'] == 100.0
+
+
+def test_benchmark_results_are_compared_against_a_threshold(tmp_path):
+    """testing if the benchmark measures the templates on generated media and
+    if the comparison flags only the changes past the threshold
+    """
+    import shutil
+    import pytest
+    from media_converter import Benchmark, Manager
+
+    old = {'results': [
+        {'template': 'h264', 'source': 'video', 'size': '720p',
+         'return_code': 0, 'fps': 100.0, 'cpu_time': 10.0,
+         'output_bytes': 1000},
+        {'template': 'gif', 'source': 'video', 'size': '720p',
+         'return_code': 0, 'fps': 50.0, 'cpu_time': 4.0,
+         'output_bytes': 1000},
+    ]}
+    new = {'results': [
+        {'template': 'h264', 'source': 'video', 'size': '720p',
+         'return_code': 0, 'fps': 95.0, 'cpu_time': 12.0,
+         'output_bytes': 1000},
+        {'template': 'gif', 'source': 'video', 'size': '720p',
+         'return_code': 1},
+    ]}
+    assert Benchmark.compare(old, new, threshold=10) == [
+        ('h264', 'video', '720p', 'cpu_time', 10.0, 12.0, 20.0),
+        ('gif', 'video', '720p', 'return_code', 0, 1, None),
+    ]
+    assert Benchmark.compare(old, old, threshold=10) == []
+
+    if shutil.which('ffmpeg') is None:
+        pytest.skip('ffmpeg is not available')
+
+    benchmark = Benchmark(
+        [Manager().get_converter('audio_to_aac')], str(tmp_path),
+        sizes=['64x36'], duration=1,
+    )
+    results = benchmark.run()
+    assert [(r['template'], r['source']) for r in results['results']] == [
+        ('audio_to_aac', 'audio')
+    ]
+    result = results['results'][0]
+    assert result['return_code'] == 0
+    assert result['output_bytes'] > 0
+    assert result['cpu_time'] >= 0
+    assert result['peak_rss'] > 0
+    Benchmark.save(results, str(tmp_path / 'results.json'))
+    assert Benchmark.load(str(tmp_path / 'results.json')) == results
+
+
+def test_templates_are_run_as_arguments_without_a_shell(tmp_path, monkeypatch):
+    """testing if the templates are compiled in to arguments, the extra
+    options override the options with values containing spaces and the odd
+    file names are passed as they are
+    """
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import CommandTemplate, Job, Manager, MediaConverter
+    converter = Manager().get_converter('vertical_video_to_letterbox')
+    converter.extra_options = '-crf 20 -lavfi "scale=1920:-2, format=yuv420p"'
+    assert '-crf 15' not in converter.command
+    assert 'boxblur' not in converter.command
+
+    job = Job(
+        command=converter.command,
+        source_file_full_path="/in/it's a $clip.mov",
+        output_file_full_path='/out/`clip`.mp4',
+        extra_options=converter.extra_options,
+    )
+    assert job.arguments == [
+        'ffmpeg', '-i', "/in/it's a $clip.mov", '-acodec', 'copy',
+        '-crf', '20', '-lavfi', 'scale=1920:-2, format=yuv420p',
+        '/out/`clip`.mp4',
+    ]
+
+    # only the commands with shell syntax need a shell
+    assert CommandTemplate.compile('cp "{input_file_full_path}" x').uses_shell \
+        is False
+    assert CommandTemplate.compile('cat "{input_file_full_path}" | gzip') \
+        .uses_shell is True
+
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    odd_name = "it's a $clip `x`.txt"
+    (source_path / odd_name).write_text('data')
+    converter = MediaConverter(
+        name='copy',
+        command='cp "{input_file_full_path}" "{output_file_full_path}"',
+        output_file_extension='.out',
+        source_path=str(source_path),
+        target_path=str(tmp_path / 'target'),
+    )
+    jobs = converter.run()
+    assert [job.status for job in jobs] == [Job.DONE]
+    assert (tmp_path / 'target' / "it's a $clip `x`.out").read_text() == 'data'
+
+
+def test_template_listing_does_not_create_converters(monkeypatch, capsys):
+    """testing if the module imports within its time budget without the
+    heavy modules and if listing the templates for the shell completion
+    doesn't create any converter
+    """
+    import os
+    import subprocess
+    import sys
+    package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import sys, media_converter; print(" ".join(sys.modules))'],
+        cwd=package_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True,
+    )
+    modules = output.stdout.split()
+    for module in ['argparse', 'subprocess', 'sqlite3', 'json', 'shlex']:
+        assert module not in modules
+    import_times = [
+        line.split('|') for line in output.stderr.splitlines()
+        if line.endswith('| media_converter')
+    ]
+    # in microseconds, generous enough to include compiling the module when
+    # there is no byte code cache
+    assert int(import_times[0][1]) < 150000
+
+    import media_converter
+    from media_converter import Manager, MediaConverter
+
+    def fail(*args, **kwargs):
+        raise AssertionError('a converter is created')
+
+    monkeypatch.setattr(MediaConverter, '__init__', fail)
+    monkeypatch.setattr(sys, 'argv', ['media_converter', '-t', 'get_converters'])
+    media_converter.main()
+    assert capsys.readouterr().out.split() == Manager.list_converter_names()
+
+    monkeypatch.setattr(sys, 'argv', ['media_converter', '--completion'])
+    media_converter.main()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith('%s ' % media_converter.__version__)
+    assert lines[1].split() == Manager.list_converter_names()
+    assert '--template' in lines[2].split()
+
+
+def test_gif_palette_is_generated_once_per_source(tmp_path, monkeypatch):
+    """testing if the GIF palette is generated in a cached prepass and reused
+    with other filters, and the bounce GIF has the same frames without the
+    reverse filter
+    """
+    import shutil
+    import subprocess
+    import pytest
+    from media_converter import Job, Manager, PaletteEncoder
+
+    assert PaletteEncoder.parse_filter_graph(
+        'fps=10,split[s0][s1];[s0]palettegen=max_colors=64[p];'
+        '[s1][p]paletteuse=dither=bayer'
+    ) == ('fps=10', '=max_colors=64', '=dither=bayer', False)
+    assert PaletteEncoder.parse_filter_graph(
+        '[0]reverse[r];[0][r]concat=n=2:v=1:a=0,split[s0][s1];'
+        '[s0]palettegen[p];[s1][p]paletteuse'
+    ) == ('', '', '', True)
+
+    if not shutil.which('ffmpeg') or not shutil.which('ffprobe'):
+        pytest.skip('ffmpeg is not available')
+
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    subprocess.check_call([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi',
+        '-i', 'testsrc2=size=64x36:rate=25:duration=0.4',
+        '-start_number', '1001', str(source_path / 'frame.%04d.png'),
+    ])
+
+    def count_frames(path):
+        return int(subprocess.check_output([
+            'ffprobe', '-v', 'error', '-count_frames', '-select_streams',
+            'v:0', '-show_entries', 'stream=nb_read_frames', '-of', 'csv=p=0',
+            path,
+        ]))
+
+    manager = Manager()
+    for name, target, extra_options in [
+        ('image_seq_to_gif_bounce', 'inline', None),
+        ('image_seq_to_gif_bounce', 'prepass', None),
+        ('image_seq_to_gif_loop', 'scaled', '-vf scale=32:-2'),
+    ]:
+        converter = manager.get_converter(name)
+        converter.extra_options = extra_options
+        converter.source_path = str(source_path)
+        converter.target_path = str(tmp_path / target)
+        converter.gif_prepass = target != 'inline'
+        jobs = converter.run()
+        assert [job.status for job in jobs] == [Job.DONE]
+
+    assert count_frames(str(tmp_path / 'prepass' / 'frame.gif')) == \
+        count_frames(str(tmp_path / 'inline' / 'frame.gif')) == 20
+    assert count_frames(str(tmp_path / 'scaled' / 'frame.gif')) == 10
+    # the palette of the source is reused with the other filters
+    assert len(list((tmp_path / 'cache').rglob('*.png'))) == 1
+
+
+def test_scheduling_policy_pins_and_renices_the_jobs(
+        tmp_path, monkeypatch, capsys):
+    """testing if the jobs are run on their CPUs with the nice value of
+    their category and if the policy is shown in the summary
+    """
+    import os
+    import sys
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import (
+        Job, Manager, MediaConverter, SchedulingPolicy
+    )
+    assert SchedulingPolicy.parse_cpu_list('0-3,8,10-11') == \
+        [0, 1, 2, 3, 8, 10, 11]
+    assert SchedulingPolicy.format_cpu_list([11, 0, 1, 2, 3, 8, 10]) == \
+        '0-3,8,10-11'
+
+    manager = Manager()
+
+    def create_job(converter_name):
+        converter = manager.get_converter(converter_name)
+        return Job(
+            converter_name=converter.name,
+            command=converter.command,
+            source_file_full_path='input.mov',
+            output_file_full_path='output%s' % converter.output_file_extension,
+        )
+
+    assert SchedulingPolicy.get_category(create_job('audio_to_mp3')) == 'audio'
+    assert SchedulingPolicy.get_category(create_job('prores422hq')) == \
+        'mastering'
+    assert SchedulingPolicy.get_category(create_job('prores422lt_proxy')) == \
+        'proxy'
+
+    # the jobs share a set of CPUs, the least used ones are picked first
+    policy = SchedulingPolicy(affinity=True, cpus=[0, 1, 2, 3])
+    jobs = [create_job('prores422hq') for i in range(3)]
+    for job, threads in zip(jobs, [2, 1, 2]):
+        job.threads = threads
+        policy.acquire(job)
+    assert [job.cpus for job in jobs] == [[0, 1], [2], [0, 3]]
+    policy.release(jobs[0])
+    assert policy.load == {0: 1, 1: 0, 2: 1, 3: 1}
+
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    for i in range(2):
+        (source_path / ('file%i.txt' % i)).write_text('data')
+    cpu = min(os.sched_getaffinity(0))
+    converter = MediaConverter(
+        name='report',
+        command='"%s" -c "import os, sys; open(sys.argv[2], \'w\').write('
+                '\'%%s %%s\' %% (sorted(os.sched_getaffinity(0)), os.nice(0)))" '
+                '"{input_file_full_path}" "{output_file_full_path}"'
+                % sys.executable,
+        output_file_extension='.out',
+        source_path=str(source_path),
+        target_path=str(tmp_path / 'target'),
+        jobs=2,
+        scheduling=SchedulingPolicy(cpus=[cpu], priorities=True),
+    )
+    jobs = converter.run()
+    assert [job.status for job in jobs] == [Job.DONE] * 2
+    for i in range(2):
+        report = (tmp_path / 'target' / ('file%i.out' % i)).read_text()
+        assert report == '[%i] %i' % (cpu, os.nice(0) + 5)
+    assert 'scheduling: proxy: nice 5, ionice best-effort 4, 2 jobs on ' \
+        'cpus %i' % cpu in capsys.readouterr().out
+
+
+def test_work_queue_is_drained_by_several_workers(tmp_path, monkeypatch):
+    """testing if the jobs pushed to the queue are run by several worker
+    processes, the workers started before the jobs are pushed wait for them,
+    the jobs of a dead worker are leased again and the coordinator gives up
+    without live workers
+    """
+    import os
+    import sqlite3
+    import subprocess
+    import sys
+    import threading
+    import time
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import Job, MediaConverter, WorkQueue
+    package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    queue_path = str(tmp_path / 'queue.sqlite')
+
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    for i in range(6):
+        (source_path / ('file%i.txt' % i)).write_text('data %i' % i)
+    converter = MediaConverter(
+        name='copy',
+        command='"%s" -c "import shutil, sys, time; time.sleep(0.2); '
+                'shutil.copy(sys.argv[1], sys.argv[2])" '
+                '"{input_file_full_path}" "{output_file_full_path}"'
+                % sys.executable,
+        output_file_extension='.out',
+        source_path=str(source_path),
+        target_path=str(tmp_path / 'target'),
+        queue=WorkQueue(queue_path),
+    )
+    # the workers are started before the queue is created
+    workers = [
+        subprocess.Popen(
+            [sys.executable, os.path.join(package_path, 'media_converter.py'),
+             '--worker', queue_path, '-j', '2'],
+            stdout=subprocess.DEVNULL,
+        )
+        for i in range(3)
+    ]
+    time.sleep(1)
+    results = []
+    coordinator = threading.Thread(target=lambda: results.extend(converter.run()))
+    coordinator.start()
+    for worker in workers:
+        assert worker.wait(timeout=60) == 0
+    coordinator.join(timeout=60)
+
+    assert [job.status for job in results] == [Job.DONE] * 6
+    for i in range(6):
+        assert (tmp_path / 'target' / ('file%i.out' % i)).read_text() == \
+            'data %i' % i
+    connection = sqlite3.connect(queue_path)
+    worker_names = set(
+        row[0] for row in connection.execute('SELECT worker FROM jobs')
+    )
+    assert len(worker_names) > 1
+
+    # a worker dies while running a job, its lease expires
+    queue = WorkQueue(str(tmp_path / 'queue2.sqlite'), lease_time=0.1)
+    job = Job(
+        converter_name='copy',
+        command=converter.command,
+        source_file_full_path=str(source_path / 'file0.txt'),
+        output_file_full_path=str(tmp_path / 'target' / 'again.out'),
+    )
+    queue.push([job])
+    assert queue.lease('dead worker').queue_id == job.queue_id
+    assert queue.lease('live worker') is None
+    time.sleep(0.2)
+    leased_job = queue.lease('live worker')
+    assert leased_job.queue_id == job.queue_id
+    # the partial output of the dead worker is removed
+    assert leased_job.overwrite is True
+    leased_job.run()
+    queue.complete(leased_job, 'dead worker')
+    assert queue.has_unfinished_jobs()
+    queue.complete(leased_job, 'live worker')
+    assert not queue.has_unfinished_jobs()
+    queue.wait([job])
+    assert job.status == Job.DONE
+
+    # no worker is alive
+    queue = WorkQueue(str(tmp_path / 'queue3.sqlite'), worker_timeout=0.5)
+    job = Job(
+        converter_name='copy',
+        command=converter.command,
+        source_file_full_path=str(source_path / 'file0.txt'),
+        output_file_full_path=str(tmp_path / 'target' / 'never.out'),
+    )
+    batch = queue.push([job])
+    assert queue.has_open_batches()
+    start_time = time.time()
+    queue.wait([job], poll_interval=0.1)
+    assert time.time() - start_time < 5
+    assert job.status == Job.FAILED
+    queue.close_batch(batch)
+    assert not queue.has_open_batches()
+
+
+def test_batch_planner_orders_longest_jobs_first(tmp_path, monkeypatch, capsys):
+    """testing if the batch planner estimates the jobs from their probed
+    duration and resolution, starts the longest ones first and learns the
+    speed of the templates
+    """
+    import os
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import BatchPlanner, Job, MediaConverter, MediaProbe
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    # name, duration, width, height
+    sources = [
+        ('short.mov', 10, 1920, 1080),
+        ('long.mov', 60, 1280, 720),
+        ('big.mov', 20, 3840, 2160),
+        ('small.mov', 60, 640, 360),
+    ]
+    infos = {}
+    for name, duration, width, height in sources:
+        (source_path / name).write_text(name)
+        infos[str(source_path / name)] = {
+            'format': {'duration': str(duration)},
+            'streams': [
+                {'codec_type': 'video', 'width': width, 'height': height}
+            ],
+        }
+    monkeypatch.setattr(MediaProbe, 'probe', lambda path: infos[path])
+
+    planner = BatchPlanner(path=str(tmp_path / 'history.sqlite'))
+    converter = MediaConverter(
+        name='copy',
+        command='cp "{input_file_full_path}" "{output_file_full_path}"',
+        output_file_extension='.out',
+        source_path=str(source_path),
+        target_path=str(tmp_path / 'target'),
+        jobs=2,
+        planner=planner,
+        plan=True,
+    )
+    jobs = converter.run()
+
+    # the plan is printed, nothing is converted
+    assert not (tmp_path / 'target').exists()
+    assert all(job.status == Job.PENDING for job in jobs)
+    output = capsys.readouterr().out
+    assert 'no history' in output
+    assert 'estimated total time with 2 jobs' in output
+    ordered = [
+        os.path.basename(job.source_file_full_path)
+        for job in planner.order(jobs)
+    ]
+    assert ordered == ['big.mov', 'long.mov', 'short.mov', 'small.mov']
+    big = [job for job in jobs
+           if job.source_file_full_path.endswith('big.mov')][0]
+    assert round(planner.estimates[big]['units'], 3) == 165.888
+
+    # the longest first order finishes earlier than the listing order
+    assert BatchPlanner.get_total_time([1, 1, 3], 2) == 4
+    assert BatchPlanner.get_total_time([3, 1, 1], 2) == 3
+    assert BatchPlanner.get_total_time([3, 2, 2, 1], 1) == 8
+
+    # running the jobs records the speed of the template
+    converter.plan = False
+    jobs = converter.run()
+    assert all(job.status == Job.DONE for job in jobs)
+    speed = planner.get_speed('copy')
+    assert speed is not None and speed > 0
+    planner.estimates.clear()
+    planner.estimate(jobs)
+    assert all(work['learned'] for work in planner.estimates.values())
+    planner.close()
+
+
+def test_intra_only_sequences_are_encoded_in_frame_ranges(tmp_path, monkeypatch):
+    """testing if an image sequence of an intra-only template is encoded in
+    parallel frame ranges with the same frames and timing as a single process
+    """
+    import os
+    import shutil
+    import subprocess
+    import pytest
+    if not shutil.which('ffmpeg') or not shutil.which('ffprobe'):
+        pytest.skip('ffmpeg is not available')
+
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import FrameRangeEncoder, Job, Manager
+    monkeypatch.setattr(FrameRangeEncoder, 'min_frames', 10)
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    subprocess.check_call([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi',
+        '-i', 'testsrc2=duration=2.6:size=160x120:rate=25',
+        '-start_number', '1001', str(source_path / 'shot.%04d.png')
+    ])
+
+    def convert(target_path, **kwargs):
+        converter = Manager().get_converter('image_seq_to_mp4')
+        converter.source_path = str(source_path)
+        converter.target_path = str(tmp_path / target_path)
+        converter.extra_options = ''
+        for key, value in kwargs.items():
+            setattr(converter, key, value)
+        jobs = converter.run()
+        assert jobs[0].status == Job.DONE
+        assert not any(
+            name.startswith('.') for name in os.listdir(converter.target_path)
+        )
+        output = subprocess.check_output([
+            'ffprobe', '-v', 'error', '-select_streams', 'v',
+            '-show_entries', 'stream=nb_frames,duration,r_frame_rate',
+            '-show_entries', 'packet=pts,duration', '-of', 'compact',
+            jobs[0].output_file_full_path
+        ])
+        return jobs[0], output.decode()
+
+    ranged_job, ranged = convert('ranged', jobs=3, frame_ranges=True)
+    single_job, single = convert('single', jobs=1, frame_ranges=True)
+    assert isinstance(ranged_job.runner, FrameRangeEncoder)
+    assert single_job.runner is None
+    # the frame ranges are opt-in
+    default_job, default = convert('default', jobs=3)
+    assert default_job.runner is None
+    assert default == single
+    assert ranged == single
+    assert 'nb_frames=65' in ranged
+
+    job = Job(
+        converter_name='image_seq_to_mp4',
+        command=ranged_job.command,
+        source_file_full_path=ranged_job.source_file_full_path,
+        output_file_full_path=str(tmp_path / 'out.mp4'),
+    )
+    assert FrameRangeEncoder(jobs=3).get_ranges(job) == \
+        [[1001, 22], [1023, 22], [1045, 21]]
+    # temporal filters and inter frame codecs are not split
+    job.command = ranged_job.command.replace('-g 1', '-g 25')
+    assert not FrameRangeEncoder.is_supported(job)
+    job.command = ranged_job.command.replace('format=yuv420p', 'reverse')
+    assert not FrameRangeEncoder.is_supported(job)
+
+
+def test_chained_templates_are_run_through_pipes(
+        tmp_path, monkeypatch, capsys):
+    """testing if a chain of templates pipes the output of each template in
+    to the next one without writing intermediate files
+    """
+    import os
+    import shutil
+    import subprocess
+    import pytest
+    if not shutil.which('ffmpeg') or not shutil.which('ffprobe'):
+        pytest.skip('ffmpeg is not available')
+
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import Job, Manager, PipeChain
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    subprocess.check_call([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi',
+        '-i', 'testsrc2=duration=2:size=160x120:rate=30',
+        '-f', 'lavfi', '-i', 'sine=duration=2',
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+        str(source_path / 'clip.mp4')
+    ])
+
+    converter = Manager().get_converter('30_to_24+youtube')
+    assert converter.output_file_extension == '.mp4'
+    first, second = converter.command.split(' | ')
+    # the first stage keeps its filters but not its encoder
+    assert '-r 24' in first and '-crf' not in first
+    assert first.endswith('-f nut pipe:1')
+    assert second.startswith('ffmpeg -i pipe:0 -c:v libx264')
+    assert '{extra_options}' in second
+
+    converter.source_path = str(source_path)
+    converter.target_path = str(tmp_path / 'target')
+    converter.extra_options = ''
+    jobs = converter.run()
+    assert isinstance(jobs[0].runner, PipeChain)
+    assert jobs[0].status == Job.DONE
+    assert os.listdir(str(tmp_path / 'target')) == ['clip.mp4']
+    output = subprocess.check_output([
+        'ffprobe', '-v', 'error', '-select_streams', 'v',
+        '-show_entries', 'stream=codec_name,r_frame_rate', '-of', 'compact',
+        jobs[0].output_file_full_path
+    ]).decode()
+    assert 'codec_name=h264' in output and 'r_frame_rate=24/1' in output
+    printed = capsys.readouterr().out
+    assert 'stage 1/2 30_to_24:' in printed
+    assert 'stage 2/2 youtube:' in printed
+
+    # a failing stage fails the job
+    converter = Manager().get_converter('30_to_24+youtube')
+    converter.source_path = str(source_path)
+    converter.target_path = str(tmp_path / 'broken')
+    converter.extra_options = '-c:v no_such_encoder'
+    # the extra options only change the last stage
+    assert '-c:v rawvideo' in converter.command
+    jobs = converter.run()
+    assert jobs[0].status == Job.FAILED
+
+
+def test_probe_cache_probes_unchanged_files_once(tmp_path, monkeypatch, capsys):
+    """testing if the sources are probed in parallel before the conversion,
+    only probed again when they are changed and the ones that can not be
+    probed are reported up front
+    """
+    import os
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import (
+        Job, MediaConverter, MediaProbe, ProbeCache, ProgressTracker
+    )
+
+    # a fake ffprobe, logging its calls and failing for the empty files
+    log_path = tmp_path / 'ffprobe.log'
+    ffprobe = tmp_path / 'ffprobe'
+    ffprobe.write_text(
+        '#!/bin/sh\n'
+        'for last; do :; done\n'
+        'echo "$last" >> "%s"\n'
+        '[ -s "$last" ] || exit 1\n'
+        'echo \'{"format": {"duration": "12.5"}, "streams": [{"codec_type": '
+        '"video", "codec_name": "prores", "width": 64, "height": 48, '
+        '"nb_frames": "300"}]}\'\n' % log_path
+    )
+    os.chmod(str(ffprobe), 0o755)
+    monkeypatch.setattr(MediaProbe, 'executable', str(ffprobe))
+
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    for i in range(4):
+        (source_path / ('clip%i.mov' % i)).write_text('data %i' % i)
+    (source_path / 'broken.mov').write_text('')
+    (source_path / 'notes.txt').write_text('not a source')
+
+    def convert(cache, progress=True):
+        monkeypatch.setattr(MediaProbe, 'cache', cache)
+        converter = MediaConverter(
+            name='copy',
+            command='cp "{input_file_full_path}" "{output_file_full_path}"',
+            file_types=['.mov'],
+            output_file_extension='.out',
+            source_path=str(source_path),
+            target_path=str(tmp_path / 'target'),
+            jobs=2,
+        )
+        converter.dry_run = True
+        if progress:
+            # reads the durations of the sources
+            converter.progress = ProgressTracker(show=False)
+        return converter.run()
+
+    # a plain conversion doesn't need the info of the sources
+    cache_path = str(tmp_path / 'probe.sqlite')
+    convert(ProbeCache(path=cache_path), progress=False)
+    assert not log_path.exists()
+    assert 'can not be probed' not in capsys.readouterr().out
+
+    convert(ProbeCache(path=cache_path))
+    probed = sorted(os.path.basename(p) for p in log_path.read_text().split())
+    assert probed == ['broken.mov'] + ['clip%i.mov' % i for i in range(4)]
+    assert 'can not be probed: %s' % (source_path / 'broken.mov') in \
+        capsys.readouterr().out
+
+    # a new process finds the info in the database, the failures are not
+    # stored as they may be fixed without changing the file
+    log_path.write_text('')
+    cache = ProbeCache(path=cache_path)
+    convert(cache)
+    assert log_path.read_text().split() == [str(source_path / 'broken.mov')]
+    info = MediaProbe.probe(str(source_path / 'clip0.mov'))
+    assert info['streams'][0]['codec_name'] == 'prores'
+    assert MediaProbe.probe(str(source_path / 'broken.mov')) is None
+
+    # only the changed file is probed again
+    log_path.write_text('')
+    (source_path / 'clip1.mov').write_text('changed data')
+    convert(ProbeCache(path=cache_path))
+    assert sorted(log_path.read_text().split()) == \
+        [str(source_path / 'broken.mov'), str(source_path / 'clip1.mov')]
+
+    # a file which can be probed later is stored
+    monkeypatch.setattr(MediaProbe, 'executable', str(tmp_path / 'missing'))
+    assert MediaProbe.probe(str(source_path / 'clip2.mov')) is not None
+    cache = ProbeCache(path=cache_path)
+    monkeypatch.setattr(MediaProbe, 'cache', cache)
+    (source_path / 'clip3.mov').write_text('changed again')
+    assert MediaProbe.probe(str(source_path / 'clip3.mov')) is None
+    monkeypatch.setattr(MediaProbe, 'executable', str(ffprobe))
+    assert MediaProbe.probe(str(source_path / 'clip3.mov')) is not None
+
+    capsys.readouterr()
+    failed = cache.print_table(
+        [str(source_path / 'clip0.mov'), str(source_path / 'broken.mov')]
+    )
+    assert failed == [str(source_path / 'broken.mov')]
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == \
+        ['duration', 'video', 'resolution', 'frames', 'audio', 'path']
+    assert lines[1].split() == \
+        ['00:00:12', 'prores', '64x48', '300', '-', str(source_path / 'clip0.mov')]
+    cache.close()
+
+
+def test_outputs_are_staged_and_renamed_in_to_place(
+        tmp_path, monkeypatch, capsys):
+    """testing if the outputs are written to a temporary file and moved in to
+    place only when the job is succeeded, and auto renaming picks the free
+    names from the index of the target folder
+    """
+    import os
+    import sys
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import Job, MediaConverter, NameIndex
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    (source_path / 'a.txt').write_text('data a')
+    (source_path / 'a.dat').write_text('data b')
+    target_path = tmp_path / 'target'
+    target_path.mkdir()
+
+    # a job killed half way leaves nothing behind
+    converter = MediaConverter(
+        name='copy',
+        command='%s -c "import sys; open(sys.argv[1], \'w\').write(\'partial\'); '
+                'sys.exit(9)" "{output_file_full_path}"' % sys.executable,
+        output_file_extension='.out',
+        source_path=str(source_path / 'a.txt'),
+        target_path=str(target_path),
+    )
+    jobs = converter.run()
+    assert jobs[0].status == Job.FAILED
+    assert jobs[0].output_file_full_path == str(target_path / 'a.out')
+    assert os.listdir(str(target_path)) == []
+    # the command is printed with the final output path
+    output = capsys.readouterr().out
+    assert str(target_path / 'a.out') in output
+    assert '.part' not in output
+
+    # the existing outputs are kept and the free names are picked
+    (target_path / 'a.out').write_text('old')
+    (target_path / 'a_1.out').write_text('old')
+    converter = MediaConverter(
+        name='copy',
+        command='cp "{input_file_full_path}" "{output_file_full_path}"',
+        output_file_extension='.out',
+        source_path=str(source_path),
+        target_path=str(target_path),
+        auto_rename=True,
+        jobs=2,
+    )
+    jobs = converter.run()
+    assert sorted(os.path.basename(job.output_file_full_path) for job in jobs) == \
+        ['a_2.out', 'a_3.out']
+    assert sorted(os.listdir(str(target_path))) == \
+        ['a.out', 'a_1.out', 'a_2.out', 'a_3.out']
+    assert (target_path / 'a.out').read_text() == 'old'
+    assert sorted(
+        open(job.output_file_full_path).read() for job in jobs
+    ) == ['data a', 'data b']
+    # the written names are not reserved anymore
+    assert NameIndex.get(str(target_path)).reserved == set()
+
+    # another worker writes the same output while the job is running
+    def create_job(name, auto_rename):
+        final = str(target_path / name)
+        return Job(
+            converter_name='copy',
+            command='%s -c "import sys; open(sys.argv[1], \'w\').write(\'new\'); '
+                    'open(sys.argv[2], \'w\').write(\'other\')" '
+                    '"{output_file_full_path}" "%s"' % (sys.executable, final),
+            source_file_full_path=str(source_path / 'a.txt'),
+            output_file_full_path=final,
+            auto_rename=auto_rename,
+        )
+
+    job = create_job('b.out', auto_rename=True)
+    job.run()
+    assert job.status == Job.DONE
+    assert job.output_file_full_path == str(target_path / 'b_1.out')
+    assert (target_path / 'b.out').read_text() == 'other'
+    assert (target_path / 'b_1.out').read_text() == 'new'
+    assert NameIndex.get(str(target_path)).reserved == set()
+
+    job = create_job('c.out', auto_rename=False)
+    job.run()
+    assert job.status == Job.FAILED
+    assert (target_path / 'c.out').read_text() == 'other'
+
+    # the existing outputs are not replaced without hard links either, like
+    # on some network shares
+    def link(source, target):
+        raise PermissionError('hard links are not supported')
+    monkeypatch.setattr(os, 'link', link)
+    job = create_job('d.out', auto_rename=True)
+    job.run()
+    assert job.status == Job.DONE
+    assert job.output_file_full_path == str(target_path / 'd_1.out')
+    assert (target_path / 'd.out').read_text() == 'other'
+    assert (target_path / 'd_1.out').read_text() == 'new'
+
+    job = create_job('e.out', auto_rename=False)
+    job.run()
+    assert job.status == Job.FAILED
+    assert (target_path / 'e.out').read_text() == 'other'
+    assert not [
+        name for name in os.listdir(str(target_path)) if name.startswith('.')
+    ]
+
+
+def test_stalled_crashed_and_timed_out_jobs_are_killed_or_retried(
+        tmp_path, monkeypatch):
+    """testing if the watchdog kills the stalled and timed out jobs, the
+    crashed and stalled jobs are retried and a cancel kills everything
+    """
+    import os
+    import threading
+    import time
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import Job, MediaConverter, ProcessWatchdog
+
+    # a fake ffmpeg, behaving by the content of its input
+    bin_path = tmp_path / 'bin'
+    bin_path.mkdir()
+    ffmpeg = bin_path / 'ffmpeg'
+    ffmpeg.write_text(
+        '#!/bin/sh\n'
+        'while [ "$1" != "-i" ]; do shift; done\n'
+        'input="$2"\n'
+        'for output; do :; done\n'
+        'echo run >> "$input.runs"\n'
+        'case "$(cat "$input")" in\n'
+        '  hang) exec sleep 60 ;;\n'
+        '  slow) while true; do echo "frame=1"; sleep 0.2; done ;;\n'
+        '  crash) [ "$(wc -l < "$input.runs")" -gt 1 ] || kill -SEGV $$ ;;\n'
+        'esac\n'
+        'cp "$input" "$output"\n'
+    )
+    os.chmod(str(ffmpeg), 0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (bin_path, os.environ['PATH']))
+    monkeypatch.setattr(ProcessWatchdog, 'interval', 0.1)
+    monkeypatch.setattr(Job, 'retry_delay', 0.1)
+
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    for behavior in ['hang', 'slow', 'crash', 'ok']:
+        (source_path / ('%s.mov' % behavior)).write_text(behavior)
+
+    converter = MediaConverter(
+        name='fake',
+        command='ffmpeg -i "{input_file_full_path}" "{output_file_full_path}"',
+        file_types=['.mov'],
+        output_file_extension='.mp4',
+        source_path=str(source_path),
+        target_path=str(tmp_path / 'target'),
+        jobs=4,
+        timeout=3,
+        stall_timeout=1,
+        retries=1,
+    )
+    start_time = time.time()
+    jobs = converter.run()
+    assert time.time() - start_time < 20
+    results = dict(
+        (os.path.basename(job.source_file_full_path),
+         (job.status, job.attempts, job.kill_reason))
+        for job in jobs
+    )
+    assert results == {
+        'hang.mov': (Job.FAILED, 2, 'stalled for 1 seconds'),
+        'slow.mov': (Job.FAILED, 1, 'timed out after 3 seconds'),
+        'crash.mov': (Job.DONE, 2, None),
+        'ok.mov': (Job.DONE, 1, None),
+    }
+    assert sorted(os.listdir(str(tmp_path / 'target'))) == \
+        ['crash.mp4', 'ok.mp4']
+
+    # cancelling kills the running jobs and does not start the others
+    converter.target_path = str(tmp_path / 'cancelled')
+    converter.timeout = converter.stall_timeout = None
+    converter.jobs = 2
+    (source_path / 'crash.mov').write_text('hang')
+    threading.Timer(1, ProcessWatchdog.cancel).start()
+    start_time = time.time()
+    jobs = converter.run()
+    assert time.time() - start_time < 10
+    assert all(
+        job.status == Job.FAILED
+        for job in jobs if job.source_file_full_path.endswith('.mov')
+    )
+    ProcessWatchdog.reset()
+
+
+def test_target_quality_picks_the_highest_crf_meeting_the_target(
+        tmp_path, monkeypatch):
+    """testing if the CRF of the template is searched on sampled segments,
+    used in place of the CRF of the template and cached for the source
+    """
+    import re
+    import shutil
+    import subprocess
+    import pytest
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import Job, MediaConverter, QualitySearch
+    assert QualitySearch.parse_target('ssim:0.98') == ('ssim', 0.98)
+    assert QualitySearch.parse_target('42') == ('psnr', 42.0)
+    with pytest.raises(ValueError):
+        QualitySearch.parse_target('vmaf:95')
+
+    if not shutil.which('ffmpeg') or not shutil.which('ffprobe'):
+        pytest.skip('ffmpeg is not available')
+
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    subprocess.check_call([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi',
+        '-i', 'testsrc2=duration=4:size=160x120:rate=25',
+        '-c:v', 'ffv1', str(source_path / 'source.mkv')
+    ])
+    monkeypatch.setattr(QualitySearch, 'samples', 2)
+    monkeypatch.setattr(QualitySearch, 'sample_duration', 1.0)
+
+    def convert(target, quality):
+        converter = MediaConverter(
+            name='h264',
+            command='ffmpeg -i "{input_file_full_path}" -c:v libx264 '
+                    '-preset ultrafast -crf 18 -vf scale=80:-2 '
+                    '-pix_fmt yuv420p {extra_options} '
+                    '"{output_file_full_path}"',
+            file_types=['.mkv'],
+            output_file_extension='.mp4',
+            source_path=str(source_path),
+            target_path=str(tmp_path / target),
+            quality=quality,
+        )
+        jobs = converter.run()
+        assert jobs[0].status == Job.DONE
+        assert '-crf 18' not in jobs[0].command
+        return int(re.search(r'-crf (\d+)', jobs[0].extra_options).group(1))
+
+    path = str(tmp_path / 'quality.sqlite')
+    loose = QualitySearch(metric='ssim', target=0.95, path=path)
+    crf = convert('loose', loose)
+    assert QualitySearch.crf_range[0] < crf <= QualitySearch.crf_range[1]
+    strict = QualitySearch(metric='ssim', target=0.99, path=path)
+    assert convert('strict', strict) < crf
+    # the lowest CRF is used and cached when the target can not be reached
+    unreachable = QualitySearch(metric='ssim', target=1.01, path=path)
+    assert convert('unreachable', unreachable) == QualitySearch.crf_range[0]
+
+    # the searched CRF is cached for the unchanged source
+    def search(job):
+        raise AssertionError('searched again')
+    monkeypatch.setattr(loose, 'search', search)
+    assert convert('cached', loose) == crf
+    monkeypatch.setattr(unreachable, 'search', search)
+    assert convert('unreachable_cached', unreachable) == \
+        QualitySearch.crf_range[0]
+    loose.close()
+    strict.close()
+    unreachable.close()
+
+
+def test_preview_renders_sampled_windows_to_a_side_folder(
+        tmp_path, monkeypatch, capsys):
+    """testing if the preview only renders short windows sampled from the
+    sources next to the target folder with the command of the full batch
+    """
+    import os
+    import shutil
+    import subprocess
+    import sys
+    import pytest
+    import media_converter
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import Job, MediaConverter, PreviewRenderer
+
+    # the runners working on the whole source are not previewed
+    (tmp_path / 'clip.mov').write_text('')
+    preview = PreviewRenderer(samples=2, sample_duration=1.0)
+    for extension, options in [
+        ('.mp4', {'chunks': 2, 'jobs': 2}),
+        ('.gif', {'gif_prepass': True}),
+    ]:
+        converter = MediaConverter(
+            name='whole',
+            command='ffmpeg -i "{input_file_full_path}" -c:v libx264 '
+                    '"{output_file_full_path}"',
+            file_types=['.mov'],
+            output_file_extension=extension,
+            source_path=str(tmp_path / 'clip.mov'),
+            target_path=str(tmp_path / 'whole'),
+            preview=preview,
+            **options
+        )
+        assert converter.run() == []
+        assert 'can not be previewed' in capsys.readouterr().out
+    assert not (tmp_path / 'whole_preview').exists()
+
+    # zero windows is not running the full batch
+    monkeypatch.setattr(sys, 'argv', [
+        'media_converter', '-t', 'to_mp4', '-i', str(tmp_path / 'clip.mp4'),
+        '--preview', '0',
+    ])
+    with pytest.raises(SystemExit):
+        media_converter.main()
+    assert 'error: --preview' in capsys.readouterr().out
+
+    if not shutil.which('ffmpeg') or not shutil.which('ffprobe'):
+        pytest.skip('ffmpeg is not available')
+
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    subprocess.check_call([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi',
+        '-i', 'testsrc2=duration=10:size=160x120:rate=25',
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p', str(source_path / 'clip.mp4')
+    ])
+    subprocess.check_call([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi',
+        '-i', 'testsrc2=duration=4:size=160x120:rate=25',
+        str(source_path / 'shot.%04d.png')
+    ])
+
+    def count_frames(path):
+        return int(subprocess.check_output([
+            'ffprobe', '-v', 'error', '-count_frames', '-select_streams', 'v',
+            '-show_entries', 'stream=nb_read_frames', '-of', 'csv=p=0', path
+        ]))
+
+    def convert(source, preview=None):
+        converter = MediaConverter(
+            name='h264',
+            command='ffmpeg -i "{input_file_full_path}" '
+                    '-c:v libx264 -preset ultrafast -pix_fmt yuv420p '
+                    '{extra_options} "{output_file_full_path}"',
+            file_types=['.mp4', '.png'],
+            output_file_extension='.mov',
+            source_path=str(source),
+            target_path=str(tmp_path / 'target'),
+            extra_options='-crf 30',
+            preview=preview,
+        )
+        return converter.run()
+
+    preview = PreviewRenderer(samples=2, sample_duration=1.0)
+    preview_jobs = convert(source_path / 'clip.mp4', preview)
+    preview_jobs += convert(source_path / 'shot.%04d.png', preview)
+    assert [job.status for job in preview_jobs] == [Job.DONE] * 4
+    assert not (tmp_path / 'target').exists()
+    preview_path = tmp_path / 'target_preview'
+    assert sorted(os.listdir(str(preview_path))) == [
+        'clip.preview1.mov', 'clip.preview2.mov',
+        'shot.preview1.mov', 'shot.preview2.mov',
+    ]
+    for name in sorted(os.listdir(str(preview_path))):
+        assert count_frames(str(preview_path / name)) == 25
+
+    # the full batch runs the printed command
+    output = capsys.readouterr().out
+    jobs = convert(source_path / 'clip.mp4')
+    assert jobs[0].status == Job.DONE
+    assert 'rendered command: %s' % jobs[0].rendered_command in output
+    assert count_frames(jobs[0].output_file_full_path) == 250
+
+
+def test_batch_runs_jobs_in_process_and_returns_futures(
+        tmp_path, monkeypatch, capsys):
+    """testing if the Batch runs the jobs of several submits on a shared pool,
+    returns futures of the jobs, prints nothing and leaves the templates of
+    the Manager untouched
+    """
+    import os
+    import shutil
+    import subprocess
+    import pytest
+    if not shutil.which('ffmpeg'):
+        pytest.skip('ffmpeg is not available')
+
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import Batch, Job, Manager, QuietPrinter
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    for name in ['a', 'b', 'c']:
+        subprocess.check_call([
+            'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'sine=duration=1',
+            str(source_path / ('%s.wav' % name))
+        ])
+    (tmp_path / 'target').mkdir()
+    (tmp_path / 'target' / 'c.m4a').write_text('existing')
+
+    manager = Manager()
+    command = manager.get_converter('audio_to_aac').command
+    with Batch(jobs=2, manager=manager) as batch:
+        futures = batch.submit(
+            'audio_to_aac', [str(source_path / 'a.wav'), str(source_path)],
+            target_path=str(tmp_path / 'target'), extra_options='-b:a 64k',
+        )
+        jobs = [future.result() for future in futures]
+        with pytest.raises(ValueError):
+            batch.submit('no_such_template', [str(source_path)])
+        with pytest.raises(TypeError):
+            batch.submit('audio_to_aac', [str(source_path)], no_such_option=1)
+        # the options of MediaConverter.run are refused, not ignored
+        for option in ['dry_run', 'preview', 'plan']:
+            with pytest.raises(TypeError):
+                batch.run(
+                    'audio_to_aac', str(source_path / 'c.wav'),
+                    target_path=str(tmp_path / 'dry_run'), **{option: True}
+                )
+        assert not (tmp_path / 'dry_run').exists()
+        renamed = batch.run(
+            'audio_to_aac', str(source_path / 'c.wav'),
+            target_path=str(tmp_path / 'target'), auto_rename=True,
+        )
+
+    assert capsys.readouterr().out == ''
+    results = sorted(
+        (os.path.basename(job.output_file_full_path), job.status)
+        for job in jobs
+    )
+    assert results == [
+        ('a.m4a', Job.DONE),
+        ('a.m4a', Job.SKIPPED),
+        ('b.m4a', Job.DONE),
+        ('c.m4a', Job.SKIPPED),
+    ]
+    for job in jobs:
+        assert isinstance(job.printer, QuietPrinter)
+        if job.status == Job.DONE:
+            assert job.return_code == 0
+            assert job.elapsed >= 0
+            assert '-b:a 64k' in job.rendered_command
+            assert '-b:a 192k' not in job.rendered_command
+            assert any('output_file_full_path' in l for l in job.printer.lines)
+    assert [job.status for job in renamed] == [Job.DONE]
+    assert renamed[0].output_file_full_path.endswith('c_1.m4a')
+
+    # the template of the Manager is not changed by the options
+    assert manager.get_converter('audio_to_aac').command == command
+    assert manager.get_converter('audio_to_aac').extra_options is None
+
+
+def test_chunked_and_frame_range_jobs_are_timed_out_with_their_parts(
+        tmp_path, monkeypatch):
+    """testing if the splitting, the parts and the joining of the chunked
+    and frame range encodes are killed with the limits of their job
+    """
+    import os
+    import time
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    from media_converter import (
+        ChunkedEncoder, FrameRangeEncoder, Job, ProcessWatchdog
+    )
+    bin_path = tmp_path / 'bin'
+    bin_path.mkdir()
+    ffmpeg = bin_path / 'ffmpeg'
+    ffmpeg.write_text('#!/bin/sh\nexec sleep 60\n')
+    os.chmod(str(ffmpeg), 0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (bin_path, os.environ['PATH']))
+    monkeypatch.setattr(ProcessWatchdog, 'interval', 0.1)
+    monkeypatch.setattr(ChunkedEncoder, 'get_segment_time', lambda self, job: 1.0)
+
+    source_path = tmp_path / 'source'
+    source_path.mkdir()
+    for frame in range(1, 101):
+        (source_path / ('shot.%04i.png' % frame)).write_text('')
+    (source_path / 'clip.mov').write_text('')
+    target_path = tmp_path / 'target'
+    target_path.mkdir()
+
+    def run(runner, source, **kwargs):
+        job = Job(
+            converter_name='prores',
+            command='ffmpeg -i "{input_file_full_path}" -c:v prores_ks '
+                    '"{output_file_full_path}"',
+            source_file_full_path=str(source_path / source),
+            output_file_full_path=str(target_path / 'output.mov'),
+            **kwargs
+        )
+        job.runner = runner
+        start_time = time.time()
+        job.run()
+        assert time.time() - start_time < 10
+        return job
+
+    # the frame ranges are timed out together, not one by one
+    job = run(
+        FrameRangeEncoder(ranges=4, jobs=2), 'shot.%04d.png', timeout=1,
+        retries=1,
+    )
+    assert (job.status, job.attempts, job.kill_reason) == \
+        (Job.FAILED, 1, 'timed out after 1 seconds')
+
+    # the split is stalled
+    job = run(ChunkedEncoder(chunks=2, jobs=2), 'clip.mov', stall_timeout=1)
+    assert (job.status, job.kill_reason) == \
+        (Job.FAILED, 'stalled for 1 seconds')
+    assert os.listdir(str(target_path)) == []